@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+'''
+Check that configMigrations.migrate() migrates a ClusterConfiguration like the chain of
+generate_new_cluster_configuration it replaced.
+
+Each case of the table is migrated by both, legacyMigrate() being a copy of the
+removed chain without the API calls. The spec and status written back must be
+equal, except for the cases the chain flagged on every run, which the step
+registry leaves as they are.
+
+    python3 benchmark/checkMigrations.py
+
+Only needs the controller sources.
+'''
+
+import copy
+import json
+import os
+import sys
+
+'''
+repoDir: The root of the ks-installer repository.
+version: The installer version the cases are migrated to.
+'''
+repoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+version = 'v3.4.0'
+
+sys.path.insert(0, os.path.join(repoDir, 'controller', 'lib'))
+import configMigrations  # noqa: E402
+
+
+def legacyMigrate(resource, version):
+    '''
+    The removed generate_new_cluster_configuration, returning the spec and
+    status it recreated the ClusterConfiguration with, or None when it left it
+    as it was.
+    '''
+    cluster_configuration_spec = copy.deepcopy(resource.get('spec'))
+    cluster_configuration_status = copy.deepcopy(resource.get('status'))
+    upgrade_flag = False
+
+    if "common" in cluster_configuration_spec:
+        if "mysqlVolumeSize" in cluster_configuration_spec["common"]:
+            del cluster_configuration_spec["common"]["mysqlVolumeSize"]
+        if "etcdVolumeSize" in cluster_configuration_spec["common"]:
+            del cluster_configuration_spec["common"]["etcdVolumeSize"]
+        if cluster_configuration_status is not None and "redis" in cluster_configuration_status and "status" in cluster_configuration_status[
+                "redis"] and cluster_configuration_status["redis"]["status"] == "enabled":
+            cluster_configuration_spec["common"]["redis"] = {"enabled": True}
+        else:
+            cluster_configuration_spec["common"]["redis"] = {"enabled": False}
+
+        if cluster_configuration_status is not None and "openldap" in cluster_configuration_status and "status" in cluster_configuration_status[
+                "openldap"] and cluster_configuration_status["openldap"]["status"] == "enabled":
+            cluster_configuration_spec["common"]["openldap"] = {"enabled": True}
+        else:
+            cluster_configuration_spec["common"]["openldap"] = {"enabled": False}
+
+        if "redisVolumSize" in cluster_configuration_spec["common"]:
+            cluster_configuration_spec["common"]["redis"][
+                "volumeSize"] = cluster_configuration_spec["common"]["redisVolumSize"]
+            del cluster_configuration_spec["common"]["redisVolumSize"]
+        if "openldapVolumeSize" in cluster_configuration_spec["common"]:
+            cluster_configuration_spec["common"]["openldap"][
+                "volumeSize"] = cluster_configuration_spec["common"]["openldapVolumeSize"]
+            del cluster_configuration_spec["common"]["openldapVolumeSize"]
+        if "minio" not in cluster_configuration_spec["common"]:
+            if "minioVolumeSize" in cluster_configuration_spec["common"]:
+                cluster_configuration_spec["common"]["minio"] = {
+                    "volumeSize": cluster_configuration_spec["common"]["minioVolumeSize"]
+                }
+                del cluster_configuration_spec["common"]["minioVolumeSize"]
+        else:
+            if "minioVolumeSize" in cluster_configuration_spec["common"]:
+                cluster_configuration_spec["common"]["minio"]["volumeSize"] = cluster_configuration_spec["common"]["minioVolumeSize"]
+                del cluster_configuration_spec["common"]["minioVolumeSize"]
+
+        if "es" in cluster_configuration_spec["common"]:
+            es = cluster_configuration_spec["common"]["es"]
+            if "master" not in es:
+                es["master"] = {"volumeSize": "4Gi"}
+            if "data" not in es:
+                es["data"] = {"volumeSize": "20Gi"}
+            if "elasticsearchMasterReplicas" in es:
+                es["master"]["replicas"] = es["elasticsearchMasterReplicas"]
+                del es["elasticsearchMasterReplicas"]
+            if "elasticsearchDataReplicas" in es:
+                es["data"]["replicas"] = es["elasticsearchDataReplicas"]
+                del es["elasticsearchDataReplicas"]
+            if "elasticsearchMasterVolumeSize" in es:
+                es["master"]["volumeSize"] = es["elasticsearchMasterVolumeSize"]
+                del es["elasticsearchMasterVolumeSize"]
+            if "elasticsearchDataVolumeSize" in es:
+                es["data"]["volumeSize"] = es["elasticsearchDataVolumeSize"]
+                del es["elasticsearchDataVolumeSize"]
+            if "externalElasticsearchHost" not in es and "externalElasticsearchUrl" in es:
+                es["externalElasticsearchHost"] = es["externalElasticsearchUrl"]
+
+        if "console" in cluster_configuration_spec:
+            if "core" in cluster_configuration_spec["common"]:
+                cluster_configuration_spec["common"]["core"]["console"] = cluster_configuration_spec["console"]
+            else:
+                cluster_configuration_spec["common"]["core"] = {
+                    "console": cluster_configuration_spec["console"]
+                }
+            del cluster_configuration_spec["console"]
+
+    if "logging" in cluster_configuration_spec and "logsidecarReplicas" in cluster_configuration_spec[
+            "logging"]:
+        upgrade_flag = True
+        if "enabled" in cluster_configuration_spec["logging"]:
+            enabled = bool(cluster_configuration_spec["logging"]["enabled"])
+            cluster_configuration_spec["logging"] = {
+                "enabled": enabled,
+                "logsidecar": {
+                    "enabled": enabled,
+                    "replicas": 2
+                }
+            }
+
+    if "notification" in cluster_configuration_spec:
+        upgrade_flag = True
+        del cluster_configuration_spec['notification']
+
+    if "openpitrix" in cluster_configuration_spec and "store" not in cluster_configuration_spec[
+            "openpitrix"]:
+        upgrade_flag = True
+        if "enabled" in cluster_configuration_spec["openpitrix"]:
+            cluster_configuration_spec["openpitrix"] = {
+                "store": {
+                    "enabled": bool(cluster_configuration_spec["openpitrix"]["enabled"])
+                }
+            }
+
+    if "networkpolicy" in cluster_configuration_spec:
+        upgrade_flag = True
+        cluster_configuration_spec["network"] = {
+            "networkpolicy": {
+                "enabled": bool(cluster_configuration_spec["networkpolicy"].get("enabled")),
+            },
+            "ippool": {
+                "type": "none",
+            },
+            "topology": {
+                "type": "none",
+            },
+        }
+        del cluster_configuration_spec["networkpolicy"]
+
+    if "kubeedge" in cluster_configuration_spec:
+        upgrade_flag = True
+        if "enabled" in cluster_configuration_spec["kubeedge"]:
+            cluster_configuration_spec["edgeruntime"] = {
+                "enabled": cluster_configuration_spec["kubeedge"]["enabled"],
+                "kubeedge": cluster_configuration_spec["kubeedge"]
+            }
+            cluster_configuration_spec["edgeruntime"]["kubeedge"]["iptables-manager"] = {
+                "enabled": True,
+                "mode": "external"
+            }
+        try:
+            del cluster_configuration_spec["edgeruntime"]["kubeedge"]["edgeWatcher"]
+        except BaseException:
+            pass
+        del cluster_configuration_spec["kubeedge"]
+
+    if isinstance(cluster_configuration_status, dict) and "core" in cluster_configuration_status:
+        if cluster_configuration_status["core"].get("version") != version:
+            upgrade_flag = True
+
+    if not upgrade_flag:
+        return None
+    status = {}
+    if isinstance(cluster_configuration_status, dict) and "clusterId" in cluster_configuration_status:
+        status = {"clusterId": cluster_configuration_status["clusterId"]}
+    return cluster_configuration_spec, status
+
+
+def applyMergePatch(target, patch):
+    '''
+    Apply a JSON merge patch (RFC 7386) like the API server does.
+    '''
+    if not isinstance(patch, dict):
+        return patch
+    result = copy.deepcopy(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = applyMergePatch(result.get(key), value)
+    return result
+
+
+def registryMigrate(resource, version):
+    patch = configMigrations.migrate(copy.deepcopy(resource), version)
+    if patch is None:
+        return None
+    return (applyMergePatch(resource.get('spec') or {}, patch.get('spec') or {}),
+            applyMergePatch(resource.get('status') or {}, patch.get('status') or {}))
+
+
+'''
+cases: Name, ClusterConfiguration, and 'unchanged' for the cases the registry leaves alone on purpose.
+'''
+v30Common = {
+    'mysqlVolumeSize': '20Gi',
+    'etcdVolumeSize': '20Gi',
+    'redisVolumSize': '2Gi',
+    'openldapVolumeSize': '2Gi',
+    'minioVolumeSize': '20Gi',
+    'es': {
+        'elasticsearchMasterReplicas': 1,
+        'elasticsearchDataReplicas': 1,
+        'elasticsearchMasterVolumeSize': '4Gi',
+        'elasticsearchDataVolumeSize': '20Gi',
+        'logMaxAge': 7,
+        'elkPrefix': 'logstash',
+        'externalElasticsearchUrl': '',
+    },
+}
+v30Status = {
+    'clusterId': 'c1',
+    'core': {'status': 'enabled', 'version': 'v3.0.0'},
+    'redis': {'status': 'enabled'},
+    'openldap': {'status': 'enabled'},
+}
+cases = [
+    ('v3.0 everything enabled', {
+        'spec': {
+            'common': copy.deepcopy(v30Common),
+            'console': {'enableMultiLogin': False, 'port': 30880},
+            'logging': {'enabled': True, 'logsidecarReplicas': 2},
+            'notification': {'enabled': True},
+            'openpitrix': {'enabled': True},
+            'networkpolicy': {'enabled': True},
+            'devops': {'enabled': True},
+        },
+        'status': copy.deepcopy(v30Status),
+    }, None),
+    ('v3.0 everything disabled', {
+        'spec': {
+            'common': copy.deepcopy(v30Common),
+            'console': {'port': 30880},
+            'logging': {'enabled': False, 'logsidecarReplicas': 2},
+            'openpitrix': {'enabled': False},
+            'networkpolicy': {'enabled': False},
+        },
+        'status': {'clusterId': 'c1', 'core': {'status': 'enabled', 'version': 'v3.0.0'}},
+    }, None),
+    ('v3.0 without status', {
+        'spec': {
+            'common': copy.deepcopy(v30Common),
+            'logging': {'enabled': True, 'logsidecarReplicas': 2},
+        },
+    }, None),
+    ('v3.0 minio and common.core present', {
+        'spec': {
+            'common': dict(copy.deepcopy(v30Common), minio={'volumeSize': '10Gi'}, core={'console': {'port': 1}}),
+            'console': {'port': 30880},
+            'notification': {},
+        },
+        'status': copy.deepcopy(v30Status),
+    }, None),
+    ('v3.1 kubeedge enabled', {
+        'spec': {
+            'common': {'redis': {'enabled': True}, 'openldap': {'enabled': True}, 'minio': {'volumeSize': '20Gi'}},
+            'openpitrix': {'store': {'enabled': True}},
+            'network': {'networkpolicy': {'enabled': False}, 'ippool': {'type': 'none'}, 'topology': {'type': 'none'}},
+            'kubeedge': {
+                'enabled': True,
+                'cloudCore': {'cloudhubPort': '10000'},
+                'edgeWatcher': {'nodeSelector': {}},
+            },
+        },
+        'status': {'clusterId': 'c1', 'core': {'status': 'enabled', 'version': 'v3.1.1'},
+                   'redis': {'status': 'enabled'}, 'kubeedge': {'status': 'enabled'}},
+    }, None),
+    ('v3.1 kubeedge disabled', {
+        'spec': {
+            'common': {'redis': {'enabled': False}, 'openldap': {'enabled': False}},
+            'kubeedge': {'enabled': False, 'edgeWatcher': {}},
+        },
+        'status': {'clusterId': 'c1', 'core': {'status': 'enabled', 'version': 'v3.1.1'}},
+    }, None),
+    ('v3.1 kubeedge without enabled next to edgeruntime', {
+        'spec': {
+            'kubeedge': {'cloudCore': {}},
+            'edgeruntime': {'enabled': True, 'kubeedge': {'enabled': True, 'edgeWatcher': {}}},
+        },
+        'status': {'clusterId': 'c1', 'core': {'status': 'enabled', 'version': 'v3.1.1'}},
+    }, None),
+    ('v3.3 upgraded', {
+        'spec': {
+            'common': {'redis': {'enabled': True, 'volumeSize': '2Gi'}, 'openldap': {'enabled': True}},
+            'edgeruntime': {'enabled': False, 'kubeedge': {'enabled': False}},
+            'logging': {'enabled': True, 'logsidecar': {'enabled': True, 'replicas': 2}},
+        },
+        'status': {'clusterId': 'c1', 'core': {'status': 'enabled', 'version': 'v3.3.2'},
+                   'redis': {'status': 'enabled'}, 'openldap': {'status': 'enabled'}},
+    }, None),
+    ('v3.3 current', {
+        'spec': {
+            'common': {'redis': {'enabled': True, 'volumeSize': '2Gi'}, 'openldap': {'enabled': False}},
+            'edgeruntime': {'enabled': False, 'kubeedge': {'enabled': False}},
+        },
+        'status': {'clusterId': 'c1', 'core': {'status': 'enabled', 'version': version}},
+    }, None),
+    ('v3.3 fresh install', {
+        'spec': {
+            'common': {'redis': {'enabled': False}, 'openldap': {'enabled': False}},
+            'edgeruntime': {'enabled': False},
+        },
+    }, None),
+    # The chain flagged these on every run without changing them, the registry leaves them alone
+    ('logsidecarReplicas without enabled', {
+        'spec': {'logging': {'logsidecarReplicas': 2}},
+        'status': {'clusterId': 'c1', 'core': {'status': 'enabled', 'version': version}},
+    }, 'unchanged'),
+    ('openpitrix without store or enabled', {
+        'spec': {'openpitrix': {}},
+        'status': {'clusterId': 'c1', 'core': {'status': 'enabled', 'version': version}},
+    }, 'unchanged'),
+]
+
+
+def main():
+    failed = 0
+    for name, resource, expected in cases:
+        got = registryMigrate(resource, version)
+        want = None if expected == 'unchanged' else legacyMigrate(resource, version)
+        if got == want:
+            print('ok      {}'.format(name))
+            continue
+        failed += 1
+        print('FAILED  {}\n  registry: {}\n  expected: {}'.format(
+            name, json.dumps(got, sort_keys=True), json.dumps(want, sort_keys=True)))
+    print('{} of {} cases migrated as expected'.format(len(cases) - failed, len(cases)))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,249 @@
+# encoding: utf-8
+
+import collections
+import copy
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+'''
+clusterConfigurationPath: The ClusterConfiguration watched by the installer.
+configMapPath: The ConfigMaps, e.g. the one the installer keeps its checkpoint in.
+kubernetesVersion: The version reported by /version.
+'''
+clusterConfigurationPath = re.compile(
+    r'^/apis/installer\.kubesphere\.io/v1alpha1/namespaces/(?P<namespace>[^/]+)/clusterconfigurations(/(?P<name>[^/]+))?$')
+configMapPath = re.compile(r'^/api/v1/namespaces/(?P<namespace>[^/]+)/configmaps(/(?P<name>[^/]+))?$')
+kubernetesVersion = 'v1.23.10'
+
+
+def mergePatch(target, patch):
+    '''
+    Apply a JSON merge patch (RFC 7386) and return the result.
+    '''
+    if not isinstance(patch, dict):
+        return copy.deepcopy(patch)
+    result = copy.deepcopy(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = mergePatch(result.get(key), value)
+    return result
+
+
+def syntheticNodes(count):
+    nodes = []
+    for index in range(count):
+        name = 'node{}'.format(index + 1)
+        labels = {'kubernetes.io/hostname': name, 'kubernetes.io/os': 'linux'}
+        if index == 0:
+            labels['node-role.kubernetes.io/master'] = ''
+        nodes.append({
+            'apiVersion': 'v1',
+            'kind': 'Node',
+            'metadata': {
+                'name': name,
+                'uid': '00000000-0000-0000-0000-{:012d}'.format(index),
+                'resourceVersion': str(index + 1),
+                'labels': labels,
+                'annotations': {'node.alpha.kubernetes.io/ttl': '0'},
+            },
+            'spec': {'podCIDR': '10.233.{}.0/24'.format(index % 256)},
+            'status': {
+                'addresses': [
+                    {'type': 'InternalIP', 'address': '192.168.{}.{}'.format(index // 250, index % 250 + 1)},
+                    {'type': 'Hostname', 'address': name},
+                ],
+                'capacity': {'cpu': '8', 'memory': '16Gi', 'pods': '110'},
+                'nodeInfo': {'kubeletVersion': kubernetesVersion, 'osImage': 'Ubuntu 20.04 LTS',
+                             'containerRuntimeVersion': 'containerd://1.6.4', 'machineID': '{:032x}'.format(index)},
+                'conditions': [{'type': 'Ready', 'status': 'True'}],
+            },
+        })
+    return nodes
+
+
+class FakeApiServer():
+    '''
+    A stand-in for the Kubernetes API serving the calls made by installRunner.py:
+    the ks-installer ClusterConfiguration, the Nodes, the ConfigMaps and the
+    server version.
+    Every request is counted so the API traffic of a run can be reported.
+    '''
+
+    def __init__(self, clusterConfiguration, nodeCount=3, host='127.0.0.1', port=0):
+        '''
+        :param clusterConfiguration: The ClusterConfiguration object served at start
+        :param nodeCount: Number of synthetic nodes returned by the Node list
+        '''
+        self.nodes = syntheticNodes(nodeCount)
+        self.requests = collections.Counter()
+        self._lock = threading.Lock()
+        self._resourceVersion = len(self.nodes)
+        self.clusterConfigurations = {}
+        self.configMaps = {}
+        if clusterConfiguration:
+            self._store(copy.deepcopy(clusterConfiguration))
+        self.server = ThreadingHTTPServer((host, port), self._handlerClass())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def writeKubeconfig(self, path):
+        kubeconfig = {
+            'apiVersion': 'v1',
+            'kind': 'Config',
+            'clusters': [{'name': 'fake', 'cluster': {'server': self.url}}],
+            'users': [{'name': 'fake', 'user': {'token': 'fake'}}],
+            'contexts': [{'name': 'fake', 'context': {'cluster': 'fake', 'user': 'fake'}}],
+            'current-context': 'fake',
+        }
+        with open(path, 'w') as f:
+            json.dump(kubeconfig, f)
+
+    def clusterConfiguration(self, namespace='kubesphere-system', name='ks-installer'):
+        with self._lock:
+            return copy.deepcopy(self.clusterConfigurations.get((namespace, name)))
+
+    def _store(self, resource):
+        metadata = resource.setdefault('metadata', {})
+        self._resourceVersion += 1
+        metadata['resourceVersion'] = str(self._resourceVersion)
+        self.clusterConfigurations[(metadata.get('namespace'), metadata.get('name'))] = resource
+        return resource
+
+    def _listNodes(self, query, accept):
+        limit = int(query.get('limit', ['0'])[0] or 0)
+        offset = int(query.get('continue', ['0'])[0] or 0)
+        items = self.nodes[offset:offset + limit] if limit else self.nodes[offset:]
+        metadata = {'resourceVersion': str(self._resourceVersion)}
+        if limit and offset + limit < len(self.nodes):
+            metadata['continue'] = str(offset + limit)
+        if 'as=PartialObjectMetadataList' in accept:
+            return {'apiVersion': 'meta.k8s.io/v1', 'kind': 'PartialObjectMetadataList', 'metadata': metadata,
+                    'items': [{'apiVersion': 'meta.k8s.io/v1', 'kind': 'PartialObjectMetadata',
+                               'metadata': item['metadata']} for item in items]}
+        return {'apiVersion': 'v1', 'kind': 'NodeList', 'metadata': metadata, 'items': items}
+
+    def route(self, method, path, query, body, accept=''):
+        '''
+        Answer a request with (status code, JSON body).
+        '''
+        self.requests['{} {}'.format(method, path)] += 1
+
+        if method == 'GET' and path == '/version':
+            return 200, {'major': '1', 'minor': '23', 'gitVersion': kubernetesVersion,
+                         'gitCommit': '0' * 40, 'gitTreeState': 'clean', 'buildDate': '2022-08-17T18:47:37Z',
+                         'goVersion': 'go1.17.13', 'compiler': 'gc', 'platform': 'linux/amd64'}
+        if method == 'GET' and path == '/api/v1/nodes':
+            return 200, self._listNodes(query, accept)
+        if method == 'GET' and path.startswith('/api/v1/nodes/'):
+            name = path[len('/api/v1/nodes/'):]
+            node = next((node for node in self.nodes if node['metadata']['name'] == name), None)
+            if node is None:
+                return 404, status(404, 'NotFound', 'nodes "{}" not found'.format(name))
+            return 200, node
+
+        match = configMapPath.match(path)
+        if match:
+            return self._configMap(method, match.group('namespace'), match.group('name'), body)
+
+        match = clusterConfigurationPath.match(path)
+        if not match:
+            return 404, status(404, 'NotFound', 'the server could not find the requested resource')
+        key = (match.group('namespace'), match.group('name'))
+
+        with self._lock:
+            if match.group('name') is None:
+                if method == 'POST':
+                    body.setdefault('metadata', {})['namespace'] = key[0]
+                    name = body['metadata'].get('name')
+                    if (key[0], name) in self.clusterConfigurations:
+                        return 409, status(409, 'AlreadyExists', 'clusterconfigurations "{}" already exists'.format(name))
+                    return 201, self._store(body)
+                if method == 'GET':
+                    items = [item for (namespace, _), item in self.clusterConfigurations.items() if namespace == key[0]]
+                    return 200, {'apiVersion': 'installer.kubesphere.io/v1alpha1',
+                                 'kind': 'ClusterConfigurationList', 'metadata': {}, 'items': items}
+                return 405, status(405, 'MethodNotAllowed', method)
+
+            resource = self.clusterConfigurations.get(key)
+            if resource is None:
+                return 404, status(404, 'NotFound', 'clusterconfigurations "{}" not found'.format(key[1]))
+            if method == 'GET':
+                return 200, resource
+            if method == 'DELETE':
+                del self.clusterConfigurations[key]
+                return 200, status(200, 'Success', '')
+            if method == 'PATCH':
+                return 200, self._store(mergePatch(resource, body))
+            if method == 'PUT':
+                return 200, self._store(body)
+        return 405, status(405, 'MethodNotAllowed', method)
+
+    def _configMap(self, method, namespace, name, body):
+        with self._lock:
+            if name is None:
+                if method != 'POST':
+                    return 405, status(405, 'MethodNotAllowed', method)
+                body.setdefault('metadata', {})['namespace'] = namespace
+                key = (namespace, body['metadata'].get('name'))
+                if key in self.configMaps:
+                    return 409, status(409, 'AlreadyExists', 'configmaps "{}" already exists'.format(key[1]))
+                self.configMaps[key] = body
+                return 201, body
+            resource = self.configMaps.get((namespace, name))
+            if resource is None:
+                return 404, status(404, 'NotFound', 'configmaps "{}" not found'.format(name))
+            if method == 'GET':
+                return 200, resource
+            if method == 'PATCH':
+                self.configMaps[(namespace, name)] = mergePatch(resource, body)
+                return 200, self.configMaps[(namespace, name)]
+        return 405, status(405, 'MethodNotAllowed', method)
+
+    def _handlerClass(self):
+        apiServer = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _serve(self):
+                url = urlparse(self.path)
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length) or b'null') if length else None
+                code, response = apiServer.route(
+                    self.command, url.path.rstrip('/') or '/', parse_qs(url.query), body,
+                    self.headers.get('Accept') or '')
+                payload = json.dumps(response).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _serve
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def status(code, reason, message):
+    return {'apiVersion': 'v1', 'kind': 'Status', 'status': 'Failure' if code >= 400 else 'Success',
+            'code': code, 'reason': reason, 'message': message}
@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+'''
+Run the whole installRunner.py flow offline and report how long it took.
+
+The controller runs in --debug mode in a scratch directory, against the
+FakeApiServer in this directory and stub playbooks that only run `sleep`
+tasks. The stub playbooks are scheduled with the real
+playbooks/dependencies.yaml, so the numbers show the cost of the
+controller, ansible_runner and Ansible themselves and not of the cluster.
+
+    python3 benchmark/runBenchmark.py --components all --tasks 5 --task-seconds 0.2 --runs 3
+
+Needs the same Python packages as the controller (ansible, ansible_runner,
+kubernetes and PyYAML).
+'''
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import yaml
+
+from fakeApiServer import FakeApiServer
+
+'''
+repoDir: The root of the ks-installer repository.
+postInstallPlaybooks: The playbooks run one after another by resultInfo() once the components are installed.
+alwaysEnabled: The components installed whatever the ClusterConfiguration says, see getComponentLists().
+preInstallPlaybooks: The playbooks run before the components, see preInstallTasks().
+'''
+repoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+postInstallPlaybooks = ['ks-config', 'result-info', 'ks-migration', 'telemetry']
+alwaysEnabled = ['monitoring', 'multicluster', 'openpitrix', 'network']
+preInstallPlaybooks = ['preinstall', 'metrics_server', 'common', 'ks-core']
+
+sys.path.insert(0, os.path.join(repoDir, 'controller', 'lib'))
+
+import taskScheduler  # noqa: E402
+
+
+def clusterConfiguration(components, upgrade):
+    '''
+    The ClusterConfiguration of deploy/cluster-configuration.yaml with either its
+    own components enabled ("default") or every component enabled ("all").
+    With upgrade the status carries an older version, so the controller first
+    migrates the ClusterConfiguration like it does after an upgrade.
+    '''
+    with open(os.path.join(repoDir, 'deploy', 'cluster-configuration.yaml'), 'r') as f:
+        clusterConfig = yaml.safe_load(f)
+
+    if components == 'all':
+        for value in clusterConfig['spec'].values():
+            if isinstance(value, dict) and 'enabled' in value:
+                value['enabled'] = True
+
+    clusterConfig['metadata']['labels']['version'] = 'master'
+    clusterConfig['status'] = {
+        'clusterId': 'benchmark',
+        'core': {'version': 'v0.0.0' if upgrade else 'master', 'status': 'enabled'},
+    }
+    return clusterConfig
+
+
+def stubTaskCount(name, graph, args):
+    if args.scale_by_weight:
+        return args.tasks * graph.weight(name)
+    return args.tasks
+
+
+def stubPlaybook(name, taskCount, taskSeconds):
+    tasks = [{
+        'name': '{} | stub task {}'.format(name, index + 1),
+        'command': 'sleep {}'.format(taskSeconds),
+        'changed_when': False,
+    } for index in range(taskCount)]
+    if name == 'ks-core':
+        # Like the real ks-core role, record the installed version in the
+        # status, which is reset by the migration of an upgrade
+        tasks.append({
+            'name': 'ks-core | record the installed version',
+            'uri': {
+                'url': '{{ benchmark_api_server }}/apis/installer.kubesphere.io/v1alpha1'
+                       '/namespaces/kubesphere-system/clusterconfigurations/ks-installer',
+                'method': 'PATCH',
+                'headers': {'Content-Type': 'application/merge-patch+json'},
+                'body_format': 'json',
+                'body': {'status': {'core': {'version': 'master', 'status': 'enabled'}}},
+            },
+        })
+    if name == 'result-info':
+        tasks.append({
+            'name': 'result-info | write kubesphere_running',
+            'copy': {'content': 'KubeSphere benchmark run finished\n', 'dest': '{{ playbook_dir }}/kubesphere_running'},
+        })
+    return [{'hosts': 'localhost', 'gather_facts': False, 'tasks': tasks}]
+
+
+def prepareWorkDir(workDir, graph, componentNames, args):
+    playbooksDir = os.path.join(workDir, 'playbooks')
+    resultsDir = os.path.join(workDir, 'results')
+    os.makedirs(playbooksDir, exist_ok=True)
+    os.makedirs(os.path.join(workDir, 'roles'), exist_ok=True)
+    os.makedirs(os.path.join(resultsDir, 'env'), exist_ok=True)
+
+    shutil.copy(os.path.join(repoDir, 'playbooks', 'dependencies.yaml'), playbooksDir)
+    durations = {}
+    for name in set(componentNames) | set(graph.nodes) | set(postInstallPlaybooks):
+        taskCount = stubTaskCount(name, graph, args)
+        durations[name] = taskCount * args.task_seconds
+        with open(os.path.join(playbooksDir, name + '.yaml'), 'w') as f:
+            yaml.safe_dump(stubPlaybook(name, taskCount, args.task_seconds), f, sort_keys=False)
+
+    with open(os.path.join(resultsDir, 'env', 'cmdline'), 'w') as f:
+        f.write(' '.join('-e @{}'.format(os.path.join(resultsDir, name))
+                         for name in ('ks-config.json', 'ks-status.json', 'ks-facts.json')))
+    return durations
+
+
+def enabledComponents(clusterConfig):
+    names = list(alwaysEnabled)
+    for name, value in clusterConfig['spec'].items():
+        if isinstance(value, dict) and value.get('enabled') and name not in names:
+            names.append(name)
+    return [name for name in names if name not in ('metrics_server', 'networkpolicy', 'telemetry')]
+
+
+def idealMakespan(names, graph, concurrency, durations):
+    '''
+    The time the given playbooks would take if each one cost exactly the sleep
+    of its stub tasks, scheduled in the same order as TaskScheduler does.
+    '''
+    prerequisites, dependents = graph.subgraph(names)
+    priority = graph.criticalPath(names, dependents)
+    order = {name: index for index, name in enumerate(names)}
+    remaining = {name: len(deps) for name, deps in prerequisites.items()}
+    ready = sorted([name for name, count in remaining.items() if count == 0],
+                   key=lambda name: (-priority[name], order[name]))
+    running = []
+    now = 0.0
+    while ready or running:
+        while ready and len(running) < concurrency:
+            name = ready.pop(0)
+            running.append((now + durations.get(name, 0.0), name))
+        running.sort()
+        now, name = running.pop(0)
+        for dependent in dependents[name]:
+            remaining[dependent] -= 1
+            if remaining[dependent] == 0:
+                ready.append(dependent)
+        ready.sort(key=lambda name: (-priority[name], order[name]))
+    return now
+
+
+def processTree(rootPid):
+    '''
+    The pids of a process and all of its descendants, read from /proc.
+    '''
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry), 'r') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        parentPid = int(stat[stat.rfind(')') + 2:].split()[1])
+        children.setdefault(parentPid, []).append(int(entry))
+
+    pids, pending = [], [rootPid]
+    while pending:
+        pid = pending.pop()
+        pids.append(pid)
+        pending.extend(children.get(pid, []))
+    return pids
+
+
+def treeMemory(rootPid):
+    '''
+    The resident and the proportional set size of a process tree. The RSS
+    counts the pages processes share, e.g. forked workers, once per process.
+    '''
+    rss = pss = 0
+    for pid in processTree(rootPid):
+        try:
+            with open('/proc/{}/smaps_rollup'.format(pid), 'r') as f:
+                for line in f:
+                    if line.startswith('Rss:'):
+                        rss += int(line.split()[1]) * 1024
+                    elif line.startswith('Pss:'):
+                        pss += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return rss, pss
+
+
+class RssSampler():
+
+    def __init__(self, pid, interval=0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.peakPss = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            rss, pss = treeMemory(self.pid)
+            self.peak = max(self.peak, rss)
+            self.peakPss = max(self.peakPss, pss)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def runController(workDir, kubeconfig, args, log):
+    env = dict(os.environ)
+    env.update({
+        'KUBECONFIG': kubeconfig,
+        'KS_INSTALLER_CONCURRENCY': str(args.concurrency),
+        'KS_INSTALLER_ANSIBLE_WORKERS': str(args.concurrency if args.ansible_workers is None else args.ansible_workers),
+        'KS_INSTALLER_METRICS_PORT': '0',
+        'ANSIBLE_ROLES_PATH': os.path.join(workDir, 'roles'),
+    })
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.time()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(repoDir, 'controller', 'installRunner.py'), '--debug'],
+        cwd=workDir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    with RssSampler(process.pid) as sampler:
+        rc = process.wait()
+    wall = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'rc': rc,
+        'wallSeconds': wall,
+        'cpuUserSeconds': after.ru_utime - before.ru_utime,
+        'cpuSystemSeconds': after.ru_stime - before.ru_stime,
+        'peakRssBytes': sampler.peak,
+        'peakPssBytes': sampler.peakPss,
+        'start': start,
+    }
+
+
+def playbooksRun(resultsDir, since):
+    '''
+    The playbooks whose artifact directory was written since the given time.
+    '''
+    names = []
+    for name in os.listdir(resultsDir):
+        path = os.path.join(resultsDir, name)
+        if not os.path.isdir(path) or name == 'env':
+            continue
+        for root, _, files in os.walk(path):
+            if any(os.path.getmtime(os.path.join(root, f)) >= since for f in files):
+                names.append(name)
+                break
+    return names
+
+
+def benchmark(args):
+    graph = taskScheduler.TaskGraph.load(os.path.join(repoDir, 'playbooks', 'dependencies.yaml'))
+    clusterConfig = clusterConfiguration(args.components, args.upgrade)
+    componentNames = preInstallPlaybooks + enabledComponents(clusterConfig)
+
+    baseDir = tempfile.mkdtemp(prefix='ks-installer-benchmark-')
+    runs = []
+    try:
+        workDir = None
+        for index in range(args.runs):
+            if workDir is None or not args.keep_state:
+                workDir = os.path.join(baseDir, 'run{}'.format(index + 1))
+                os.makedirs(workDir)
+                durations = prepareWorkDir(workDir, graph, componentNames, args)
+
+            apiServer = FakeApiServer(clusterConfig, nodeCount=args.nodes).start()
+            kubeconfig = os.path.join(workDir, 'kubeconfig')
+            apiServer.writeKubeconfig(kubeconfig)
+            with open(os.path.join(workDir, 'results', 'env', 'extravars'), 'w') as f:
+                yaml.safe_dump({'ansible_connection': 'local', 'benchmark_api_server': apiServer.url}, f)
+
+            with open(os.path.join(workDir, 'controller.log'), 'a') as log:
+                result = runController(workDir, kubeconfig, args, log)
+            apiServer.stop()
+
+            ran = playbooksRun(os.path.join(workDir, 'results'), result.pop('start'))
+            components = [name for name in componentNames if name in ran]
+            post = [name for name in postInstallPlaybooks if name in ran]
+            ideal = idealMakespan(components, graph, args.concurrency, durations) if components else 0.0
+            ideal += sum(durations[name] for name in post)
+
+            result.update({
+                'run': index + 1,
+                'playbooks': len(components) + len(post),
+                'idealSeconds': ideal,
+                'overheadSeconds': result['wallSeconds'] - ideal,
+                'apiRequests': sum(apiServer.requests.values()),
+                'workDir': workDir,
+            })
+            runs.append(result)
+            if result['rc'] != 0:
+                print('run {} failed with rc {}, see {}'.format(
+                    index + 1, result['rc'], os.path.join(workDir, 'controller.log')), file=sys.stderr)
+    finally:
+        if not args.keep_workdir:
+            shutil.rmtree(baseDir, ignore_errors=True)
+    return runs
+
+
+def summarize(runs):
+    keys = ['wallSeconds', 'idealSeconds', 'overheadSeconds', 'cpuUserSeconds', 'cpuSystemSeconds', 'peakRssBytes', 'peakPssBytes']
+    return {key: {
+        'min': min(run[key] for run in runs),
+        'median': statistics.median(run[key] for run in runs),
+        'max': max(run[key] for run in runs),
+    } for key in keys}
+
+
+def printTable(runs, summary):
+    header = '{:>4} {:>3} {:>9} {:>9} {:>9} {:>8} {:>8} {:>9} {:>9} {:>5} {:>6}'.format(
+        'run', 'rc', 'wall(s)', 'ideal(s)', 'ovhd(s)', 'user(s)', 'sys(s)', 'rss(MiB)', 'pss(MiB)', 'pbs', 'api')
+    print(header)
+    for run in runs:
+        print('{:>4} {:>3} {:>9.2f} {:>9.2f} {:>9.2f} {:>8.2f} {:>8.2f} {:>9.1f} {:>9.1f} {:>5} {:>6}'.format(
+            run['run'], run['rc'], run['wallSeconds'], run['idealSeconds'], run['overheadSeconds'],
+            run['cpuUserSeconds'], run['cpuSystemSeconds'], run['peakRssBytes'] / 1048576.0,
+            run['peakPssBytes'] / 1048576.0, run['playbooks'], run['apiRequests']))
+    median = {key: value['median'] for key, value in summary.items()}
+    print('{:>8} {:>9.2f} {:>9.2f} {:>9.2f} {:>8.2f} {:>8.2f} {:>9.1f} {:>9.1f}'.format(
+        'median', median['wallSeconds'], median['idealSeconds'], median['overheadSeconds'],
+        median['cpuUserSeconds'], median['cpuSystemSeconds'], median['peakRssBytes'] / 1048576.0,
+        median['peakPssBytes'] / 1048576.0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--components', choices=['default', 'all'], default='all',
+                        help='enable the components of deploy/cluster-configuration.yaml or all of them')
+    parser.add_argument('--tasks', type=int, default=5, help='stub tasks per playbook')
+    parser.add_argument('--task-seconds', type=float, default=0.1, help='sleep of each stub task')
+    parser.add_argument('--scale-by-weight', action='store_true',
+                        help='multiply the stub tasks of a playbook by its weight in dependencies.yaml')
+    parser.add_argument('--nodes', type=int, default=3, help='nodes returned by the fake API server')
+    parser.add_argument('--concurrency', type=int, default=int(os.environ.get('KS_INSTALLER_CONCURRENCY', 4)))
+    parser.add_argument('--ansible-workers', type=int,
+                        help='pre-forked Ansible workers, the concurrency by default, 0 starts ansible-playbook per playbook')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--upgrade', action='store_true',
+                        help='start from an outdated ClusterConfiguration status, so each run migrates it first')
+    parser.add_argument('--keep-state', action='store_true',
+                        help='reuse the scratch directory between runs to measure reconciles without changes')
+    parser.add_argument('--keep-workdir', action='store_true', help='keep the scratch directories and logs')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    runs = benchmark(args)
+    summary = summarize(runs)
+    if args.json:
+        print(json.dumps({'arguments': vars(args), 'runs': runs, 'summary': summary}, indent=2))
+    else:
+        printTable(runs, summary)
+    if any(run['rc'] != 0 for run in runs):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
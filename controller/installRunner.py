@@ -3,23 +3,84 @@
 
 import os
 import sys
+import atexit
 import shutil
 import json
-import ansible_runner
 import collections
 import logging
-from kubernetes import client, config
+import signal
+
+# Helper modules live in lib/, which shell-operator skips when discovering hooks
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lib'))
+
+import taskScheduler  # noqa: E402
+import reconcileState  # noqa: E402
+import runnerEvents  # noqa: E402
+import installerMetrics  # noqa: E402
+import eventLog  # noqa: E402
+import clusterFacts  # noqa: E402
+import configMigrations  # noqa: E402
+import ansibleWorkers  # noqa: E402
+import clusterStatus  # noqa: E402
+import installProgress  # noqa: E402
+import reconcileDaemon  # noqa: E402
+import memoryAdmission  # noqa: E402
+import clusterFleet  # noqa: E402
+import imagePrepull  # noqa: E402
+import clusterTeardown  # noqa: E402
 
 '''
 playbookBasePath: The folder where the playbooks is located.
 privateDataDir: The folder where the playbooks execution results are located.
 configFile: Define the parameters in the installation process. Generated by cluster configuration
 statusFile: Define the status in the installation process.
+factsFile: Define the cluster facts collected for the roles, e.g. the number of nodes and the first node's IP.
+fingerprintFile: Define the fingerprints of the inputs of each playbook's last successful run.
+progressFile: Define the duration and task count of each playbook's last successful run, the base of the progress estimates.
+memoryFile: Define the peak memory of each playbook's last successful run, the base of the memory admission.
+fleetDir: The folder holding a state folder for every cluster reconciled in fleet mode.
+imagesFile: The defaults of the download role, defining the images of the offline images list.
+checkpointConfigMap: The namespace and name of the ConfigMap keeping the fingerprints across installer pods, so an interrupted install resumes.
+prepullDaemonSet: The namespace and name of the DaemonSet pulling the images of a reconcile onto the nodes.
+concurrency: Maximum number of playbooks running at the same time.
+nodePageSize: Number of nodes read per list call when collecting the cluster facts.
+metricsPort: Port of the Prometheus metrics endpoint, 0 disables it.
+eventLogDir: The folder where the compressed event logs of the playbook runs are located.
+artifactMode: "compact" keeps the events only in the event logs, "files" also writes ansible_runner's job_events files.
+ansibleWorkerCount: Number of pre-forked Ansible workers the playbooks run in, 0 starts a new ansible-playbook for every playbook.
+statusInterval: Seconds the status changes reported by the playbooks are collected for before they are written to the ClusterConfiguration.
+daemonSocket: The unix socket a resident controller started with --daemon serves the hook invocations on.
+daemonWindow: Seconds the resident controller waits for more changes of the spec before it reconciles.
+playbookMemory: Bytes of memory a playbook is expected to take before its peak was sampled once.
+memoryReserve: Fraction of the memory limit of the pod no playbook is started into.
+fleetWorkers: Number of clusters reconciled at the same time in fleet mode.
+prepullTimeout: Seconds the images of a reconcile are pulled onto the nodes for at most, 0 disables the pre-pull.
 '''
 playbookBasePath = '/kubesphere/playbooks'
 privateDataDir = '/kubesphere/results'
 configFile = '/kubesphere/config/ks-config.json'
 statusFile = '/kubesphere/config/ks-status.json'
+factsFile = '/kubesphere/config/ks-facts.json'
+fingerprintFile = '/kubesphere/config/ks-fingerprints.json'
+progressFile = '/kubesphere/config/ks-progress.json'
+memoryFile = '/kubesphere/config/ks-memory.json'
+fleetDir = '/kubesphere/fleet'
+imagesFile = '/kubesphere/installer/roles/download/defaults/main.yml'
+checkpointConfigMap = ('kubesphere-system', 'ks-installer-checkpoint')
+prepullDaemonSet = ('kubesphere-system', 'ks-installer-image-prepull')
+concurrency = int(os.environ.get('KS_INSTALLER_CONCURRENCY', 4))
+nodePageSize = int(os.environ.get('KS_INSTALLER_NODE_PAGE_SIZE', 500))
+metricsPort = int(os.environ.get('KS_INSTALLER_METRICS_PORT', 9797))
+eventLogDir = '/kubesphere/results/event-logs'
+artifactMode = os.environ.get('KS_INSTALLER_ARTIFACTS', 'compact')
+ansibleWorkerCount = int(os.environ.get('KS_INSTALLER_ANSIBLE_WORKERS', concurrency))
+statusInterval = float(os.environ.get('KS_INSTALLER_STATUS_INTERVAL', 3))
+daemonSocket = os.environ.get('KS_INSTALLER_SOCKET', '/kubesphere/results/installer.sock')
+daemonWindow = float(os.environ.get('KS_INSTALLER_DAEMON_WINDOW', 5))
+playbookMemory = int(os.environ.get('KS_INSTALLER_PLAYBOOK_MEMORY', 256 * 1024 * 1024))
+memoryReserve = float(os.environ.get('KS_INSTALLER_MEMORY_RESERVE', 0.1))
+fleetWorkers = int(os.environ.get('KS_INSTALLER_FLEET_WORKERS', 4))
+prepullTimeout = int(os.environ.get('KS_INSTALLER_PREPULL_TIMEOUT', 1800))
 
 logging.basicConfig(level=logging.INFO, format="%(message)s")
 
@@ -63,7 +124,10 @@ class component():
             artifact_dir,
             ident,
             quiet,
-            rotate_artifacts):
+            rotate_artifacts,
+            finished_callback=None,
+            event_handler=None,
+            status_handler=None):
         '''
         :param private_data_dir: The directory containing all runner metadata needed to invoke the runner
                                  module. Output artifacts will also be stored here for later consumption.
@@ -72,6 +136,9 @@ class component():
         :param playbook: The playbook that will be invoked by runner when executing Ansible.
         :param artifact_dir: The path to the directory where artifacts should live, this defaults to 'artifacts' under the private data dir
         :param quiet: Disable all output
+        :param finished_callback: Called with the runner object once the playbook has finished
+        :param event_handler: Called with each event of the playbook, returning False skips writing it to job_events
+        :param status_handler: Called with each status change of the playbook run
         '''
 
         self.playbook = playbook
@@ -80,21 +147,98 @@ class component():
         self.ident = ident
         self.quiet = quiet
         self.rotate_artifacts = rotate_artifacts
+        self.finished_callback = finished_callback
+        self.event_handler = event_handler
+        self.status_handler = status_handler
+        self.thread = None
+        self.canceled = False
 
     # Generate ansible_runner objects based on parameters
 
     def installRunner(self):
+        import ansible_runner
+
+        # The artifacts of a canceled run are removed with those of the last one
+        if os.path.exists(self.artifact_dir):
+            shutil.rmtree(self.artifact_dir)
+
+        self.canceled = False
         installer = ansible_runner.run_async(
             playbook=self.playbook,
             private_data_dir=self.private_data_dir,
             artifact_dir=self.artifact_dir,
             ident=self.ident,
             quiet=self.quiet,
-            rotate_artifacts=self.rotate_artifacts
+            rotate_artifacts=self.rotate_artifacts,
+            envvars=runnerEnvvars(self.artifact_dir),
+            finished_callback=self.finished_callback,
+            cancel_callback=lambda: self.canceled,
+            event_handler=self.event_handler,
+            status_handler=self.status_handler
         )
+        self.thread = installer[0]
         return installer[1]
 
 
+# Environment of a playbook run, the kubesphere_k8s action plugin keeps its
+# per-run read cache under the artifact directory
+
+
+def runnerEnvvars(artifactDir):
+    cacheDir = os.path.join(artifactDir, 'k8s-cache')
+    if os.path.exists(cacheDir):
+        shutil.rmtree(cacheDir)
+
+    envvars = {
+        'KS_K8S_CACHE_DIR': cacheDir,
+        'KS_STATUS_WRITER': '1',
+        ansibleWorkers.pidFileEnv: os.path.join(artifactDir, 'playbook.pid')
+    }
+    envvars.update(workerPool.envvars())
+    return envvars
+
+
+# ansible_runner saves the envvars of its first run to env/envvars and that file
+# then overrides the envvars of every later run, an empty one keeps them per run
+
+
+def resetRunnerEnvFile():
+    envDir = os.path.join(privateDataDir, 'env')
+    if not os.path.exists(envDir):
+        os.makedirs(envDir)
+    with open(os.path.join(envDir, 'envvars'), 'w') as f:
+        f.write('{}')
+
+
+# The runs read the configuration, status and facts files as extra vars, a
+# cluster of the fleet passes its own files
+
+
+def writeRunnerCmdline():
+    with open(os.path.join(privateDataDir, 'env', 'cmdline'), 'w') as f:
+        f.write(' '.join('-e @{}'.format(path) for path in (configFile, statusFile, factsFile)))
+
+
+# Keep the files of the controller in another folder, e.g. for --debug or a cluster of the fleet
+
+
+def useStateDir(stateDir):
+    global privateDataDir, configFile, statusFile, factsFile, fingerprintFile, progressFile, memoryFile, daemonSocket
+
+    privateDataDir = stateDir
+    configFile = os.path.join(stateDir, 'ks-config.json')
+    statusFile = os.path.join(stateDir, 'ks-status.json')
+    factsFile = os.path.join(stateDir, 'ks-facts.json')
+    fingerprintFile = os.path.join(stateDir, 'ks-fingerprints.json')
+    progressFile = os.path.join(stateDir, 'ks-progress.json')
+    memoryFile = os.path.join(stateDir, 'ks-memory.json')
+    jobEventLog.baseDir = os.path.join(stateDir, 'event-logs')
+    statusWriter.path = statusFile
+    progress.historyFile = progressFile
+    admission.historyFile = memoryFile
+    daemonSocket = os.path.join(stateDir, 'installer.sock')
+
+
 # Using the Observer pattern to get the info of task execution
 
 class Subject(object):
@@ -144,6 +288,46 @@ infoGetter = Info('taskInfo')
 viewer = InfoViewer()
 infoGetter.attach(viewer)
 
+# The events of every playbook run are streamed to these handlers
+
+eventStream = runnerEvents.EventStream()
+jobEventLog = eventLog.EventLog(
+    eventLogDir,
+    keepRuns=int(os.environ.get('KS_INSTALLER_EVENT_LOG_RUNS', 5)),
+    byteBudget=int(os.environ.get('KS_INSTALLER_EVENT_LOG_BYTES', 64 * 1024 * 1024)),
+    writeJobEvents=(artifactMode == 'files'))
+eventStream.attach(jobEventLog)
+metrics = installerMetrics.InstallerMetrics()
+eventStream.attach(metrics)
+# The status changes reported by the playbooks are written to the ClusterConfiguration together
+statusWriter = clusterStatus.StatusWriter(statusFile, statusInterval)
+eventStream.attach(statusWriter)
+# The progress of the playbooks is served by the metrics server and summarized in the status
+progress = installProgress.InstallProgress(
+    progressFile, report=lambda summary: statusWriter.update({'progress': summary}))
+eventStream.attach(progress)
+# Playbooks only start while the memory limit of the pod leaves room for them
+admission = memoryAdmission.MemoryAdmission(
+    memoryFile,
+    lambda name: os.path.join(privateDataDir, name, 'playbook.pid'),
+    playbookMemory,
+    memoryReserve,
+    report=lambda summary: statusWriter.update({'admission': summary}))
+eventStream.attach(admission)
+# The images of the playbooks are pulled onto the nodes while the first playbooks run
+prepull = imagePrepull.ImagePrepull(
+    prepullDaemonSet[0], prepullDaemonSet[1], prepullTimeout,
+    report=lambda summary: statusWriter.update({'prepull': summary}))
+
+# The spec of the ClusterConfiguration is watched for changes during a run
+specWatch = reconcileDaemon.SpecWatch()
+
+# Playbooks run in workers forked from a process with Ansible already imported
+workerPool = ansibleWorkers.WorkerPool(ansibleWorkerCount)
+
+# The clusters reconciled by a controller started with --fleet
+fleet = clusterFleet.Fleet(fleetWorkers)
+
 
 def get_cluster_configuration(api):
     resource = api.get_namespaced_custom_object(
@@ -157,93 +341,184 @@ def get_cluster_configuration(api):
     return resource
 
 
-def create_cluster_configuration(api, resource):
-    api.create_namespaced_custom_object(
-        group="installer.kubesphere.io",
-        version="v1alpha1",
-        namespace="kubesphere-system",
-        plural="clusterconfigurations",
-        body=resource,
-    )
-
-    logging.info("Create cluster configuration successfully")
-
-
-def delete_cluster_configuration(api):
-    api.delete_namespaced_custom_object(
+def patch_cluster_configuration(api, patch):
+    api.patch_namespaced_custom_object(
         group="installer.kubesphere.io",
         version="v1alpha1",
         name="ks-installer",
         namespace="kubesphere-system",
         plural="clusterconfigurations",
+        body=patch,
     )
 
-    logging.info("Delete old cluster configuration successfully")
 
+def notifyInfo(message):
+    infoGetter.info = message
+
+
+def getResultInfo(spec):
+    '''
+    Run the changed tasks and return whether one of them failed, together with
+    the digest of the spec the run covers in full, None when a change of the
+    spec during the run is left to the next reconcile.
+    :param spec: The digest of the spec the configuration file was generated from
+    '''
+    # Execute the pre-install tasks and components as their dependencies allow
+    tasks = preInstallTasks()
+    tasks.update(generateTaskLists())
+    graph = taskScheduler.TaskGraph.load(
+        os.path.join(playbookBasePath, 'dependencies.yaml'))
+    tasks, fingerprints, fingerprintStore = getChangedTasks(tasks, graph)
+    progress.begin(tasks.keys())
+    if prepullTimeout > 0:
+        prepull.start(lambda: prepullImages(list(tasks.keys())))
+    # Each playbook is recorded as soon as it finishes, an interrupted run resumes from the others
+    fingerprintStore.begin(tasks.keys())
+    scheduler = taskScheduler.TaskScheduler(
+        tasks, graph, concurrency, notify=notifyInfo,
+        record=lambda name, rc: fingerprintStore.record(name, fingerprints[name], rc),
+        admit=admission.admit)
+
+    applied = {'spec': spec, 'complete': True}
+
+    def specChanged(newSpec, digest):
+        if digest == applied['spec']:
+            return
+        covered = restartChangedTasks(scheduler, graph, fingerprints, newSpec)
+        if covered is not None:
+            applied['spec'] = digest
+            applied['complete'] = applied['complete'] and covered
+
+    specWatch.attach(specChanged)
+    specWatch.start()
 
-def getResultInfo():
-    # Execute and add the installation task process
-    taskProcessList = []
-    tasks = generateTaskLists()
-    for taskName, taskObject in tasks.items():
-        taskProcess = {}
-        infoGetter.info = "Start installing {}".format(taskName)
-        taskProcess[taskName] = taskObject.installRunner()
-        taskProcessList.append(
-            taskProcess
-        )
-
-    taskProcessListLen = len(taskProcessList)
     logging.info('*' * 50)
     logging.info('Waiting for all tasks to be completed ...')
-    completedTasks = []
-    while True:
-        for taskProcess in taskProcessList:
-            taskName = list(taskProcess.keys())[0]
-            result = taskProcess[taskName].rc
-            if result is not None and {taskName: result} not in completedTasks:
-                infoGetter.info = "task {} status is {}  ({}/{})".format(
-                    taskName,
-                    taskProcess[taskName].status,
-                    len(completedTasks) + 1,
-                    len(taskProcessList)
-                )
-                completedTasks.append({taskName: result})
-
-        if len(completedTasks) == taskProcessListLen:
-            break
+    try:
+        completedTasks = scheduler.run()
+    finally:
+        specWatch.detach(specChanged)
+        prepull.stop()
+    progress.end(completedTasks)
+
     logging.info('*' * 50)
     logging.info('Collecting installation results ...')
 
     # Operation result check
     resultState = False
-    for taskResult in completedTasks:
-        taskName = list(taskResult.keys())[0]
-        taskRC = list(taskResult.values())[0]
-
-        if taskRC != 0:
+    for taskName, taskRC in completedTasks.items():
+        if taskRC == -1:
+            resultState = True
+            print("Task '{}' skipped because a prerequisite failed".format(taskName))
+        elif taskRC != 0:
             resultState = resultState or True
-            resultInfoPath = os.path.join(
-                privateDataDir,
-                str(taskName),
-                str(taskName),
-                'job_events'
-            )
-            if os.path.exists(resultInfoPath):
-                jobList = os.listdir(resultInfoPath)
-                jobList.sort(
-                    key=lambda x: int(x.split('-')[0])
-                )
-
-                errorEventFile = os.path.join(resultInfoPath, jobList[-2])
-                with open(errorEventFile, 'r') as f:
-                    failedEvent = json.load(f)
-                print("\n")
-                print("Task '{}' failed:".format(taskName))
-                print('*' * 150)
-                print(json.dumps(failedEvent, sort_keys=True, indent=2))
-                print('*' * 150)
-    return resultState
+            print("\n")
+            print("Task '{}' failed:".format(taskName))
+            print('*' * 150)
+            print(runnerEvents.failureSummary(jobEventLog.failures(taskName)) or
+                  "No failed task was reported, check the output in {}".format(
+                      os.path.join(privateDataDir, taskName, taskName, 'stdout')))
+            print('*' * 150)
+
+    for taskName, taskRC in completedTasks.items():
+        if taskRC != 0 and graph.required(taskName):
+            exit()
+    return resultState, applied['spec'] if applied['complete'] else None
+
+
+# Restart the tasks of the run whose inputs changed with a spec seen during it,
+# together with their dependents, while the other tasks go on. Returns whether
+# the run then covers the whole spec, None when the run was already over.
+
+
+def restartChangedTasks(scheduler, graph, fingerprints, spec):
+    with open(configFile, 'r') as f:
+        current = json.load(f)
+    config = dict(spec)
+    config['nodeNum'] = current.get('nodeNum')
+    config['kubernetes_version'] = current.get('kubernetes_version')
+
+    latest = specFingerprints(fingerprints.keys(), graph, config)
+    changed = set(name for name in latest if latest[name] != fingerprints.get(name))
+    # Components enabled or disabled by the change, and changed tasks which
+    # are not part of this run, are left to the next reconcile
+    enabledBefore = set(getComponentLists(current)[0])
+    enabledAfter = set(getComponentLists(config)[0])
+    restart = set(name for name in changed
+                  if name in scheduler.tasks and name not in enabledBefore - enabledAfter)
+    covered = restart == changed and enabledBefore == enabledAfter
+    restart = graph.affected(restart, scheduler.tasks.keys())
+
+    def writeConfig():
+        tmpFile = configFile + '.tmp'
+        with open(tmpFile, 'w', encoding='utf-8') as f:
+            json.dump(config, f, ensure_ascii=False, indent=4)
+        os.replace(tmpFile, configFile)
+        fingerprints.update(latest)
+
+    if not scheduler.restart(restart, before=writeConfig):
+        return None
+    if restart:
+        logging.info("The configuration changed, restarting: {}".format(', '.join(sorted(restart))))
+    return covered
+
+
+# Only keep the tasks whose inputs changed since their last successful run,
+# together with the tasks depending on changed playbook or role files
+
+
+def getChangedTasks(tasks, graph):
+    with open(configFile, 'r') as f:
+        spec = json.load(f)
+
+    fingerprints = specFingerprints(tasks.keys(), graph, spec)
+    fingerprintStore = reconcileState.FingerprintStore(fingerprintFile, checkpointConfigMap)
+    configChanged, codeChanged = fingerprintStore.changed(fingerprints)
+    selected = configChanged | graph.affected(codeChanged, tasks.keys())
+
+    unchanged = [taskName for taskName in tasks if taskName not in selected]
+    if unchanged:
+        logging.info("Skipping unchanged tasks: {}".format(', '.join(unchanged)))
+
+    changedTasks = collections.OrderedDict()
+    for taskName, taskObject in tasks.items():
+        if taskName in selected:
+            changedTasks[taskName] = taskObject
+    return changedTasks, fingerprints, fingerprintStore
+
+
+def specFingerprints(names, graph, spec):
+    rolesPaths = os.environ.get(
+        'ANSIBLE_ROLES_PATH',
+        os.path.join(os.path.dirname(playbookBasePath), 'roles')
+    ).split(':')
+
+    return reconcileState.fingerprints(
+        names,
+        graph,
+        spec,
+        reconcileState.RoleFingerprint(playbookBasePath, rolesPaths)
+    )
+
+
+# The images of the playbooks and the image of the pre-pull helper, rendered
+# with the extra vars of the playbooks like the offline images list
+
+
+def prepullImages(playbooks):
+    variables = {}
+    extravars = os.path.join(privateDataDir, 'env', 'extravars')
+    if os.path.exists(extravars):
+        import yaml
+        with open(extravars, 'r') as f:
+            variables.update(yaml.safe_load(f) or {})
+    with open(configFile, 'r') as f:
+        variables.update(json.load(f))
+
+    images = imagePrepull.renderImages(imagesFile, variables)
+    if imagePrepull.helperImage not in images:
+        raise ValueError("the image of the pre-pull helper, {}, does not render".format(imagePrepull.helperImage))
+    return imagePrepull.playbookImageList(playbooks, images), images[imagePrepull.helperImage]
 
 
 # Generate a objects list of components
@@ -251,28 +526,32 @@ def getResultInfo():
 
 def generateTaskLists():
     readyToEnabledList, readyToDisableList = getComponentLists()
-    tasksDict = {}
+    tasksDict = collections.OrderedDict()
     for taskName in readyToEnabledList:
-        playbookPath = os.path.join(playbookBasePath, str(taskName) + '.yaml')
-        artifactDir = os.path.join(privateDataDir, str(taskName))
-        if os.path.exists(artifactDir):
-            shutil.rmtree(artifactDir)
-
-        tasksDict[str(taskName)] = component(
-            playbook=playbookPath,
-            private_data_dir=privateDataDir,
-            artifact_dir=artifactDir,
-            ident=str(taskName),
-            quiet=True,
-            rotate_artifacts=1
-        )
+        tasksDict[str(taskName)] = generateTask(str(taskName), quiet=True)
 
     return tasksDict
 
+
+def generateTask(taskName, quiet):
+    playbookPath = os.path.join(playbookBasePath, taskName + '.yaml')
+    artifactDir = os.path.join(privateDataDir, taskName)
+
+    return component(
+        playbook=playbookPath,
+        private_data_dir=privateDataDir,
+        artifact_dir=artifactDir,
+        ident=taskName,
+        quiet=quiet,
+        rotate_artifacts=1,
+        event_handler=eventStream.handler(taskName),
+        status_handler=eventStream.statusHandler(taskName)
+    )
+
 # Generate a list of components to install based on the configuration file
 
 
-def getComponentLists():
+def getComponentLists(configs=None):
     readyToEnabledList = [
         'monitoring',
         'multicluster',
@@ -281,13 +560,12 @@ def getComponentLists():
     readyToDisableList = []
     global configFile
 
-    if os.path.exists(configFile):
+    if configs is None:
+        if not os.path.exists(configFile):
+            print("The configuration file does not exist !  {}".format(configFile))
+            exit()
         with open(configFile, 'r') as f:
             configs = json.load(f)
-        f.close()
-    else:
-        print("The configuration file does not exist !  {}".format(configFile))
-        exit()
 
     for component, parameters in configs.items():
         if (not isinstance(parameters, str)) or (
@@ -320,44 +598,30 @@ def getComponentLists():
     return readyToEnabledList, readyToDisableList
 
 
+# The pre-install playbooks are scheduled together with the components,
+# their order is declared in playbooks/dependencies.yaml
+
+
 def preInstallTasks():
     preInstallTasks = collections.OrderedDict()
-    preInstallTasks['preInstall'] = [
-        os.path.join(playbookBasePath, 'preinstall.yaml'),
-        os.path.join(privateDataDir, 'preinstall')
-    ]
-    preInstallTasks['metrics-server'] = [
-        os.path.join(playbookBasePath, 'metrics_server.yaml'),
-        os.path.join(privateDataDir, 'metrics_server')
-    ]
-    preInstallTasks['common'] = [
-        os.path.join(playbookBasePath, 'common.yaml'),
-        os.path.join(privateDataDir, 'common')
-    ]
-    preInstallTasks['ks-core'] = [
-        os.path.join(playbookBasePath, 'ks-core.yaml'),
-        os.path.join(privateDataDir, 'ks-core')
-    ]
-
-    for task, paths in preInstallTasks.items():
-        pretask = ansible_runner.run(
-            playbook=paths[0],
-            private_data_dir=privateDataDir,
-            artifact_dir=paths[1],
-            ident=str(task),
-            quiet=False
-        )
-        if pretask.rc != 0:
-            exit()
+    for taskName in ['preinstall', 'metrics_server', 'common', 'ks-core']:
+        preInstallTasks[taskName] = generateTask(taskName, quiet=False)
+
+    return preInstallTasks
 
 
 def resultInfo(resultState=False, api=None):
+    import ansible_runner
+
     ks_config = ansible_runner.run(
         playbook=os.path.join(playbookBasePath, 'ks-config.yaml'),
         private_data_dir=privateDataDir,
         artifact_dir=os.path.join(privateDataDir, 'ks-config'),
+        envvars=runnerEnvvars(os.path.join(privateDataDir, 'ks-config')),
         ident='ks-config',
-        quiet=True
+        quiet=True,
+        event_handler=eventStream.handler('ks-config'),
+        status_handler=eventStream.statusHandler('ks-config')
     )
 
     if ks_config.rc != 0:
@@ -368,14 +632,18 @@ def resultInfo(resultState=False, api=None):
         playbook=os.path.join(playbookBasePath, 'result-info.yaml'),
         private_data_dir=privateDataDir,
         artifact_dir=os.path.join(privateDataDir, 'result-info'),
+        envvars=runnerEnvvars(os.path.join(privateDataDir, 'result-info')),
         ident='result',
-        quiet=True
+        quiet=True,
+        event_handler=eventStream.handler('result-info'),
+        status_handler=eventStream.statusHandler('result-info')
     )
 
     if result.rc != 0:
         print("Failed to ansible-playbook result-info.yaml")
         exit()
 
+    statusWriter.flush()
     resource = get_cluster_configuration(api)
 
     if "migration" in resource['status']['core'] and resource['status']['core']['migration'] and resultState == False:
@@ -383,8 +651,11 @@ def resultInfo(resultState=False, api=None):
             playbook=os.path.join(playbookBasePath, 'ks-migration.yaml'),
             private_data_dir=privateDataDir,
             artifact_dir=os.path.join(privateDataDir, 'ks-migration'),
+            envvars=runnerEnvvars(os.path.join(privateDataDir, 'ks-migration')),
             ident='ks-migration',
-            quiet=False
+            quiet=False,
+            event_handler=eventStream.handler('ks-migration'),
+            status_handler=eventStream.statusHandler('ks-migration')
         )
         if migration.rc != 0:
             exit()
@@ -394,12 +665,16 @@ def resultInfo(resultState=False, api=None):
             info = f.read()
             logging.info(info)
 
+    statusWriter.flush()
     telemeter = ansible_runner.run(
         playbook=os.path.join(playbookBasePath, 'telemetry.yaml'),
         private_data_dir=privateDataDir,
         artifact_dir=os.path.join(privateDataDir, 'telemetry'),
+        envvars=runnerEnvvars(os.path.join(privateDataDir, 'telemetry')),
         ident='telemetry',
-        quiet=True
+        quiet=True,
+        event_handler=eventStream.handler('telemetry'),
+        status_handler=eventStream.statusHandler('telemetry')
     )
 
     if telemeter.rc != 0:
@@ -411,14 +686,14 @@ def generateConfig(api):
     resource = get_cluster_configuration(api)
 
     cluster_config = resource['spec']
+    spec = reconcileState.digest(cluster_config)
 
-    api = client.CoreV1Api()
-    nodes = api.list_node(_preload_content=False)
-    nodesStr = nodes.read().decode('utf-8')
-    nodesObj = json.loads(nodesStr)
+    facts = clusterFacts.collect(nodePageSize)
 
-    cluster_config['nodeNum'] = len(nodesObj["items"])
-    cluster_config['kubernetes_version'] = client.VersionApi().get_code().git_version
+    cluster_config['nodeNum'] = facts['node_num']
+    cluster_config['kubernetes_version'] = facts['kubernetes_version']
+
+    clusterFacts.write(factsFile, facts)
 
     try:
         with open(configFile, 'w', encoding='utf-8') as f:
@@ -427,243 +702,184 @@ def generateConfig(api):
         with open(configFile, 'w', encoding='utf-8') as f:
             json.dump({"config": "new"}, f, ensure_ascii=False, indent=4)
 
-    try:
-        with open(statusFile, 'w', encoding='utf-8') as f:
-            json.dump({"status": resource['status']},
-                      f, ensure_ascii=False, indent=4)
-    except BaseException:
-        with open(statusFile, 'w', encoding='utf-8') as f:
-            json.dump({"status": {"enabledComponents": []}},
-                      f, ensure_ascii=False, indent=4)
+    statusWriter.reset(resource.get('status') or {"enabledComponents": []})
+    return spec
 
 # Migrate cluster configuration
 
 
 def generate_new_cluster_configuration(api):
-    global old_cluster_configuration
-    upgrade_flag = False
     try:
         old_cluster_configuration = get_cluster_configuration(api)
     except BaseException:
         exit(0)
 
-    cluster_configuration_spec = old_cluster_configuration.get('spec')
-    cluster_configuration_status = old_cluster_configuration.get('status')
-
-    if "common" in cluster_configuration_spec:
-        if "mysqlVolumeSize" in cluster_configuration_spec["common"]:
-            del cluster_configuration_spec["common"]["mysqlVolumeSize"]
-        if "etcdVolumeSize" in cluster_configuration_spec["common"]:
-            del cluster_configuration_spec["common"]["etcdVolumeSize"]
-        if cluster_configuration_status is not None and "redis" in cluster_configuration_status and "status" in cluster_configuration_status[
-                "redis"] and cluster_configuration_status["redis"]["status"] == "enabled":
-            cluster_configuration_spec["common"]["redis"] = {
-                "enabled": True
-            }
-        else:
-            cluster_configuration_spec["common"]["redis"] = {
-                "enabled": False
-            }
-
-        if cluster_configuration_status is not None and "openldap" in cluster_configuration_status and "status" in cluster_configuration_status[
-                "openldap"] and cluster_configuration_status["openldap"]["status"] == "enabled":
-            cluster_configuration_spec["common"]["openldap"] = {
-                "enabled": True
-            }
-        else:
-            cluster_configuration_spec["common"]["openldap"] = {
-                "enabled": False
-            }
-
-        if "redisVolumSize" in cluster_configuration_spec["common"]:
-            cluster_configuration_spec["common"]["redis"][
-                "volumeSize"] = cluster_configuration_spec["common"]["redisVolumSize"]
-            del cluster_configuration_spec["common"]["redisVolumSize"]
-        if "openldapVolumeSize" in cluster_configuration_spec["common"]:
-            cluster_configuration_spec["common"]["openldap"][
-                "volumeSize"] = cluster_configuration_spec["common"]["openldapVolumeSize"]
-            del cluster_configuration_spec["common"]["openldapVolumeSize"]
-        if "minio" not in cluster_configuration_spec["common"]:
-            if "minioVolumeSize" in cluster_configuration_spec["common"]:
-                cluster_configuration_spec["common"]["minio"] = {
-                    "volumeSize": cluster_configuration_spec["common"]["minioVolumeSize"]
-                }
-                del cluster_configuration_spec["common"]["minioVolumeSize"]
-        else:
-            if "minioVolumeSize" in cluster_configuration_spec["common"]:
-                cluster_configuration_spec["common"]["minio"]["volumeSize"] = cluster_configuration_spec["common"]["minioVolumeSize"]
-                del cluster_configuration_spec["common"]["minioVolumeSize"]
-
-        # Migrate the configuration of es elasticsearch
-        if "es" in cluster_configuration_spec["common"]:
-            if "master" not in cluster_configuration_spec["common"]["es"]:
-                cluster_configuration_spec["common"]["es"]["master"] = {
-                    "volumeSize": "4Gi"
-                }
-            if "data" not in cluster_configuration_spec["common"]["es"]:
-                cluster_configuration_spec["common"]["es"]["data"] = {
-                    "volumeSize": "20Gi"
-                }
-            if "elasticsearchMasterReplicas" in cluster_configuration_spec["common"]["es"]:
-                cluster_configuration_spec["common"]["es"]["master"]["replicas"] = cluster_configuration_spec["common"]["es"]["elasticsearchMasterReplicas"]
-                del cluster_configuration_spec["common"]["es"]["elasticsearchMasterReplicas"]
-            if "elasticsearchDataReplicas" in cluster_configuration_spec["common"]["es"]:
-                cluster_configuration_spec["common"]["es"]["data"]["replicas"] = cluster_configuration_spec["common"]["es"]["elasticsearchDataReplicas"]
-                del cluster_configuration_spec["common"]["es"]["elasticsearchDataReplicas"]
-            if "elasticsearchMasterVolumeSize" in cluster_configuration_spec["common"]["es"]:
-                cluster_configuration_spec["common"]["es"]["master"]["volumeSize"] = cluster_configuration_spec["common"]["es"]["elasticsearchMasterVolumeSize"]
-                del cluster_configuration_spec["common"]["es"]["elasticsearchMasterVolumeSize"]
-            if "elasticsearchDataVolumeSize" in cluster_configuration_spec["common"]["es"]:
-                cluster_configuration_spec["common"]["es"]["data"]["volumeSize"] = cluster_configuration_spec["common"]["es"]["elasticsearchDataVolumeSize"]
-                del cluster_configuration_spec["common"]["es"]["elasticsearchDataVolumeSize"]
-            if "externalElasticsearchHost" not in cluster_configuration_spec["common"]["es"] and "externalElasticsearchUrl" in cluster_configuration_spec["common"]["es"]:
-                cluster_configuration_spec["common"]["es"]["externalElasticsearchHost"] = cluster_configuration_spec["common"]["es"]["externalElasticsearchUrl"]
-
-        if "console" in cluster_configuration_spec:
-            if "core" in cluster_configuration_spec["common"]:
-                cluster_configuration_spec["common"]["core"]["console"]=cluster_configuration_spec["console"]
-            else:
-                cluster_configuration_spec["common"]["core"] = {
-                    "console": cluster_configuration_spec["console"]
-                }
-            del cluster_configuration_spec["console"]
-
-    if "logging" in cluster_configuration_spec and "logsidecarReplicas" in cluster_configuration_spec[
-            "logging"]:
-        upgrade_flag = True
-        if "enabled" in cluster_configuration_spec["logging"]:
-            if cluster_configuration_spec["logging"]["enabled"]:
-                cluster_configuration_spec["logging"] = {
-                    "enabled": True,
-                    "logsidecar": {
-                        "enabled": True,
-                        "replicas": 2
-                    }
-                }
-            else:
-                cluster_configuration_spec["logging"] = {
-                    "enabled": False,
-                    "logsidecar": {
-                        "enabled": False,
-                        "replicas": 2
-                    }
-                }
-
-    if "notification" in cluster_configuration_spec:
-        upgrade_flag = True
-        del cluster_configuration_spec['notification']
-
-    if "openpitrix" in cluster_configuration_spec and "store" not in cluster_configuration_spec[
-            "openpitrix"]:
-        upgrade_flag = True
-        if "enabled" in cluster_configuration_spec["openpitrix"]:
-            if cluster_configuration_spec["openpitrix"]["enabled"]:
-                cluster_configuration_spec["openpitrix"] = {
-                    "store": {
-                        "enabled": True
-                    }
-                }
-            else:
-                cluster_configuration_spec["openpitrix"] = {
-                    "store": {
-                        "enabled": False
-                    }
-                }
-
-    if "networkpolicy" in cluster_configuration_spec:
-        upgrade_flag = True
-        if "enabled" in cluster_configuration_spec[
-                "networkpolicy"] and cluster_configuration_spec["networkpolicy"]["enabled"]:
-            cluster_configuration_spec["network"] = {
-                "networkpolicy": {
-                    "enabled": True,
-                },
-                "ippool": {
-                    "type": "none",
-                },
-                "topology": {
-                    "type": "none",
-                },
-            }
-        else:
-            cluster_configuration_spec["network"] = {
-                "networkpolicy": {
-                    "enabled": False,
-                },
-                "ippool": {
-                    "type": "none",
-                },
-                "topology": {
-                    "type": "none",
-                },
-            }
-        del cluster_configuration_spec["networkpolicy"]
-
-    # add edgeruntime configuration migration
-    if "kubeedge" in cluster_configuration_spec:
-        upgrade_flag = True
-        if "enabled" in cluster_configuration_spec["kubeedge"]:
-            cluster_configuration_spec["edgeruntime"] = {
-                "enabled": cluster_configuration_spec["kubeedge"]["enabled"],
-                "kubeedge": cluster_configuration_spec["kubeedge"]
-            }
-
-            cluster_configuration_spec["edgeruntime"]["kubeedge"]["iptables-manager"] = {
-                "enabled": True,
-                "mode": "external"
-            }
+    # The migrated configuration is written back in place and the run goes on
+    # with it, instead of recreating the object and waiting for the next event
+    patch = configMigrations.migrate(
+        old_cluster_configuration, cluster_configuration["metadata"]["labels"]["version"])
+    if patch is not None:
+        patch_cluster_configuration(api, patch)
+        logging.info("Migrate cluster configuration successfully")
+
+
+# Reconcile the cluster configuration once, returning the digest of the spec it ran with
+
+
+def reconcile(api):
+    generate_new_cluster_configuration(api)
+    spec = generateConfig(api)
+    # execute preInstall tasks and components
+    resultState, spec = getResultInfo(spec)
+    resultInfo(resultState, api)
+    return spec
+
+
+# Reconcile every cluster of the fleet once, each in a child process with its own state folder
+
+
+def reconcileFleet(source, debug):
+    clusters = clusterFleet.kubeconfigFiles(source) if source else clusterFleet.memberClusters()
+    members = []
+    for name, kubeconfig in clusters:
+        stateDir = os.path.join(fleetDir, name)
+        envDir = os.path.join(stateDir, 'env')
+        if not os.path.exists(envDir):
+            os.makedirs(envDir)
+        kubeconfigFile = os.path.join(stateDir, 'kubeconfig')
+        with open(os.open(kubeconfigFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            f.write(kubeconfig)
+        extravars = os.path.join(privateDataDir, 'env', 'extravars')
+        if os.path.exists(extravars):
+            shutil.copy(extravars, envDir)
+
+        env = dict(os.environ)
+        env.update({
+            'KUBECONFIG': kubeconfigFile,
+            'KS_INSTALLER_STATE_DIR': stateDir,
+            'KS_INSTALLER_METRICS_PORT': '0',
+            # The playbooks of every cluster run in the workers of this controller
+            'KS_INSTALLER_ANSIBLE_WORKERS': '0',
+        })
+        env.update(workerPool.envvars())
+        command = [sys.executable, os.path.abspath(__file__), '--member'] + (['--debug'] if debug else [])
+        members.append(clusterFleet.Member(name, command, env, stateDir, os.path.join(stateDir, 'ks-status.json')))
+
+    logging.info("Reconciling {} clusters, {} at a time".format(len(members), fleet.workers))
+    results = fleet.run(members)
+    failed = [name for name, rc in results.items() if rc != 0]
+    logging.info('*' * 50)
+    logging.info("{} of {} clusters reconciled{}".format(
+        len(results) - len(failed), len(results),
+        ', failed: {}'.format(', '.join(failed)) if failed else ''))
+    return 1 if failed else 0
 
-        try:
-            del cluster_configuration_spec["edgeruntime"]["kubeedge"]["edgeWatcher"]
-        except:
-            pass
-        
-        del cluster_configuration_spec["kubeedge"]
-
-    if isinstance(cluster_configuration_status,
-                  dict) and "core" in cluster_configuration_status:
-        if ("version" in cluster_configuration_status["core"] and cluster_configuration_status["core"]["version"] !=
-                cluster_configuration["metadata"]["labels"]["version"]) or "version" not in cluster_configuration_status["core"]:
-            upgrade_flag = True
-
-    if upgrade_flag:
-        cluster_configuration["spec"] = cluster_configuration_spec
-        if isinstance(cluster_configuration_status,
-                      dict) and "clusterId" in cluster_configuration_status:
-            cluster_configuration["status"] = {
-                "clusterId": cluster_configuration_status["clusterId"]
-            }
-        delete_cluster_configuration(api)
-        create_cluster_configuration(api, cluster_configuration)
-        exit(0)
+
+# Tear the components of the cluster down as planned in playbooks/teardown.yaml
+
+
+def uninstall(dryRun):
+    from kubernetes import client
+    from kubernetes.client.rest import ApiException
+
+    try:
+        clusterConfiguration = get_cluster_configuration(client.CustomObjectsApi())
+        components = ['common', 'ks-core'] + getComponentLists(clusterConfiguration.get('spec') or {})[0]
+        # Components disabled in the spec after they were installed are still enabled in the status
+        for name, value in (clusterConfiguration.get('status') or {}).items():
+            if isinstance(value, dict) and value.get('status') == 'enabled':
+                components.append(name)
+    except ApiException as e:
+        if e.status != 404:
+            raise
+        # Without the ClusterConfiguration, only the components with kubesphere-* namespaces left are torn down
+        components = None
+
+    graph = taskScheduler.TaskGraph.load(os.path.join(playbookBasePath, 'dependencies.yaml'))
+    plan = clusterTeardown.loadPlan(os.path.join(playbookBasePath, 'teardown.yaml'))
+    return clusterTeardown.Teardown(plan, graph, components, dryRun).run()
 
 
 def main():
-    global privateDataDir, playbookBasePath, configFile, statusFile
+    global playbookBasePath, fleetDir, imagesFile
 
+    # The hook discovery runs without importing the kubernetes client or ansible_runner
     if len(sys.argv) > 1 and sys.argv[1] == "--config":
         print(ks_hook)
         return
 
-    if len(sys.argv) > 1 and sys.argv[1] == "--debug":
-        privateDataDir = os.path.abspath('./results')
+    debug = "--debug" in sys.argv[1:]
+    daemon = "--daemon" in sys.argv[1:]
+    member = "--member" in sys.argv[1:]
+    fleetMode = "--fleet" in sys.argv[1:]
+    uninstallMode = "--uninstall" in sys.argv[1:]
+    if debug:
         playbookBasePath = os.path.abspath('./playbooks')
-        configFile = os.path.abspath('./results/ks-config.json')
-        statusFile = os.path.abspath('./results/ks-status.json')
+        fleetDir = os.path.abspath('./results/fleet')
+        imagesFile = os.path.abspath('./roles/download/defaults/main.yml')
+        useStateDir(os.path.abspath('./results'))
+    if member:
+        useStateDir(os.environ['KS_INSTALLER_STATE_DIR'])
+
+    # A hook invocation is served by the resident controller when one is running
+    if not daemon and not member and not fleetMode and not uninstallMode:
+        rc = reconcileDaemon.forward(daemonSocket)
+        if rc is not None:
+            sys.exit(rc)
+
+    from kubernetes import client, config
+    if debug or member or uninstallMode:
         config.load_kube_config()
     else:
         config.load_incluster_config()
 
+    # The teardown deletes the ks-installer Deployment, it runs outside of its pod
+    if uninstallMode:
+        sys.exit(uninstall("--dry-run" in sys.argv[1:]))
+
     if not os.path.exists(privateDataDir):
         os.makedirs(privateDataDir)
+    resetRunnerEnvFile()
+    if member:
+        writeRunnerCmdline()
+
+    # The workers of the fleet serve the playbooks of all clusters reconciled at the same time
+    if fleetMode and 'KS_INSTALLER_ANSIBLE_WORKERS' not in os.environ:
+        workerPool.size = ansibleWorkerCount * fleet.workers
+    workerPool.start(privateDataDir, os.path.join(playbookBasePath, 'preinstall.yaml'))
+    atexit.register(workerPool.stop)
+
+    if fleetMode:
+        index = sys.argv.index("--fleet")
+        source = sys.argv[index + 1] if index + 1 < len(sys.argv) and not sys.argv[index + 1].startswith('--') else None
+        installerMetrics.MetricsServer(metricsPort, {
+            '/fleet': lambda: ('application/json', json.dumps(fleet.snapshot(), indent=2))
+        }).start()
+        sys.exit(reconcileFleet(source, debug))
+
+    installerMetrics.MetricsServer(metricsPort, {
+        '/metrics': lambda: ('text/plain; version=0.0.4; charset=utf-8', metrics.expose()),
+        '/progress': lambda: ('application/json', json.dumps(progress.snapshot(), indent=2))
+    }, streams={
+        '/progress/events': lambda lastEventId: installProgress.serverSentEvents(progress, lastEventId)
+    }).start()
 
     api = client.CustomObjectsApi()
-    generate_new_cluster_configuration(api)
-    generateConfig(api)
-    # execute preInstall tasks
-    preInstallTasks()
-    resultState = getResultInfo()
-    resultInfo(resultState, api)
+    statusWriter.start(lambda patch: patch_cluster_configuration(api, patch))
+    atexit.register(statusWriter.stop)
+
+    if not daemon:
+        reconcile(api)
+        return
+
+    # Stop between two reconciles, or in the middle of one, with the exit handlers run
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    resident = reconcileDaemon.ReconcileDaemon(lambda: reconcile(api), daemonSocket, daemonWindow)
+    resident.watch(specWatch)
+    try:
+        resident.run()
+    except KeyboardInterrupt:
+        logging.info("Stopping the controller")
 
 
 if __name__ == '__main__':
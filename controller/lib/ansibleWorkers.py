@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+import atexit
+import gc
+import importlib
+import io
+import json
+import logging
+import os
+import random
+import runpy
+import select
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import traceback
+
+'''
+socketEnv: Environment variable telling the client which worker pool to hand the playbook to.
+pidFileEnv: Environment variable naming the file the client writes the process group running the playbook to.
+perRunEnv: Ansible settings that differ between the runs of one pool and are read again by every worker.
+warmEnv: Other settings a worker only runs a playbook with when they are the same as the pool's.
+warmModules: Modules imported once by the pool, before the workers are forked.
+reloadModules: Modules reading the environment or the terminal on import, imported again by every worker.
+'''
+socketEnv = 'KS_ANSIBLE_WORKERS_SOCKET'
+pidFileEnv = 'KS_ANSIBLE_PID_FILE'
+perRunEnv = ('ANSIBLE_CACHE_PLUGIN_CONNECTION',)
+warmEnv = ('HOME',)
+warmModules = [
+    'ansible.cli.playbook',
+    'ansible.executor.playbook_executor',
+    'ansible.executor.task_executor',
+    'ansible.executor.process.worker',
+    'ansible.inventory.manager',
+    'ansible.vars.manager',
+    'ansible.template',
+    'ansible.plugins.strategy.linear',
+    'ansible.plugins.connection.local',
+    'ansible.plugins.shell.sh',
+    'ansible.plugins.become.sudo',
+    'ansible.plugins.action.normal',
+    'ansible.plugins.action.command',
+    'ansible.plugins.action.copy',
+    'ansible.plugins.action.template',
+    'ansible.plugins.action.include_vars',
+    'ansible.plugins.action.set_fact',
+    'ansible.plugins.callback.default',
+    'ansible.plugins.inventory.ini',
+    'ansible.plugins.inventory.yaml',
+    'ansible.plugins.inventory.host_list',
+    'ansible.plugins.filter.core',
+    'ansible.plugins.test.core',
+    'ansible.plugins.lookup.file',
+]
+reloadModules = [
+    'ansible.constants',
+    'ansible.utils.color',
+    'ansible.utils.vars',
+]
+
+
+def ansiblePlaybook():
+    '''
+    The real ansible-playbook, skipping the link to this file the pool puts
+    first in the PATH of the runs.
+    '''
+    candidates = [os.path.dirname(sys.executable)] + os.environ.get('PATH', '').split(os.pathsep)
+    for directory in candidates:
+        path = os.path.join(directory, 'ansible-playbook')
+        if os.path.isfile(path) and os.access(path, os.X_OK) and \
+                os.path.realpath(path) != os.path.realpath(__file__):
+            return path
+    return None
+
+
+def isPythonScript(path):
+    try:
+        with open(path, 'rb') as f:
+            return b'python' in f.readline()
+    except OSError:
+        return False
+
+
+def settings(env):
+    return dict((key, value) for key, value in env.items()
+                if (key.startswith('ANSIBLE_') or key in warmEnv) and key not in perRunEnv)
+
+
+def sameConfig(cwd, warmCwd):
+    '''
+    Whether Ansible reads the same configuration in cwd as in the folder the
+    pool imported it in: another folder only matters with an ansible.cfg.
+    '''
+    if cwd == warmCwd:
+        return True
+    return not any(os.path.exists(os.path.join(path, 'ansible.cfg')) for path in (cwd, warmCwd))
+
+
+class WorkerPool():
+    '''
+    Keep size Ansible workers forked from a process that has already imported
+    Ansible, and let ansible_runner hand playbooks to them.
+
+    The runs find a link to this file first in their PATH and run it as
+    ansible-playbook. The client passes its arguments, environment, working directory and terminal to a
+    free worker, which runs ansible-playbook in-process on that terminal.
+    ansible_runner sees the same output, events and artifacts as from a new
+    ansible-playbook process. Every worker runs a single playbook and is then
+    replaced, so no Ansible state is shared between runs.
+    '''
+
+    def __init__(self, size):
+        '''
+        :param size: Number of idle workers kept, 0 disables the pool
+        '''
+        self.size = size
+        self.socketPath = None
+        self.process = None
+        self._dir = None
+
+    def start(self, privateDataDir, playbook, envvars=None):
+        '''
+        Start the pool with the environment ansible_runner prepares for a run,
+        playbooks run with other Ansible settings fall back to ansible-playbook.
+        :param privateDataDir: The private data dir of the runs
+        :param playbook: Any playbook of the runs
+        :param envvars: The envvars passed to the runs
+        '''
+        if self.size <= 0 or self.process is not None:
+            return
+        self._dir = tempfile.mkdtemp(prefix='ks-ansible-workers-')
+        try:
+            from ansible_runner.config.runner import RunnerConfig
+            runnerConfig = RunnerConfig(
+                private_data_dir=privateDataDir,
+                playbook=playbook,
+                artifact_dir=os.path.join(self._dir, 'artifacts'),
+                ident='workers',
+                envvars=envvars)
+            runnerConfig.prepare()
+            env = dict(runnerConfig.env)
+            cwd = runnerConfig.cwd
+        except Exception as e:
+            logging.info("Failed to prepare the Ansible worker pool: {}".format(e))
+            self.stop()
+            return
+
+        binDir = os.path.join(self._dir, 'bin')
+        os.makedirs(binDir)
+        os.symlink(os.path.abspath(__file__), os.path.join(binDir, 'ansible-playbook'))
+        self.socketPath = os.path.join(self._dir, 'workers.sock')
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--serve', self.socketPath, str(self.size)],
+            env=env, cwd=cwd,
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def envvars(self):
+        if self.process is None:
+            return {}
+        return {
+            'PATH': os.pathsep.join([os.path.join(self._dir, 'bin'), os.environ.get('PATH', '')]),
+            socketEnv: self.socketPath,
+        }
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            try:
+                self.process.wait(5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+        if self._dir is not None:
+            shutil.rmtree(self._dir, ignore_errors=True)
+            self._dir = None
+
+
+class Cold(Exception):
+    pass
+
+
+# The pool process, it forks the workers and replaces every worker that exits
+
+
+def serve(socketPath, size):
+    # Objects collected or moved between generations are written to, which
+    # copies their pages into every worker
+    gc.disable()
+    for name in warmModules:
+        try:
+            importlib.import_module(name)
+        except Exception:
+            pass
+    script = ansiblePlaybook()
+    if script is not None and not isPythonScript(script):
+        script = None
+    warm = (settings(os.environ), os.getcwd())
+
+    if os.path.exists(socketPath):
+        os.remove(socketPath)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socketPath)
+    os.chmod(socketPath, 0o600)
+    listener.listen(16)
+
+    wakeup, wake = os.pipe()
+    os.set_blocking(wake, False)
+    signal.set_wakeup_fd(wake)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.append(signum))
+
+    gc.collect()
+    gc.freeze()
+    parent = os.getppid()
+    workers = set()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    while not stopping and os.getppid() == parent:
+        while len(workers) < size:
+            pid = os.fork()
+            if pid == 0:
+                os.close(wakeup)
+                os.close(wake)
+                worker(listener, script, warm)
+            workers.add(pid)
+        select.select([wakeup], [], [], 1.0)
+        try:
+            os.read(wakeup, 512)
+        except BlockingIOError:
+            pass
+        while workers:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                workers.clear()
+                break
+            if pid == 0:
+                break
+            workers.discard(pid)
+
+    # Runs have ended when the controller stops the pool
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+    listener.close()
+    os.remove(socketPath)
+
+
+def worker(listener, script, warm):
+    signal.set_wakeup_fd(-1)
+    for signum in (signal.SIGCHLD, signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, signal.SIG_DFL)
+    # Inherited exit handlers belong to the pool, e.g. the removal of its Ansible tmp dir
+    atexit._clear()
+    gc.enable()
+    os.setpgrp()
+    rc = 255
+    try:
+        conn, _ = listener.accept()
+        listener.close()
+        rc = runPlaybook(conn, script, warm)
+    except Exception:
+        traceback.print_exc()
+    os._exit(rc)
+
+
+def runPlaybook(conn, script, warm):
+    _, fds, _, _ = socket.recv_fds(conn, 1, 3)
+    stream = conn.makefile('rb')
+    request = json.loads(stream.readline())
+
+    warmSettings, warmCwd = warm
+    if settings(request['env']) != warmSettings or not sameConfig(request['cwd'], warmCwd) or script is None:
+        for fd in fds:
+            os.close(fd)
+        conn.sendall(b'{"cold": true}\n')
+        return 0
+
+    for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+        os.close(fd)
+    os.chdir(request['cwd'])
+    os.environ.clear()
+    os.environ.update(request['env'])
+    sys.stdin = io.TextIOWrapper(io.FileIO(0, 'r', closefd=False))
+    sys.stdout = io.TextIOWrapper(io.FileIO(1, 'w', closefd=False), line_buffering=os.isatty(1))
+    sys.stderr = io.TextIOWrapper(io.FileIO(2, 'w', closefd=False), line_buffering=True)
+    random.seed()
+    for name in reloadModules:
+        if name in sys.modules:
+            importlib.reload(sys.modules[name])
+
+    conn.sendall(json.dumps({'pid': os.getpid()}).encode('utf-8') + b'\n')
+    # The client is killed together with its process group when the run is canceled
+    threading.Thread(target=watchClient, args=(conn,), daemon=True).start()
+
+    sys.argv = [script] + request['args']
+    try:
+        runpy.run_path(script, run_name='__main__')
+        rc = 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            rc = e.code or 0
+        else:
+            sys.stderr.write('{}\n'.format(e.code))
+            rc = 1
+    except BaseException:
+        traceback.print_exc()
+        rc = 1
+    atexit._run_exitfuncs()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    conn.sendall(json.dumps({'rc': rc}).encode('utf-8') + b'\n')
+    return rc
+
+
+def watchClient(conn):
+    try:
+        while conn.recv(64):
+            pass
+    except OSError:
+        pass
+    os.killpg(0, signal.SIGKILL)
+
+
+# The client, run by ansible_runner in place of ansible-playbook
+
+
+def request(socketPath, args):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socketPath)
+        socket.send_fds(conn, [b'\0'], [0, 1, 2])
+        conn.sendall(json.dumps({'args': args, 'env': dict(os.environ), 'cwd': os.getcwd()}).encode('utf-8') + b'\n')
+        stream = conn.makefile('rb')
+        reply = json.loads(stream.readline() or b'{"cold": true}')
+    except (OSError, ValueError):
+        conn.close()
+        raise Cold()
+    if 'pid' not in reply:
+        conn.close()
+        raise Cold()
+
+    pid = reply['pid']
+    writePidFile(pid)
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+        signal.signal(signum, lambda signum, frame: os.kill(pid, signum))
+    line = stream.readline()
+    if not line:
+        return 255
+    return json.loads(line)['rc']
+
+
+# The process group of a run is followed by the controller, e.g. to sample its memory
+
+
+def writePidFile(pgid):
+    path = os.environ.get(pidFileEnv)
+    if not path:
+        return
+    try:
+        with open(path, 'w') as f:
+            f.write(str(pgid))
+    except OSError:
+        pass
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--serve':
+        serve(sys.argv[2], int(sys.argv[3]))
+        return
+
+    socketPath = os.environ.get(socketEnv)
+    if socketPath:
+        try:
+            sys.exit(request(socketPath, sys.argv[1:]))
+        except Cold:
+            pass
+    script = ansiblePlaybook()
+    if script is None:
+        sys.stderr.write('ansible-playbook not found\n')
+        sys.exit(127)
+    writePidFile(os.getpgid(0))
+    os.execv(script, [script] + sys.argv[1:])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+# encoding: utf-8
+
+import argparse
+import json
+import os
+
+'''
+metadataAccept: Asks the API server for the metadata of the objects only.
+masterLabel: The label of the nodes counted in master_num, which sets enableHA. Nodes only labelled
+             node-role.kubernetes.io/control-plane, as on Kubernetes 1.24+, are not counted.
+edgeLabel: The label of the KubeEdge nodes.
+'''
+metadataAccept = 'application/json;as=PartialObjectMetadataList;g=meta.k8s.io;v=v1,application/json'
+masterLabel = 'node-role.kubernetes.io/master'
+edgeLabel = 'node-role.kubernetes.io/edge'
+
+
+def listNodeMetadata(pageSize):
+    '''
+    Yield the metadata of every node, one page of pageSize nodes at a time.
+    The default Accept header is used because the header argument of the
+    generated methods differs between client versions.
+    '''
+    from kubernetes import client
+
+    apiClient = client.ApiClient()
+    apiClient.set_default_header('Accept', metadataAccept)
+    api = client.CoreV1Api(apiClient)
+
+    token = None
+    while True:
+        kwargs = {'limit': pageSize, '_preload_content': False}
+        if token:
+            kwargs['_continue'] = token
+        page = json.loads(api.list_node(**kwargs).read().decode('utf-8'))
+        for item in page.get('items') or []:
+            yield item.get('metadata') or {}
+        token = (page.get('metadata') or {}).get('continue')
+        if not token:
+            break
+
+
+def nodeFacts(name):
+    '''
+    The facts the roles read from the status of a single node.
+    '''
+    from kubernetes import client
+
+    node = {}
+    if name is not None:
+        node = json.loads(client.CoreV1Api().read_node(name, _preload_content=False).read().decode('utf-8'))
+    status = node.get('status') or {}
+    addresses = status.get('addresses') or []
+    nodeInfo = status.get('nodeInfo') or {}
+    return {
+        'name': name or '',
+        'address': addresses[0]['address'] if addresses else '',
+        'internal_ip': next((address['address'] for address in addresses if address.get('type') == 'InternalIP'), ''),
+        'container_runtime_version': nodeInfo.get('containerRuntimeVersion', ''),
+        'kubelet_version': nodeInfo.get('kubeletVersion', ''),
+        'os_image': nodeInfo.get('osImage', ''),
+        'machine_id': nodeInfo.get('machineID', ''),
+    }
+
+
+def collect(pageSize=500):
+    '''
+    Gather the cluster facts used by the roles in a single pass over the
+    nodes. Only the first node and the first node that is not an edge node
+    are read in full, in the same order `kubectl get node` lists them.
+    '''
+    from kubernetes import client
+
+    nodeNum = masterNum = edgeNum = 0
+    firstNode = firstCloudNode = None
+    for metadata in listNodeMetadata(pageSize):
+        labels = metadata.get('labels') or {}
+        nodeNum += 1
+        if firstNode is None:
+            firstNode = metadata.get('name')
+        if masterLabel in labels:
+            masterNum += 1
+        if edgeLabel in labels:
+            edgeNum += 1
+        elif firstCloudNode is None:
+            firstCloudNode = metadata.get('name')
+
+    first = nodeFacts(firstNode)
+    return {
+        'node_num': nodeNum,
+        'master_num': masterNum,
+        'edge_node_num': edgeNum,
+        'kubernetes_version': client.VersionApi().get_code().git_version,
+        'first_node': first,
+        'first_cloud_node': first if firstCloudNode == firstNode else nodeFacts(firstCloudNode),
+    }
+
+
+def write(path, facts):
+    '''
+    Save the facts as the cluster_facts extra var of the playbooks.
+    '''
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({"cluster_facts": facts}, f, ensure_ascii=False, indent=4)
+
+
+def main():
+    from kubernetes import config
+
+    parser = argparse.ArgumentParser(description='Collect the cluster facts of the playbooks, e.g. for telemetry.')
+    parser.add_argument('--output', default='/kubesphere/config/ks-facts.json', help='the file the facts are saved to')
+    parser.add_argument('--page-size', type=int, default=int(os.environ.get('KS_INSTALLER_NODE_PAGE_SIZE', 500)),
+                        help='the number of nodes read per list call')
+    args = parser.parse_args()
+
+    try:
+        config.load_incluster_config()
+    except config.ConfigException:
+        config.load_kube_config()
+    write(args.output, collect(args.page_size))
+
+
+if __name__ == '__main__':
+    main()
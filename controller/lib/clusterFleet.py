@@ -0,0 +1,151 @@
+# encoding: utf-8
+
+import base64
+import collections
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+clusterResource: The group, version and plural of the KubeSphere Cluster objects of a host cluster.
+hostRoleLabel: Label of the Cluster object of the host cluster itself.
+'''
+clusterResource = ('cluster.kubesphere.io', 'v1alpha1', 'clusters')
+hostRoleLabel = 'cluster-role.kubesphere.io/host'
+
+
+def memberClusters():
+    '''
+    The name and kubeconfig of every member cluster joined to this host
+    cluster with a direct connection. Members joined through the proxy have
+    no kubeconfig the controller can use.
+    '''
+    from kubernetes import client
+
+    group, version, plural = clusterResource
+    items = client.CustomObjectsApi().list_cluster_custom_object(group, version, plural).get('items') or []
+    members = []
+    for item in items:
+        name = item['metadata']['name']
+        if hostRoleLabel in (item['metadata'].get('labels') or {}):
+            continue
+        connection = (item.get('spec') or {}).get('connection') or {}
+        if connection.get('type', 'direct') != 'direct' or not connection.get('kubeconfig'):
+            logging.info("Skipping cluster {}: no direct connection with a kubeconfig".format(name))
+            continue
+        members.append((name, base64.b64decode(connection['kubeconfig']).decode('utf-8')))
+    return members
+
+
+def kubeconfigFiles(path):
+    '''
+    The name and kubeconfig of every file of a directory, named after the file.
+    '''
+    members = []
+    for fileName in sorted(os.listdir(path)):
+        filePath = os.path.join(path, fileName)
+        if fileName.startswith('.') or not os.path.isfile(filePath):
+            continue
+        with open(filePath, 'r') as f:
+            members.append((os.path.splitext(fileName)[0], f.read()))
+    return members
+
+
+class Member():
+
+    def __init__(self, name, command, env, stateDir, statusFile):
+        '''
+        :param command: The command reconciling the cluster once
+        :param env: The environment of the command, e.g. its KUBECONFIG
+        :param stateDir: The folder holding the state of the cluster and the log of its reconcile
+        :param statusFile: The status file the reconcile writes its progress to
+        '''
+        self.name = name
+        self.command = command
+        self.env = env
+        self.stateDir = stateDir
+        self.statusFile = statusFile
+        self.state = 'pending'
+        self.rc = None
+        self.start = None
+        self.end = None
+
+    def progress(self):
+        try:
+            with open(self.statusFile, 'r') as f:
+                return (json.load(f).get('status') or {}).get('progress')
+        except (IOError, ValueError):
+            return None
+
+    def describe(self):
+        now = self.end or time.time()
+        return collections.OrderedDict([
+            ('cluster', self.name),
+            ('state', self.state),
+            ('rc', self.rc),
+            ('elapsed', round(now - self.start, 1) if self.start is not None else 0.0),
+            ('progress', self.progress() if self.start is not None else None),
+            ('log', os.path.join(self.stateDir, 'controller.log')),
+        ])
+
+
+class Fleet():
+    '''
+    Reconcile many clusters from one controller, at most workers of them at
+    the same time. Every reconcile runs the controller for a single cluster in
+    a child process with its own state folder, so the clusters share no files
+    but share the Ansible worker pool and the playbooks of the controller.
+    '''
+
+    def __init__(self, workers):
+        '''
+        :param workers: Number of clusters reconciled at the same time
+        '''
+        self.workers = max(1, int(workers))
+        self.members = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def run(self, members):
+        '''
+        Reconcile every member once and return a mapping of cluster name to return code.
+        '''
+        for member in members:
+            self.members[member.name] = member
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for member in members:
+                executor.submit(self._reconcile, member)
+        return {member.name: member.rc for member in members}
+
+    def snapshot(self):
+        with self._lock:
+            members = list(self.members.values())
+        states = collections.Counter(member.state for member in members)
+        return collections.OrderedDict([
+            ('summary', collections.OrderedDict(
+                [('total', len(members))] + sorted(states.items()))),
+            ('clusters', [member.describe() for member in members]),
+        ])
+
+    def _reconcile(self, member):
+        with self._lock:
+            member.state = 'running'
+            member.start = time.time()
+        logging.info("Reconciling cluster {} ...".format(member.name))
+        try:
+            with open(os.path.join(member.stateDir, 'controller.log'), 'ab') as log:
+                rc = subprocess.call(member.command, env=member.env, stdin=subprocess.DEVNULL,
+                                     stdout=log, stderr=subprocess.STDOUT)
+        except OSError as e:
+            logging.info("Failed to reconcile cluster {}: {}".format(member.name, e))
+            rc = 1
+        with self._lock:
+            member.rc = rc
+            member.end = time.time()
+            member.state = 'succeeded' if rc == 0 else 'failed'
+        logging.info("Cluster {} {} in {:.0f}s{}".format(
+            member.name, member.state, member.end - member.start,
+            '' if rc == 0 else ', see {}'.format(os.path.join(member.stateDir, 'controller.log'))))
@@ -0,0 +1,150 @@
+# encoding: utf-8
+
+import copy
+import json
+import logging
+import os
+import threading
+import time
+
+'''
+resultKey: Key of the task results of kubesphere_status holding the reported status change.
+'''
+resultKey = 'ks_status'
+
+
+def mergePatch(target, patch):
+    '''
+    Apply a JSON merge patch to target in place, a None value removes the key.
+    '''
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict):
+            if not isinstance(target.get(key), dict):
+                target[key] = {}
+            mergePatch(target[key], value)
+        else:
+            target[key] = copy.deepcopy(value)
+    return target
+
+
+def combinePatches(first, second):
+    '''
+    Merge second into the merge patch first in place, so that first then
+    patches like first followed by second. The None values are kept.
+    '''
+    for key, value in second.items():
+        if isinstance(value, dict) and isinstance(first.get(key), dict):
+            combinePatches(first[key], value)
+        else:
+            first[key] = copy.deepcopy(value)
+    return first
+
+
+class StatusWriter():
+    '''
+    Write the status of the ks-installer ClusterConfiguration for all runs.
+    The playbooks report status changes with the kubesphere_status action,
+    which this handler reads from the runner events. Each change is applied
+    to the status file right away, so the playbooks started later read it,
+    and the changes are merged into a single patch of the ClusterConfiguration
+    sent interval seconds after the first of them. A failed patch is sent
+    again with the next changes.
+    '''
+
+    def __init__(self, path, interval=3):
+        '''
+        :param path: The status file, passed to every run as extra vars
+        :param interval: Seconds the changes are collected for before they are written
+        '''
+        self.path = path
+        self.interval = interval
+        self.current = {}
+        self._patch = None
+        self._pending = {}
+        self._due = None
+        self._lock = threading.Lock()
+        self._flushLock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._thread = None
+        self._stopping = False
+
+    def start(self, patch):
+        '''
+        :param patch: Called with a merge patch of the ClusterConfiguration
+        '''
+        self._patch = patch
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def reset(self, status):
+        '''
+        Start from the status read from the ClusterConfiguration.
+        '''
+        with self._lock:
+            self.current = copy.deepcopy(status)
+            mergePatch(self.current, self._pending)
+            self._save()
+
+    def update(self, change):
+        with self._lock:
+            mergePatch(self.current, change)
+            combinePatches(self._pending, change)
+            if self._due is None:
+                self._due = time.time() + self.interval
+            self._save()
+            self._changed.notify()
+
+    def handle(self, taskName, event):
+        if event.get('event') != 'runner_on_ok':
+            return True
+        res = (event.get('event_data') or {}).get('res') or {}
+        change = res.get(resultKey)
+        if isinstance(change, dict) and change:
+            self.update(change)
+        return True
+
+    def flush(self):
+        '''
+        Write the pending changes now, e.g. before the ClusterConfiguration is read.
+        '''
+        with self._flushLock:
+            with self._lock:
+                pending, self._pending, self._due = self._pending, {}, None
+            if not pending or self._patch is None:
+                return
+            try:
+                self._patch({'status': pending})
+                logging.info("Updated the status of {}".format(', '.join(sorted(pending))))
+            except Exception as e:
+                logging.info("Failed to update the status, retrying in {}s: {}".format(self.interval, e))
+                with self._lock:
+                    self._pending = combinePatches(pending, self._pending)
+                    self._due = time.time() + self.interval
+                    self._changed.notify()
+
+    def stop(self):
+        with self._lock:
+            self._stopping = True
+            self._changed.notify()
+        self.flush()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._stopping and (self._due is None or self._due > time.time()):
+                    self._changed.wait(None if self._due is None else self._due - time.time())
+                if self._stopping:
+                    return
+            self.flush()
+
+    def _save(self):
+        tmpFile = self.path + '.tmp'
+        try:
+            with open(tmpFile, 'w', encoding='utf-8') as f:
+                json.dump({"status": self.current}, f, ensure_ascii=False, indent=4)
+            os.replace(tmpFile, self.path)
+        except (IOError, OSError) as e:
+            logging.info("Failed to save the status: {}".format(e))
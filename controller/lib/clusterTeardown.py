@@ -0,0 +1,450 @@
+# encoding: utf-8
+
+import logging
+import re
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import yaml
+
+'''
+installerDeployment: The namespace and name of the ks-installer Deployment, deleted first so no reconcile installs the components again.
+finalizerGroups: Suffixes of the API groups whose objects left in a terminating namespace have their finalizers cleared,
+                 the controllers handling them are torn down with the components.
+stuckAfter: Seconds a namespace is terminating before the finalizers of the objects it waits for are cleared.
+namespaceTimeout: Seconds a namespace is waited for at most.
+helmTimeout: Seconds a helm command may take.
+ownedPrefix: The prefix of the namespaces only KubeSphere creates, their components are torn down while they exist.
+'''
+installerDeployment = ('kubesphere-system', 'ks-installer')
+finalizerGroups = ('kubesphere.io', 'kubefed.io', 'kiali.io', 'jaegertracing.io', 'gatekeeper.sh', 'kubeedge.io')
+stuckAfter = 30
+namespaceTimeout = 600
+helmTimeout = 300
+ownedPrefix = 'kubesphere-'
+
+remainingPattern = re.compile(r'([a-z0-9.-]+) has \d+ resource instances')
+
+
+def loadPlan(path):
+    with open(path, 'r') as f:
+        return yaml.safe_load(f) or {}
+
+
+def ignoreMissing(call, *args):
+    '''
+    Call an API, e.g. a deletion, ignoring an object already gone.
+    '''
+    from kubernetes.client.rest import ApiException
+
+    try:
+        return call(*args)
+    except ApiException as e:
+        if e.status != 404:
+            raise
+        return None
+
+
+def matchesGroup(group, suffix):
+    return group == suffix or group.endswith('.' + suffix)
+
+
+class Step():
+
+    def __init__(self, name, after, action):
+        '''
+        :param after: Names of the steps this one waits for
+        :param action: Called without arguments to run the step
+        '''
+        self.name = name
+        self.after = after
+        self.action = action
+        self.state = 'pending'
+        self.start = None
+        self.end = None
+
+
+class Teardown():
+    '''
+    Uninstall the components in the reverse order of their installation: a
+    component is torn down once every component installed after it is, and
+    the others at the same time, as declared in the teardown plan. A
+    namespace is deleted once every component listing it is torn down, and
+    watched until it is gone instead of waited for a fixed time. The
+    finalizers of the objects it still waits for after stuckAfter seconds are
+    cleared. Components that are not enabled are only torn down while one of
+    their kubesphere-* namespaces exists. A failed step is logged and the
+    others go on, the run then returns 1. With dryRun, the objects are read but nothing is changed.
+    '''
+
+    def __init__(self, plan, graph, components=None, dryRun=False):
+        '''
+        :param plan: Mapping of component name to its teardown steps, see playbooks/teardown.yaml
+        :param graph: TaskGraph declaring the order the components are installed in
+        :param components: The components enabled in the spec or status, None when the ClusterConfiguration is gone
+        :param dryRun: Log the changes instead of making them
+        '''
+        self.plan = plan
+        self.graph = graph
+        self.components = components
+        self.dryRun = dryRun
+        self.steps = {}
+        self._crds = None
+        self._lock = threading.Lock()
+
+    def build(self):
+        '''
+        The steps of the teardown: one per component of the plan which is
+        enabled or has a kubesphere-* namespace left, and one per existing
+        namespace. A namespace outside kubesphere-* is only deleted when every
+        component listing it is enabled, it may hold the user's own install
+        of e.g. Istio or Argo CD.
+        '''
+        from kubernetes import client
+
+        enabled = set(self.components or [])
+        existing = set(ns.metadata.name for ns in client.CoreV1Api().list_namespace().items)
+        names = [name for name in self.plan
+                 if name in enabled or any(namespace in existing and namespace.startswith(ownedPrefix)
+                                           for namespace in self.plan[name].get('namespaces') or [])]
+        # Torn down after the components installed after them
+        _, dependents = self.graph.subgraph(names)
+
+        steps = {}
+        owners = {}
+        for name in names:
+            steps[name] = Step(name, dependents[name], lambda name=name: self._component(name, self.plan[name]))
+            for namespace in self.plan[name].get('namespaces') or []:
+                owners.setdefault(namespace, []).append(name)
+        for namespace, components in owners.items():
+            if namespace not in existing:
+                continue
+            if not namespace.startswith(ownedPrefix) and not enabled.issuperset(components):
+                logging.info("Keeping namespace {}, not every component listing it is enabled".format(namespace))
+                continue
+            step = 'namespace/' + namespace
+            steps[step] = Step(step, components, lambda namespace=namespace: self._namespace(namespace))
+        self.steps = steps
+        return steps
+
+    def run(self):
+        from kubernetes import client
+        from kubernetes.client.rest import ApiException
+
+        steps = self.build()
+        logging.info("{}Teardown plan of {} steps:".format('Dry run, ' if self.dryRun else '', len(steps)))
+        for step in steps.values():
+            logging.info("  {}{}".format(step.name, ', after {}'.format(', '.join(step.after)) if step.after else ''))
+
+        namespace, name = installerDeployment
+        apps = client.AppsV1Api()
+        try:
+            apps.read_namespaced_deployment(name, namespace)
+            self._change("delete deployment {}/{}".format(namespace, name),
+                         lambda: ignoreMissing(apps.delete_namespaced_deployment, name, namespace))
+        except ApiException as e:
+            if e.status != 404:
+                raise
+
+        started = time.time()
+        failed = []
+        pending = dict(steps)
+        futures = {}
+        # Every step whose prerequisites are done runs right away, most of them wait on the API server
+        with ThreadPoolExecutor(max_workers=len(steps) or 1) as executor:
+            while pending or futures:
+                for step in list(pending.values()):
+                    if all(steps[dep].state in ('done', 'failed') for dep in step.after):
+                        del pending[step.name]
+                        step.state = 'running'
+                        step.start = time.time()
+                        logging.info("Tearing down {} ...".format(step.name))
+                        futures[executor.submit(step.action)] = step
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    step = futures.pop(future)
+                    step.end = time.time()
+                    error = future.exception()
+                    step.state = 'failed' if error is not None else 'done'
+                    done = len([s for s in steps.values() if s.state in ('done', 'failed')])
+                    if error is not None:
+                        failed.append(step.name)
+                        logging.info("Failed to tear down {}: {}  ({}/{})".format(
+                            step.name, getattr(error, 'reason', None) or error, done, len(steps)))
+                    else:
+                        logging.info("{} torn down in {:.0f}s  ({}/{})".format(
+                            step.name, step.end - step.start, done, len(steps)))
+
+        logging.info('*' * 50)
+        logging.info("{} of {} steps {} in {:.0f}s{}".format(
+            len(steps) - len(failed), len(steps), 'planned' if self.dryRun else 'torn down', time.time() - started,
+            ', failed: {}'.format(', '.join(failed)) if failed else ''))
+        return 1 if failed else 0
+
+    def _change(self, description, change):
+        if self.dryRun:
+            logging.info("Would {}".format(description))
+            return None
+        logging.info(description[0].upper() + description[1:])
+        return change()
+
+    def _component(self, name, spec):
+        for webhook in spec.get('webhooks') or []:
+            self._deleteWebhook(webhook)
+        self._uninstall(spec.get('releases') or [])
+        if spec.get('detachNamespaces'):
+            self._detachNamespaces(spec['detachNamespaces'])
+        if spec.get('rbac'):
+            self._deleteRbac(spec['rbac'].get('selectors') or [], spec['rbac'].get('names') or [])
+        for resource in spec.get('finalizers') or []:
+            for crd in self._matchingCrds(lambda crd: crd['name'] == resource or crd['group'] == resource):
+                self._deleteObjects(crd)
+        for suffix in spec.get('crds') or []:
+            for crd in self._matchingCrds(lambda crd: matchesGroup(crd['group'], suffix)):
+                self._deleteCrd(crd)
+
+    def _deleteWebhook(self, name):
+        from kubernetes import client
+        from kubernetes.client.rest import ApiException
+
+        api = client.AdmissionregistrationV1Api()
+        for kind, read, delete in (
+                ('validating', api.read_validating_webhook_configuration, api.delete_validating_webhook_configuration),
+                ('mutating', api.read_mutating_webhook_configuration, api.delete_mutating_webhook_configuration)):
+            try:
+                read(name)
+                self._change("delete {} webhook configuration {}".format(kind, name), lambda: ignoreMissing(delete, name))
+            except ApiException as e:
+                if e.status != 404:
+                    raise
+
+    def _helm(self, *args):
+        binary = shutil.which('helm') or '/usr/local/bin/helm'
+        result = subprocess.run([binary] + list(args), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                timeout=helmTimeout, universal_newlines=True)
+        return result.returncode, result.stdout
+
+    def _uninstall(self, releases):
+        byNamespace = {}
+        for release in releases:
+            namespace, _, name = release.partition('/')
+            byNamespace.setdefault(namespace, []).append(name)
+
+        present = []
+        for namespace, names in byNamespace.items():
+            rc, output = self._helm('list', '-n', namespace, '-a', '-q')
+            if rc != 0:
+                raise RuntimeError("helm list -n {} failed: {}".format(namespace, output.strip()))
+            installed = output.split()
+            present.extend((namespace, name) for name in installed if '*' in names or name in names)
+
+        def uninstall(namespace, name):
+            rc, output = self._helm('uninstall', '-n', namespace, name)
+            if rc != 0 and 'not found' not in output:
+                raise RuntimeError("helm uninstall -n {} {} failed: {}".format(namespace, name, output.strip()))
+
+        if not present:
+            return
+        with ThreadPoolExecutor(max_workers=len(present)) as executor:
+            futures = [executor.submit(
+                self._change, "uninstall release {}/{}".format(namespace, name),
+                lambda namespace=namespace, name=name: uninstall(namespace, name))
+                for namespace, name in present]
+        for future in futures:
+            future.result()
+
+    def _detachNamespaces(self, labels):
+        from kubernetes import client
+
+        core = client.CoreV1Api()
+        for namespace in core.list_namespace().items:
+            metadata = namespace.metadata
+            owners = [ref for ref in metadata.owner_references or [] if 'kubesphere.io' not in ref.api_version]
+            finalizers = [f for f in metadata.finalizers or [] if 'kubesphere.io' not in f]
+            patch = {}
+            present = [label for label in labels if label in (metadata.labels or {})]
+            if present:
+                patch['labels'] = dict((label, None) for label in present)
+            if len(owners) != len(metadata.owner_references or []):
+                patch['ownerReferences'] = [client.ApiClient().sanitize_for_serialization(ref) for ref in owners] or None
+            if len(finalizers) != len(metadata.finalizers or []):
+                patch['finalizers'] = finalizers or None
+            if patch:
+                self._change("detach namespace {} from KubeSphere".format(metadata.name),
+                             lambda name=metadata.name, patch=patch: ignoreMissing(
+                                 core.patch_namespace, name, {'metadata': patch}))
+
+    def _deleteRbac(self, selectors, names):
+        from kubernetes import client
+
+        rbac = client.RbacAuthorizationV1Api()
+        for kind, listAll, delete in (
+                ('role', rbac.list_role_for_all_namespaces, rbac.delete_namespaced_role),
+                ('role binding', rbac.list_role_binding_for_all_namespaces, rbac.delete_namespaced_role_binding)):
+            matched = set()
+            for selector in selectors:
+                matched.update((item.metadata.namespace, item.metadata.name)
+                               for item in listAll(label_selector=selector).items)
+            for namespace, name in sorted(matched):
+                self._change("delete {} {}/{}".format(kind, namespace, name),
+                             lambda namespace=namespace, name=name, delete=delete: ignoreMissing(delete, name, namespace))
+        for kind, listAll, delete in (
+                ('cluster role', rbac.list_cluster_role, rbac.delete_cluster_role),
+                ('cluster role binding', rbac.list_cluster_role_binding, rbac.delete_cluster_role_binding)):
+            matched = set()
+            for selector in selectors:
+                matched.update(item.metadata.name for item in listAll(label_selector=selector).items)
+            matched.update(item.metadata.name for item in listAll().items
+                           if any(part in item.metadata.name for part in names))
+            for name in sorted(matched):
+                self._change("delete {} {}".format(kind, name), lambda name=name, delete=delete: ignoreMissing(delete, name))
+
+    def _matchingCrds(self, match):
+        from kubernetes import client
+
+        with self._lock:
+            if self._crds is None:
+                self._crds = []
+                for crd in client.ApiextensionsV1Api().list_custom_resource_definition().items:
+                    versions = [v.name for v in crd.spec.versions if v.storage] or [crd.spec.versions[0].name]
+                    self._crds.append({'name': crd.metadata.name, 'group': crd.spec.group, 'version': versions[0],
+                                       'plural': crd.spec.names.plural, 'namespaced': crd.spec.scope == 'Namespaced'})
+            return [crd for crd in self._crds if match(crd)]
+
+    def _objects(self, crd, namespace=None):
+        from kubernetes import client
+        from kubernetes.client.rest import ApiException
+
+        api = client.CustomObjectsApi()
+        try:
+            if namespace is None:
+                return api.list_cluster_custom_object(crd['group'], crd['version'], crd['plural']).get('items') or []
+            return api.list_namespaced_custom_object(
+                crd['group'], crd['version'], namespace, crd['plural']).get('items') or []
+        except ApiException as e:
+            if e.status == 404:
+                return []
+            raise
+
+    def _clearFinalizers(self, crd, item):
+        from kubernetes import client
+
+        api = client.CustomObjectsApi()
+        metadata = item['metadata']
+        patch = {'metadata': {'finalizers': None}}
+        if crd['namespaced']:
+            ignoreMissing(api.patch_namespaced_custom_object,
+                          crd['group'], crd['version'], metadata['namespace'], crd['plural'], metadata['name'], patch)
+        else:
+            ignoreMissing(api.patch_cluster_custom_object,
+                          crd['group'], crd['version'], crd['plural'], metadata['name'], patch)
+
+    def _deleteObjects(self, crd):
+        '''
+        Delete the objects of a resource, then clear their finalizers: no
+        controller can add one to an object being deleted.
+        '''
+        from kubernetes import client
+
+        api = client.CustomObjectsApi()
+        for item in self._objects(crd):
+            metadata = item['metadata']
+            key = '{}/{}'.format(metadata['namespace'], metadata['name']) if crd['namespaced'] else metadata['name']
+
+            def delete(item=item, metadata=metadata):
+                if crd['namespaced']:
+                    ignoreMissing(api.delete_namespaced_custom_object,
+                                  crd['group'], crd['version'], metadata['namespace'], crd['plural'], metadata['name'])
+                else:
+                    ignoreMissing(api.delete_cluster_custom_object,
+                                  crd['group'], crd['version'], crd['plural'], metadata['name'])
+                if metadata.get('finalizers'):
+                    self._clearFinalizers(crd, item)
+
+            self._change("delete {} {}".format(crd['name'], key), delete)
+
+    def _deleteCrd(self, crd):
+        '''
+        Delete a custom resource definition, then clear the finalizers of its
+        objects its deletion waits for.
+        '''
+        from kubernetes import client
+
+        def delete():
+            ignoreMissing(client.ApiextensionsV1Api().delete_custom_resource_definition, crd['name'])
+            for item in self._objects(crd):
+                if item['metadata'].get('finalizers'):
+                    self._clearFinalizers(crd, item)
+
+        self._change("delete custom resource definition {}".format(crd['name']), delete)
+
+    def _namespace(self, namespace):
+        from kubernetes import client
+        from kubernetes.client.rest import ApiException
+
+        core = client.CoreV1Api()
+        try:
+            current = core.read_namespace(namespace)
+        except ApiException as e:
+            if e.status == 404:
+                return
+            raise
+
+        def delete():
+            if current.metadata.finalizers:
+                ignoreMissing(core.patch_namespace, namespace, {'metadata': {'finalizers': None}})
+            if current.metadata.deletion_timestamp is None:
+                ignoreMissing(core.delete_namespace, namespace)
+            self._waitNamespace(core, namespace)
+
+        self._change("delete namespace {}".format(namespace), delete)
+
+    def _waitNamespace(self, core, namespace):
+        from kubernetes import watch
+        from kubernetes.client.rest import ApiException
+
+        started = time.time()
+        cleared = started
+        last = None
+        while time.time() - started < namespaceTimeout:
+            try:
+                current = core.read_namespace(namespace)
+            except ApiException as e:
+                if e.status == 404:
+                    return
+                raise
+            conditions = [c for c in (current.status and current.status.conditions) or [] if c.status == 'True']
+            message = '; '.join(c.message for c in conditions if c.message)
+            if message and message != last:
+                logging.info("Namespace {} is terminating: {}".format(namespace, message))
+            last = message
+            if time.time() - cleared >= stuckAfter:
+                cleared = time.time()
+                self._clearStuck(namespace, message)
+
+            # Woken up by the next change of the namespace, at the latest when it is due to be cleared again
+            timeout = max(1, int(min(cleared + stuckAfter - time.time(), namespaceTimeout - (time.time() - started))))
+            for event in watch.Watch().stream(
+                    core.list_namespace, field_selector='metadata.name={}'.format(namespace),
+                    resource_version=current.metadata.resource_version, timeout_seconds=timeout):
+                if event['type'] == 'DELETED':
+                    return
+                break
+        raise RuntimeError("namespace {} still terminating after {}s".format(namespace, namespaceTimeout))
+
+    def _clearStuck(self, namespace, message):
+        '''
+        Clear the finalizers of the objects of the known groups the namespace
+        still waits for, as listed by its NamespaceContentRemaining condition.
+        '''
+        resources = set(remainingPattern.findall(message or ''))
+        for crd in self._matchingCrds(lambda crd: crd['name'] in resources and crd['namespaced'] and
+                                      any(matchesGroup(crd['group'], suffix) for suffix in finalizerGroups)):
+            for item in self._objects(crd, namespace):
+                if item['metadata'].get('finalizers'):
+                    logging.info("Clearing the finalizers of {} {}/{}".format(
+                        crd['name'], namespace, item['metadata']['name']))
+                    self._clearFinalizers(crd, item)
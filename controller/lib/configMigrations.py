@@ -0,0 +1,234 @@
+# encoding: utf-8
+
+import copy
+import logging
+
+'''
+registry: The migration steps in the order they are applied.
+'''
+registry = []
+
+
+class Migration():
+
+    def __init__(self, name, version, apply, upgradeOnly):
+        '''
+        :param name: Name of the step, used in the log
+        :param version: The KubeSphere version that introduced the layout the step migrates to
+        :param apply: Called with (spec, status), changes spec in place and must be idempotent
+        :param upgradeOnly: Only apply the step when the ClusterConfiguration is written back
+                            anyway, i.e. on an upgrade or when another step changed the spec
+        '''
+        self.name = name
+        self.version = version
+        self.apply = apply
+        self.upgradeOnly = upgradeOnly
+
+
+def migration(version, upgradeOnly=False):
+    def register(apply):
+        registry.append(Migration(apply.__name__, version, apply, upgradeOnly))
+        return apply
+    return register
+
+
+def componentStatus(status, name):
+    return isinstance(status, dict) and isinstance(status.get(name), dict) and \
+        status[name].get('status') == 'enabled'
+
+
+@migration('v3.0.0', upgradeOnly=True)
+def dropRemovedVolumeSizes(spec, status):
+    common = spec.get('common')
+    if common is None:
+        return
+    common.pop('mysqlVolumeSize', None)
+    common.pop('etcdVolumeSize', None)
+
+
+@migration('v3.0.0', upgradeOnly=True)
+def redisAndOpenldapFromStatus(spec, status):
+    common = spec.get('common')
+    if common is None:
+        return
+    common['redis'] = {'enabled': componentStatus(status, 'redis')}
+    common['openldap'] = {'enabled': componentStatus(status, 'openldap')}
+    if 'redisVolumSize' in common:
+        common['redis']['volumeSize'] = common.pop('redisVolumSize')
+    if 'openldapVolumeSize' in common:
+        common['openldap']['volumeSize'] = common.pop('openldapVolumeSize')
+
+
+@migration('v3.0.0', upgradeOnly=True)
+def minioVolumeSize(spec, status):
+    common = spec.get('common')
+    if common is None or 'minioVolumeSize' not in common:
+        return
+    common.setdefault('minio', {})['volumeSize'] = common.pop('minioVolumeSize')
+
+
+@migration('v3.0.0', upgradeOnly=True)
+def elasticsearchLayout(spec, status):
+    es = (spec.get('common') or {}).get('es')
+    if es is None:
+        return
+    es.setdefault('master', {'volumeSize': '4Gi'})
+    es.setdefault('data', {'volumeSize': '20Gi'})
+    for old, role, key in [
+            ('elasticsearchMasterReplicas', 'master', 'replicas'),
+            ('elasticsearchDataReplicas', 'data', 'replicas'),
+            ('elasticsearchMasterVolumeSize', 'master', 'volumeSize'),
+            ('elasticsearchDataVolumeSize', 'data', 'volumeSize')]:
+        if old in es:
+            es[role][key] = es.pop(old)
+    if 'externalElasticsearchHost' not in es and 'externalElasticsearchUrl' in es:
+        es['externalElasticsearchHost'] = es['externalElasticsearchUrl']
+
+
+@migration('v3.1.0', upgradeOnly=True)
+def consoleUnderCore(spec, status):
+    common = spec.get('common')
+    if common is None or 'console' not in spec:
+        return
+    common.setdefault('core', {})['console'] = spec.pop('console')
+
+
+@migration('v3.0.0')
+def loggingSidecar(spec, status):
+    loggingSpec = spec.get('logging')
+    if not isinstance(loggingSpec, dict) or 'logsidecarReplicas' not in loggingSpec or 'enabled' not in loggingSpec:
+        return
+    enabled = bool(loggingSpec['enabled'])
+    spec['logging'] = {
+        'enabled': enabled,
+        'logsidecar': {
+            'enabled': enabled,
+            'replicas': 2
+        }
+    }
+
+
+@migration('v3.1.0')
+def dropNotification(spec, status):
+    spec.pop('notification', None)
+
+
+@migration('v3.1.0')
+def openpitrixStore(spec, status):
+    openpitrix = spec.get('openpitrix')
+    if not isinstance(openpitrix, dict) or 'store' in openpitrix or 'enabled' not in openpitrix:
+        return
+    spec['openpitrix'] = {
+        'store': {
+            'enabled': bool(openpitrix['enabled'])
+        }
+    }
+
+
+@migration('v3.1.0')
+def networkpolicyToNetwork(spec, status):
+    if 'networkpolicy' not in spec:
+        return
+    networkpolicy = spec.pop('networkpolicy') or {}
+    spec['network'] = {
+        'networkpolicy': {
+            'enabled': bool(networkpolicy.get('enabled')),
+        },
+        'ippool': {
+            'type': 'none',
+        },
+        'topology': {
+            'type': 'none',
+        },
+    }
+
+
+@migration('v3.3.0')
+def kubeedgeToEdgeruntime(spec, status):
+    if 'kubeedge' not in spec:
+        return
+    kubeedge = spec.pop('kubeedge')
+    if 'enabled' in kubeedge:
+        kubeedge['iptables-manager'] = {
+            'enabled': True,
+            'mode': 'external'
+        }
+        spec['edgeruntime'] = {
+            'enabled': kubeedge['enabled'],
+            'kubeedge': kubeedge
+        }
+    edgeruntimeKubeedge = (spec.get('edgeruntime') or {}).get('kubeedge')
+    if isinstance(edgeruntimeKubeedge, dict):
+        edgeruntimeKubeedge.pop('edgeWatcher', None)
+
+
+def mergePatch(old, new):
+    '''
+    The JSON merge patch (RFC 7386) turning old into new.
+    '''
+    patch = {}
+    for key in old:
+        if key not in new:
+            patch[key] = None
+    for key, value in new.items():
+        if key not in old:
+            patch[key] = value
+        elif isinstance(value, dict) and isinstance(old[key], dict):
+            nested = mergePatch(old[key], value)
+            if nested:
+                patch[key] = nested
+        elif value != old[key]:
+            patch[key] = value
+    return patch
+
+
+def needsUpgrade(status, version):
+    if not isinstance(status, dict) or 'core' not in status:
+        return False
+    return status['core'].get('version') != version
+
+
+def migrate(resource, version):
+    '''
+    Apply the registered steps to a ClusterConfiguration and return the merge
+    patch writing the result back, or None when nothing has to be written.
+    On a write the status is reset to the clusterId, so every component is
+    installed again, and the version label is set to the installer version.
+    '''
+    spec = copy.deepcopy(resource.get('spec') or {})
+    status = resource.get('status')
+    upgrade = needsUpgrade(status, version)
+
+    applied = []
+    for step in registry:
+        if step.upgradeOnly:
+            continue
+        before = copy.deepcopy(spec)
+        step.apply(spec, status)
+        if spec != before:
+            applied.append(step)
+
+    if not upgrade and not applied:
+        return None
+
+    for step in registry:
+        if not step.upgradeOnly:
+            continue
+        before = copy.deepcopy(spec)
+        step.apply(spec, status)
+        if spec != before:
+            applied.append(step)
+
+    for step in applied:
+        logging.info("Migrating cluster configuration to the {} layout: {}".format(step.version, step.name))
+
+    newStatus = {}
+    if isinstance(status, dict) and 'clusterId' in status:
+        newStatus['clusterId'] = status['clusterId']
+
+    patch = {
+        'metadata': {'labels': {'version': version}},
+        'spec': mergePatch(resource.get('spec') or {}, spec),
+        'status': mergePatch(status if isinstance(status, dict) else {}, newStatus),
+    }
+    return {key: value for key, value in patch.items() if value}
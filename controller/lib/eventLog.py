@@ -0,0 +1,263 @@
+# encoding: utf-8
+
+import argparse
+import gzip
+import json
+import os
+import sys
+import threading
+from datetime import datetime
+
+import runnerEvents
+
+'''
+logSuffix: Suffix of the compressed event log of a run.
+indexSuffix: Suffix of the chunk index of a run.
+finishedStatuses: The statuses ending an ansible_runner run.
+'''
+logSuffix = '.jsonl.gz'
+indexSuffix = '.idx'
+finishedStatuses = ('successful', 'failed', 'timeout', 'canceled')
+
+
+class RunWriter():
+    '''
+    Append the events of one run to its log, one gzip member per chunk of
+    events, and describe every chunk with a line in the index:
+    {"offset": ..., "length": ..., "first": ..., "last": ..., "failed": [...]}
+    where first, last and failed are sequence numbers of events in the run.
+    '''
+
+    def __init__(self, path, chunkEvents):
+        self.path = path
+        self.chunkEvents = chunkEvents
+        self._log = open(path + logSuffix, 'ab')
+        self._index = open(path + indexSuffix, 'a')
+        self._lines = []
+        self._failed = []
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def append(self, event):
+        with self._lock:
+            self._lines.append(json.dumps(event, separators=(',', ':')) + '\n')
+            if runnerEvents.failureRecord(event) is not None:
+                self._failed.append(self._next)
+            self._next += 1
+            # Failures are flushed right away to survive a crash of the controller
+            if len(self._lines) >= self.chunkEvents or self._failed:
+                self._flush()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._log.close()
+            self._index.close()
+
+    def _flush(self):
+        if not self._lines:
+            return
+        data = gzip.compress(''.join(self._lines).encode('utf-8'), compresslevel=6)
+        offset = self._log.tell()
+        self._log.write(data)
+        self._log.flush()
+        self._index.write(json.dumps({
+            'offset': offset,
+            'length': len(data),
+            'first': self._next - len(self._lines),
+            'last': self._next - 1,
+            'failed': self._failed,
+        }) + '\n')
+        self._index.flush()
+        self._lines = []
+        self._failed = []
+
+
+class EventLog():
+    '''
+    Keep the events of the playbook runs in one compressed JSON lines log per
+    run under <baseDir>/<taskName>/<runId>.jsonl.gz, next to a chunk index
+    for random access. Only the last keepRuns runs of every playbook are kept,
+    and the oldest runs are dropped while all logs together exceed byteBudget.
+    '''
+
+    def __init__(self, baseDir, keepRuns=5, byteBudget=64 * 1024 * 1024, chunkEvents=64, writeJobEvents=False):
+        '''
+        :param baseDir: The folder the logs are written to
+        :param keepRuns: Number of runs kept per playbook
+        :param byteBudget: Maximum size of all logs and indexes together
+        :param chunkEvents: Number of events compressed together, the unit of random access
+        :param writeJobEvents: Whether ansible_runner still writes one job_events file per event
+        '''
+        self.baseDir = baseDir
+        self.keepRuns = keepRuns
+        self.byteBudget = byteBudget
+        self.chunkEvents = chunkEvents
+        self.writeJobEvents = writeJobEvents
+        self._writers = {}
+        self._lock = threading.Lock()
+
+    def status(self, taskName, status):
+        if status == 'starting':
+            self._close(taskName)
+            self._open(taskName)
+        elif status in finishedStatuses:
+            self._close(taskName)
+            self.prune()
+
+    def handle(self, taskName, event):
+        with self._lock:
+            writer = self._writers.get(taskName)
+        if writer is None:
+            writer = self._open(taskName)
+        writer.append(event)
+        return self.writeJobEvents
+
+    def _open(self, taskName):
+        taskDir = os.path.join(self.baseDir, taskName)
+        os.makedirs(taskDir, exist_ok=True)
+        runId = datetime.now().strftime('%Y%m%dT%H%M%S.%f')
+        writer = RunWriter(os.path.join(taskDir, runId), self.chunkEvents)
+        with self._lock:
+            self._writers[taskName] = writer
+        return writer
+
+    def _close(self, taskName):
+        with self._lock:
+            writer = self._writers.pop(taskName, None)
+        if writer is not None:
+            writer.close()
+
+    def runs(self, taskName):
+        '''
+        The run ids of a playbook, newest first.
+        '''
+        taskDir = os.path.join(self.baseDir, taskName)
+        if not os.path.isdir(taskDir):
+            return []
+        return sorted(
+            [name[:-len(logSuffix)] for name in os.listdir(taskDir) if name.endswith(logSuffix)],
+            reverse=True)
+
+    def _chunks(self, taskName, runId):
+        path = os.path.join(self.baseDir, taskName, runId + indexSuffix)
+        chunks = []
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        chunks.append(json.loads(line))
+                    except ValueError:
+                        # The last line of a run interrupted while flushing
+                        break
+        return chunks
+
+    def _readChunk(self, logFile, chunk):
+        logFile.seek(chunk['offset'])
+        data = gzip.decompress(logFile.read(chunk['length']))
+        return [json.loads(line) for line in data.decode('utf-8').splitlines()]
+
+    def events(self, taskName, runId=None, first=0, last=None):
+        '''
+        Yield the events of a run, the latest one by default, between the
+        sequence numbers first and last, decompressing only the chunks needed.
+        '''
+        runId = runId or next(iter(self.runs(taskName)), None)
+        if runId is None:
+            return
+        with open(os.path.join(self.baseDir, taskName, runId + logSuffix), 'rb') as logFile:
+            for chunk in self._chunks(taskName, runId):
+                if chunk['last'] < first or (last is not None and chunk['first'] > last):
+                    continue
+                for sequence, event in enumerate(self._readChunk(logFile, chunk), chunk['first']):
+                    if sequence >= first and (last is None or sequence <= last):
+                        yield event
+
+    def failures(self, taskName, runId=None):
+        '''
+        The failures of a run, the latest one by default, read from the chunks
+        the index lists failed events in.
+        '''
+        runId = runId or next(iter(self.runs(taskName)), None)
+        if runId is None:
+            return []
+        failures = []
+        with open(os.path.join(self.baseDir, taskName, runId + logSuffix), 'rb') as logFile:
+            for chunk in self._chunks(taskName, runId):
+                if not chunk['failed']:
+                    continue
+                events = self._readChunk(logFile, chunk)
+                for sequence in chunk['failed']:
+                    failure = runnerEvents.failureRecord(events[sequence - chunk['first']])
+                    if failure is not None:
+                        failures.append(failure)
+        return failures
+
+    def prune(self):
+        if not os.path.isdir(self.baseDir):
+            return
+        with self._lock:
+            active = set(writer.path for writer in self._writers.values())
+
+        kept = []
+        for taskName in os.listdir(self.baseDir):
+            for index, runId in enumerate(self.runs(taskName)):
+                path = os.path.join(self.baseDir, taskName, runId)
+                if path in active:
+                    continue
+                if index >= self.keepRuns:
+                    self._remove(path)
+                else:
+                    kept.append((runId, path))
+
+        size = sum(self._size(path) for _, path in kept)
+        for _, path in sorted(kept):
+            if size <= self.byteBudget:
+                break
+            size -= self._size(path)
+            self._remove(path)
+
+    @staticmethod
+    def _size(path):
+        return sum(os.path.getsize(path + suffix) for suffix in (logSuffix, indexSuffix)
+                   if os.path.exists(path + suffix))
+
+    @staticmethod
+    def _remove(path):
+        for suffix in (logSuffix, indexSuffix):
+            try:
+                os.remove(path + suffix)
+            except OSError:
+                pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Read the event logs of the playbook runs.')
+    parser.add_argument('--dir', default='/kubesphere/results/event-logs', help='the folder of the event logs')
+    parser.add_argument('task', nargs='?', help='the playbook, all playbooks are listed without it')
+    parser.add_argument('--run', help='the run id, the latest run by default')
+    parser.add_argument('--failed', action='store_true', help='only print the failures')
+    parser.add_argument('--json', action='store_true', help='print the events as JSON lines instead of their output')
+    parser.add_argument('--first', type=int, default=0, help='the sequence number of the first event')
+    parser.add_argument('--last', type=int, help='the sequence number of the last event')
+    args = parser.parse_args()
+
+    log = EventLog(args.dir)
+    if not args.task:
+        for taskName in sorted(os.listdir(args.dir)):
+            print('{}: {}'.format(taskName, ' '.join(log.runs(taskName))))
+        return
+
+    if args.failed:
+        print(runnerEvents.failureSummary(log.failures(args.task, args.run)) or 'No failed task was reported')
+        return
+
+    for event in log.events(args.task, args.run, args.first, args.last):
+        if args.json:
+            sys.stdout.write(json.dumps(event) + '\n')
+        elif event.get('stdout'):
+            sys.stdout.write(event['stdout'] + '\n')
+
+
+if __name__ == '__main__':
+    main()
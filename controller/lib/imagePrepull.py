@@ -0,0 +1,279 @@
+# encoding: utf-8
+
+import collections
+import logging
+import threading
+import time
+
+'''
+playbookImages: The keys of the images of roles/download/defaults/main.yml each playbook rolls out, the
+                images needed on demand only, e.g. the builders of the pipelines, are left to the offline tooling.
+helperImage: The key of the image the static busybox the pre-pull containers sleep in is copied from.
+pullFailures: The waiting reasons of a container whose image cannot be pulled.
+mirrorRegistry: The registry whose images live in the kubesphereio namespace, see roles/kubesphere-defaults.
+'''
+playbookImages = {
+    'metrics_server': ['metrics_server'],
+    'common': ['redis', 'haproxy', 'openldap', 'minio', 'mc', 'alpine'],
+    'ks-core': ['ks_apiserver', 'ks_console', 'ks_controller_manager', 'ks_kubectl', 'snapshot_controller',
+                'defaultbackend'],
+    'multicluster': ['kubefed', 'tower'],
+    'openpitrix': ['openpitrix_job'],
+    'monitoring': ['configmap_reload', 'prometheus', 'prometheus_config_reloader', 'prometheus_operator',
+                   'kube_rbac_proxy', 'kube_state_metrics', 'node_exporter', 'alertmanager', 'thanos'],
+    'notification': ['notification_manager_operator', 'notification_manager', 'notification_tenant_sidecar'],
+    'logging': ['elasticsearch_oss', 'docker_elasticsearch_curator', 'fluentbit_operator', 'ks_fluent_bit',
+                'ks_log_sidecar_injector'],
+    'events': ['kube_events_operator', 'kube_events_exporter', 'kube_events_ruler'],
+    'auditing': ['auditing_operator', 'auditing_webhook'],
+    'devops': ['ks_devops_apiserver', 'ks_devops_controller', 'ks_devops_tools', 'jenkins', 's2ioperator'],
+    'servicemesh': ['istio_pilot', 'istio_proxyv2', 'jaeger_operator', 'jaeger_agent', 'jaeger_collector',
+                    'jaeger_query', 'kiali_operator', 'kiali'],
+    'edgeruntime': ['cloudcore', 'edge_watcher', 'edge_watcher_agent'],
+    'gatekeeper': ['gatekeeper'],
+}
+helperImage = 'busybox'
+pullFailures = ('ErrImagePull', 'ImagePullBackOff', 'InvalidImageName', 'ErrImageNeverPull')
+mirrorRegistry = 'registry.cn-beijing.aliyuncs.com'
+
+
+def namespaceOverride(variables):
+    '''
+    The namespace_override the kubesphere-defaults role sets before the
+    images are rendered, or None.
+    '''
+    if 'namespace_override' in variables:
+        return variables['namespace_override']
+    if variables.get('local_registry') == mirrorRegistry or variables.get('zone') == 'cn':
+        return 'kubesphereio'
+    return None
+
+
+def renderImages(defaultsFile, variables):
+    '''
+    The images of the download role as a mapping of key to image reference,
+    rendered like the roles render them. Its defaults only use the default
+    filter, so they are rendered with jinja2 alone, again and again until no
+    variable refers to another one. An undefined variable fails the image like
+    it fails Ansible, and the image is left out.
+    :param variables: The extra vars of the playbooks, e.g. local_registry or dev_tag
+    '''
+    import jinja2
+    import yaml
+
+    with open(defaultsFile, 'r') as f:
+        values = yaml.safe_load(f)
+    values.update(variables)
+    override = namespaceOverride(values)
+    if override is not None:
+        values['namespace_override'] = override
+    environment = jinja2.Environment(undefined=jinja2.StrictUndefined)
+    for _ in range(10):
+        rendered = {}
+        for key, value in values.items():
+            if isinstance(value, str) and ('{{' in value or '{%' in value):
+                try:
+                    rendered[key] = environment.from_string(value).render(values).strip()
+                except jinja2.TemplateError:
+                    # Only fails the images using it
+                    continue
+        if not rendered or all(values[key] == value for key, value in rendered.items()):
+            break
+        values.update(rendered)
+
+    images = collections.OrderedDict()
+    for key, image in (values.get('images') or {}).items():
+        try:
+            repo = environment.from_string(str(image.get('repo') or '')).render(values).strip()
+            tag = environment.from_string(str(image.get('tag') or '')).render(values).strip()
+        except jinja2.TemplateError as e:
+            logging.info("Not pre-pulling image {}, it does not render: {}".format(key, e))
+            continue
+        if '{{' in repo + tag or '{%' in repo + tag or not repo or (not tag and '@' not in repo):
+            logging.info("Not pre-pulling image {}, it renders to {}:{}".format(key, repo, tag))
+            continue
+        images[key] = '{}:{}'.format(repo, tag) if '@' not in repo else repo
+    return images
+
+
+def playbookImageList(playbooks, images):
+    '''
+    The images rolled out by the playbooks, a mapping of container name to
+    image reference without duplicates.
+    '''
+    selected = collections.OrderedDict()
+    for playbook in playbooks:
+        for key in playbookImages.get(playbook, []):
+            image = images.get(key)
+            if image and image not in selected.values():
+                selected[key.replace('_', '-')[:63]] = image
+    return selected
+
+
+class ImagePrepull():
+    '''
+    Pull the images of the playbooks of a reconcile onto the nodes while the
+    first playbooks run, so their workloads later start from warm caches
+    instead of waiting in ContainerCreating. A short-lived DaemonSet runs a
+    container per image on every node except the edge nodes, each sleeping in
+    a static busybox copied in by an init container, so images without a shell
+    are pulled too. The pull progress is logged and passed to report, and the
+    DaemonSet is deleted once every image is pulled or failed on every node,
+    after timeout seconds, or by stop().
+    '''
+
+    def __init__(self, namespace, name, timeout=1800, interval=5, report=None):
+        '''
+        :param namespace: The namespace of the DaemonSet
+        :param name: The name of the DaemonSet and the value of its app label
+        :param timeout: Seconds the images are pulled for at most
+        :param interval: Seconds between two reads of the pull progress
+        :param report: Called with the summary whenever the pull progress changes
+        '''
+        self.namespace = namespace
+        self.name = name
+        self.timeout = timeout
+        self.interval = interval
+        self.report = report
+        self.images = collections.OrderedDict()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self, images):
+        '''
+        Start pulling in the background.
+        :param images: Called without arguments, returns the mapping of container name to image to pull
+                       and the image the static busybox is copied from
+        '''
+        self.stop()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(images, self._stopped), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self, images, stopped):
+        from kubernetes import client
+        from kubernetes.client.rest import ApiException
+
+        apps = client.AppsV1Api()
+        try:
+            self.images, helper = images()
+            if not self.images:
+                return
+            try:
+                apps.create_namespaced_daemon_set(self.namespace, self._daemonSet(helper))
+            except ApiException as e:
+                # Left behind by an interrupted run
+                if e.status != 409:
+                    raise
+                apps.replace_namespaced_daemon_set(self.name, self.namespace, self._daemonSet(helper))
+        except Exception as e:
+            logging.info("Skipping the image pre-pull: {}".format(getattr(e, 'reason', None) or e))
+            return
+
+        logging.info("Pre-pulling {} images on every node ...".format(len(self.images)))
+        deadline = time.time() + self.timeout
+        last = None
+        try:
+            while not stopped.wait(self.interval):
+                try:
+                    summary = self._progress(apps, client.CoreV1Api())
+                except Exception as e:
+                    logging.info("Failed to read the image pre-pull progress: {}".format(e))
+                    continue
+                if summary != last:
+                    last = summary
+                    logging.info("Pre-pulled {} of {} images on {} nodes{}".format(
+                        summary['pulled'], summary['total'], summary['nodes'],
+                        ', failed: {}'.format(', '.join(summary['failed'])) if summary['failed'] else ''))
+                    self._report(summary)
+                if summary['nodes'] and summary['pulled'] + summary['failing'] == summary['total']:
+                    break
+                if time.time() > deadline:
+                    logging.info("Stopping the image pre-pull after {}s".format(self.timeout))
+                    break
+        finally:
+            try:
+                apps.delete_namespaced_daemon_set(
+                    self.name, self.namespace, body=client.V1DeleteOptions(propagation_policy='Background'))
+            except Exception as e:
+                logging.info("Failed to delete the image pre-pull DaemonSet: {}".format(e))
+
+    def _progress(self, apps, core):
+        daemonSet = apps.read_namespaced_daemon_set_status(self.name, self.namespace)
+        nodes = (daemonSet.status and daemonSet.status.desired_number_scheduled) or 0
+        pods = core.list_namespaced_pod(self.namespace, label_selector='app={}'.format(self.name)).items
+        pulled = 0
+        failing = 0
+        failed = set()
+        for pod in pods:
+            for status in (pod.status and pod.status.container_statuses) or []:
+                waiting = status.state and status.state.waiting
+                if status.image_id or (status.state and (status.state.running or status.state.terminated)):
+                    pulled += 1
+                elif waiting and waiting.reason in pullFailures:
+                    failing += 1
+                    failed.add(self.images.get(status.name, status.name))
+        return collections.OrderedDict([
+            ('images', len(self.images)),
+            ('nodes', nodes),
+            ('pulled', pulled),
+            ('failing', failing),
+            ('total', len(self.images) * nodes),
+            ('failed', sorted(failed)),
+        ])
+
+    def _daemonSet(self, helper):
+        resources = {'requests': {'cpu': '1m', 'memory': '4Mi'}, 'limits': {'cpu': '10m', 'memory': '16Mi'}}
+        mount = {'name': 'prepull', 'mountPath': '/prepull'}
+        containers = [{
+            'name': name,
+            'image': image,
+            'imagePullPolicy': 'IfNotPresent',
+            'command': ['/prepull/busybox', 'sleep', '2147483647'],
+            'resources': resources,
+            'volumeMounts': [mount],
+        } for name, image in self.images.items()]
+        return {
+            'apiVersion': 'apps/v1',
+            'kind': 'DaemonSet',
+            'metadata': {'name': self.name, 'namespace': self.namespace, 'labels': {'app': self.name}},
+            'spec': {
+                'selector': {'matchLabels': {'app': self.name}},
+                'template': {
+                    'metadata': {'labels': {'app': self.name}},
+                    'spec': {
+                        'automountServiceAccountToken': False,
+                        'terminationGracePeriodSeconds': 0,
+                        'tolerations': [{'operator': 'Exists'}],
+                        'affinity': {'nodeAffinity': {'requiredDuringSchedulingIgnoredDuringExecution': {
+                            'nodeSelectorTerms': [{'matchExpressions': [
+                                {'key': 'node-role.kubernetes.io/edge', 'operator': 'DoesNotExist'}]}]}}},
+                        'initContainers': [{
+                            'name': 'prepull-helper',
+                            'image': helper,
+                            'imagePullPolicy': 'IfNotPresent',
+                            'command': ['cp', '/bin/busybox', '/prepull/busybox'],
+                            'resources': resources,
+                            'volumeMounts': [mount],
+                        }],
+                        'containers': containers,
+                        'volumes': [{'name': 'prepull', 'emptyDir': {}}],
+                    },
+                },
+            },
+        }
+
+    def _report(self, summary):
+        if self.report is None:
+            return
+        try:
+            self.report(dict((key, value) for key, value in summary.items() if key != 'failing'))
+        except Exception as e:
+            logging.info("Failed to report the image pre-pull: {}".format(e))
@@ -0,0 +1,259 @@
+# encoding: utf-8
+
+import collections
+import copy
+import json
+import logging
+import os
+import threading
+import time
+
+'''
+finishedStatuses: The statuses ending an ansible_runner run.
+taskEndEvents: The runner events ending a task on a host.
+keepAlive: Seconds between the comments keeping an idle event stream open.
+'''
+finishedStatuses = ('successful', 'failed', 'timeout', 'canceled')
+taskEndEvents = ('runner_on_ok', 'runner_on_failed', 'runner_on_skipped', 'runner_on_unreachable')
+keepAlive = 15
+
+
+class PlaybookProgress():
+
+    def __init__(self, name, expected=None):
+        '''
+        :param expected: The duration and task count of the last successful run, e.g. {"seconds": 120, "tasks": 40}
+        '''
+        self.name = name
+        self.expected = expected or {}
+        self.status = 'pending'
+        self.start = None
+        self.end = None
+        self.done = set()
+        self.task = None
+        self.role = None
+
+    def percent(self):
+        if self.status in finishedStatuses or self.status == 'skipped':
+            return 100.0
+        if self.start is None:
+            return 0.0
+        fractions = []
+        if self.expected.get('tasks'):
+            fractions.append(len(self.done) / float(self.expected['tasks']))
+        if self.expected.get('seconds'):
+            fractions.append((time.time() - self.start) / float(self.expected['seconds']))
+        if not fractions:
+            return None
+        # A run is not done before its last event, whatever its history says
+        return round(min(0.99, max(fractions)) * 100, 1)
+
+    def remaining(self):
+        '''
+        Seconds left according to the duration of the last successful run.
+        '''
+        if self.status in finishedStatuses or self.status == 'skipped':
+            return 0.0
+        seconds = self.expected.get('seconds')
+        if not seconds:
+            return None
+        elapsed = time.time() - self.start if self.start is not None else 0.0
+        return round(max(0.0, seconds - elapsed), 1)
+
+    def describe(self):
+        now = self.end or time.time()
+        return collections.OrderedDict([
+            ('playbook', self.name),
+            ('status', self.status),
+            ('percent', self.percent()),
+            ('tasksDone', len(self.done)),
+            ('tasksExpected', self.expected.get('tasks')),
+            ('task', self.task),
+            ('role', self.role),
+            ('elapsed', round(now - self.start, 1) if self.start is not None else 0.0),
+            ('eta', self.remaining()),
+        ])
+
+
+class InstallProgress():
+    '''
+    Follow the progress of the playbooks of a reconcile from their runner
+    events: the tasks done out of the tasks of the last successful run, the
+    current task, the elapsed time and the time left according to the
+    duration of the last successful run. Every change is kept as a numbered
+    record in a ring buffer the event stream is served from, and the change of
+    a playbook's status is passed to report as the compact summary().
+    '''
+
+    def __init__(self, historyFile, size=1024, report=None):
+        '''
+        :param historyFile: The file keeping the duration and task count of the last successful run of each playbook
+        :param size: Number of records kept for the event stream
+        :param report: Called with the summary whenever a playbook changes status
+        '''
+        self.historyFile = historyFile
+        self.report = report
+        self.records = collections.deque(maxlen=size)
+        self.playbooks = collections.OrderedDict()
+        self.planned = []
+        self.history = {}
+        self._next = 1
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._loaded = False
+
+    def begin(self, names):
+        '''
+        Start following the playbooks scheduled in this reconcile.
+        '''
+        with self._lock:
+            self._load()
+            self.planned = list(names)
+            self.playbooks = collections.OrderedDict()
+            for name in self.planned:
+                self.playbooks[name] = PlaybookProgress(name, self.history.get(name))
+            self._record('plan', {'playbooks': self.planned})
+        self._report()
+
+    def end(self, results):
+        '''
+        Mark the playbooks skipped behind a failed prerequisite, they never start.
+        :param results: Mapping of playbook name to return code, -1 for a skipped playbook
+        '''
+        with self._lock:
+            for name, rc in results.items():
+                playbook = self.playbooks.get(name)
+                if rc == -1 and playbook is not None and playbook.status == 'pending':
+                    playbook.status = 'skipped'
+                    self._record('playbook', playbook.describe())
+        self._report()
+
+    def status(self, taskName, status):
+        with self._lock:
+            self._load()
+            playbook = self.playbooks.get(taskName)
+            if playbook is None or (status == 'starting' and playbook.status in finishedStatuses):
+                playbook = self.playbooks[taskName] = PlaybookProgress(taskName, self.history.get(taskName))
+            if status == 'running' and playbook.start is None:
+                playbook.start = time.time()
+            elif status in finishedStatuses:
+                playbook.end = time.time()
+                if status == 'successful' and playbook.start is not None:
+                    self.history[taskName] = {'seconds': round(playbook.end - playbook.start, 1),
+                                              'tasks': len(playbook.done)}
+                    self._save()
+            playbook.status = status
+            self._record('playbook', playbook.describe())
+        if status == 'running' or status in finishedStatuses:
+            self._report()
+
+    def handle(self, taskName, event):
+        eventName = event.get('event')
+        if eventName != 'playbook_on_task_start' and eventName not in taskEndEvents:
+            return True
+        eventData = event.get('event_data') or {}
+        with self._lock:
+            playbook = self.playbooks.get(taskName)
+            if playbook is None:
+                return True
+            if eventName == 'playbook_on_task_start':
+                playbook.task = eventData.get('task')
+                playbook.role = eventData.get('role') or None
+                self._record('task', playbook.describe())
+            else:
+                playbook.done.add(eventData.get('task_uuid'))
+        return True
+
+    def summary(self):
+        '''
+        The progress of the whole reconcile, compact enough for the status of
+        the ClusterConfiguration.
+        '''
+        with self._lock:
+            return self._summary()
+
+    def _summary(self):
+        planned = [self.playbooks[name] for name in self.planned if name in self.playbooks]
+        finished = [p for p in planned if p.status in finishedStatuses or p.status == 'skipped']
+        percent = sum((p.percent() or 0.0) for p in planned) / len(planned) if planned else 100.0
+        return collections.OrderedDict([
+            ('completed', len(finished)),
+            ('total', len(planned)),
+            ('percent', round(percent, 1)),
+            ('running', [p.name for p in planned if p.status == 'running']),
+            ('failed', [p.name for p in planned if p.status in ('failed', 'timeout', 'canceled')]),
+        ])
+
+    def snapshot(self):
+        with self._lock:
+            return collections.OrderedDict([
+                ('summary', self._summary()),
+                ('lastEventId', self._next - 1),
+                ('playbooks', [playbook.describe() for playbook in self.playbooks.values()]),
+            ])
+
+    def stream(self, lastEventId=0, timeout=keepAlive):
+        '''
+        Yield the records after lastEventId as they are added, and None when
+        no record was added for timeout seconds. The records dropped from the
+        ring buffer are replaced by a snapshot.
+        '''
+        nextId = lastEventId + 1
+        while True:
+            with self._lock:
+                if not self.records or self.records[-1]['id'] < nextId:
+                    self._changed.wait(timeout)
+                records = [record for record in self.records if record['id'] >= nextId]
+                if self.records and self.records[0]['id'] > nextId and nextId < self._next:
+                    records.insert(0, {'id': self.records[0]['id'] - 1, 'event': 'snapshot', 'data': None})
+            if not records:
+                yield None
+                continue
+            for record in records:
+                if record['event'] == 'snapshot':
+                    record = dict(record, data=self.snapshot())
+                yield record
+            nextId = records[-1]['id'] + 1
+
+    def _record(self, event, data):
+        self.records.append({'id': self._next, 'time': time.time(), 'event': event, 'data': copy.deepcopy(data)})
+        self._next += 1
+        self._changed.notify_all()
+
+    def _report(self):
+        if self.report is not None:
+            try:
+                self.report(self.summary())
+            except Exception as e:
+                logging.info("Failed to report the progress: {}".format(e))
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            with open(self.historyFile, 'r') as f:
+                self.history = json.load(f).get('playbooks') or {}
+        except (IOError, ValueError):
+            self.history = {}
+
+    def _save(self):
+        tmpFile = self.historyFile + '.tmp'
+        try:
+            with open(tmpFile, 'w', encoding='utf-8') as f:
+                json.dump({"playbooks": self.history}, f, ensure_ascii=False, indent=4)
+            os.replace(tmpFile, self.historyFile)
+        except (IOError, OSError) as e:
+            logging.info("Failed to save the playbook durations: {}".format(e))
+
+
+def serverSentEvents(progress, lastEventId):
+    '''
+    Format the records of the progress stream as server-sent events.
+    '''
+    for record in progress.stream(lastEventId):
+        if record is None:
+            yield ': keep-alive\n\n'
+            continue
+        yield 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+            record['id'], record['event'], json.dumps(record['data'], separators=(',', ':')))
@@ -0,0 +1,266 @@
+# encoding: utf-8
+
+import bisect
+import collections
+import logging
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+'''
+durationBuckets: Upper bounds in seconds of the duration histograms.
+apiActions: Modules whose tasks are counted as time spent waiting on the API server.
+apiCommands: Commands whose shell tasks are counted as time spent waiting on the API server.
+'''
+durationBuckets = [1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600]
+apiActions = ('kubesphere_k8s',)
+apiCommands = ('kubectl', 'helm')
+finishedStatuses = ('successful', 'failed', 'timeout', 'canceled')
+taskEndEvents = ('runner_on_ok', 'runner_on_failed', 'runner_on_skipped', 'runner_on_unreachable')
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def formatLabels(names, values, extra=None):
+    pairs = ['{}="{}"'.format(name, escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Histogram():
+
+    def __init__(self, name, help, labels, buckets=durationBuckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+
+    def observe(self, values, amount):
+        series = self._series.setdefault(tuple(values), [[0] * len(self.buckets), 0.0, 0])
+        index = bisect.bisect_left(self.buckets, amount)
+        if index < len(self.buckets):
+            series[0][index] += 1
+        series[1] += amount
+        series[2] += 1
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+        for values, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, bucketCount in zip(self.buckets, counts):
+                cumulative += bucketCount
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, formatLabels(self.labels, values, 'le="{}"'.format(bound)), cumulative))
+            lines.append('{}_bucket{} {}'.format(
+                self.name, formatLabels(self.labels, values, 'le="+Inf"'), count))
+            lines.append('{}_sum{} {}'.format(self.name, formatLabels(self.labels, values), total))
+            lines.append('{}_count{} {}'.format(self.name, formatLabels(self.labels, values), count))
+        return lines
+
+
+class Sample():
+
+    def __init__(self, name, help, labels, kind):
+        '''
+        :param kind: "counter" or "gauge"
+        '''
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.kind = kind
+        self._series = collections.defaultdict(float)
+
+    def inc(self, values, amount=1):
+        self._series[tuple(values)] += amount
+
+    def set(self, values, value):
+        self._series[tuple(values)] = value
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind)]
+        for values, value in sorted(self._series.items()):
+            lines.append('{}{} {}'.format(self.name, formatLabels(self.labels, values), value))
+        return lines
+
+
+def eventTime(event):
+    try:
+        return datetime.strptime(event['created'], '%Y-%m-%dT%H:%M:%S.%f').timestamp()
+    except (KeyError, ValueError):
+        return time.time()
+
+
+class InstallerMetrics():
+    '''
+    Build Prometheus metrics from the runner events and statuses of every playbook.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.playbookDuration = Histogram(
+            'ks_installer_playbook_duration_seconds',
+            'Duration of the playbook runs.', ['playbook', 'status'])
+        self.roleDuration = Histogram(
+            'ks_installer_role_duration_seconds',
+            'Time from the first task start to the last task end of a role.', ['playbook', 'role'])
+        self.taskDuration = Histogram(
+            'ks_installer_task_duration_seconds',
+            'Duration of the tasks, including their retries.', ['playbook', 'role', 'task'])
+        self.taskRetries = Sample(
+            'ks_installer_task_retries_total',
+            'Retries spent in until loops.', ['playbook', 'role', 'task'], 'counter')
+        self.apiWait = Sample(
+            'ks_installer_api_wait_seconds_total',
+            'Time spent in tasks talking to the API server through kubectl, helm or kubesphere_k8s.',
+            ['playbook'], 'counter')
+        self.running = Sample(
+            'ks_installer_running_playbooks',
+            'Number of playbooks running right now.', [], 'gauge')
+        self.lastStatus = Sample(
+            'ks_installer_playbook_last_status',
+            'Final status of the last run of each playbook, 1 for the status reached.',
+            ['playbook', 'status'], 'gauge')
+        self.lastSuccess = Sample(
+            'ks_installer_playbook_last_success_timestamp_seconds',
+            'Time of the last successful run of each playbook.', ['playbook'], 'gauge')
+        self.running.set([], 0)
+
+        self._playbookStart = {}
+        self._tasks = {}
+        self._roles = {}
+
+    def status(self, playbook, status):
+        with self._lock:
+            if status == 'running' and playbook not in self._playbookStart:
+                self._playbookStart[playbook] = time.time()
+                self.running.inc([], 1)
+            elif status in finishedStatuses and playbook in self._playbookStart:
+                now = time.time()
+                self.playbookDuration.observe([playbook, status], now - self._playbookStart.pop(playbook))
+                self.running.inc([], -1)
+                for known in finishedStatuses:
+                    self.lastStatus.set([playbook, known], 1 if known == status else 0)
+                if status == 'successful':
+                    self.lastSuccess.set([playbook], now)
+                for (rolePlaybook, role), (start, end) in list(self._roles.items()):
+                    if rolePlaybook == playbook:
+                        self.roleDuration.observe([playbook, role], end - start)
+                        del self._roles[(rolePlaybook, role)]
+
+    def handle(self, playbook, event):
+        eventName = event.get('event')
+        eventData = event.get('event_data') or {}
+        role = eventData.get('role') or ''
+        task = eventData.get('task') or ''
+
+        with self._lock:
+            if eventName == 'playbook_on_task_start':
+                start = eventTime(event)
+                self._tasks[(playbook, eventData.get('task_uuid'))] = start
+                if role:
+                    first, last = self._roles.get((playbook, role), (start, start))
+                    self._roles[(playbook, role)] = (first, last)
+            elif eventName == 'runner_retry':
+                self.taskRetries.inc([playbook, role, task])
+            elif eventName in taskEndEvents:
+                start = self._tasks.pop((playbook, eventData.get('task_uuid')), None)
+                if start is None:
+                    return True
+                end = eventTime(event)
+                duration = max(0.0, end - start)
+                self.taskDuration.observe([playbook, role, task], duration)
+                if role and (playbook, role) in self._roles:
+                    self._roles[(playbook, role)] = (self._roles[(playbook, role)][0], end)
+                if self._talksToApiServer(eventData):
+                    self.apiWait.inc([playbook], duration)
+        return True
+
+    @staticmethod
+    def _talksToApiServer(eventData):
+        if eventData.get('task_action') in apiActions:
+            return True
+        cmd = (eventData.get('res') or {}).get('cmd') or eventData.get('task_args') or ''
+        if isinstance(cmd, list):
+            cmd = ' '.join(cmd)
+        return any(command in cmd for command in apiCommands)
+
+    def expose(self):
+        with self._lock:
+            lines = []
+            for metric in [self.playbookDuration, self.roleDuration, self.taskDuration,
+                           self.taskRetries, self.apiWait, self.running,
+                           self.lastStatus, self.lastSuccess]:
+                lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer():
+
+    def __init__(self, port, routes, streams=None):
+        '''
+        :param port: Port to listen on, 0 disables the server
+        :param routes: Mapping of path to a callable returning (content type, body)
+        :param streams: Mapping of path to a callable taking the Last-Event-ID of the request
+                        and yielding server-sent events until the client goes away
+        '''
+        self.port = port
+        self.routes = routes
+        self.streams = streams or {}
+        self.server = None
+
+    def start(self):
+        if not self.port:
+            return
+        routes = self.routes
+        streams = self.streams
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                if path in streams:
+                    self._stream(streams[path])
+                    return
+                route = routes.get(path)
+                if route is None:
+                    self.send_error(404)
+                    return
+                contentType, body = route()
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', contentType)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _stream(self, stream):
+                try:
+                    lastEventId = int(self.headers.get('Last-Event-ID') or 0)
+                except ValueError:
+                    lastEventId = 0
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+                try:
+                    for chunk in stream(lastEventId):
+                        self.wfile.write(chunk.encode('utf-8'))
+                        self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self.server = ThreadingHTTPServer(('', self.port), Handler)
+        except OSError as e:
+            logging.info("Failed to serve metrics on port {}: {}".format(self.port, e))
+            return
+        self.server.daemon_threads = True
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
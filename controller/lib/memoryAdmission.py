@@ -0,0 +1,263 @@
+# encoding: utf-8
+
+import json
+import logging
+import os
+import threading
+import time
+
+'''
+cgroupRoot: The mount point of the cgroup filesystem.
+unlimited: Limits at or above this many bytes mean no limit, cgroup v1 reports one close to 2**63.
+mebibyte: Bytes in a MiB, the unit of the logs and the status.
+finishedStatuses: The statuses ending an ansible_runner run.
+'''
+cgroupRoot = '/sys/fs/cgroup'
+unlimited = 2 ** 60
+mebibyte = 1024 * 1024
+finishedStatuses = ('successful', 'failed', 'timeout', 'canceled')
+
+
+def readInt(path):
+    try:
+        with open(path, 'r') as f:
+            value = f.read().strip()
+    except (IOError, OSError):
+        return None
+    if value == 'max':
+        return unlimited
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def readStat(path, key):
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                name, _, value = line.partition(' ')
+                if name == key:
+                    return int(value)
+    except (IOError, OSError, ValueError):
+        pass
+    return 0
+
+
+def cgroupDirs(controller):
+    '''
+    The directories the memory cgroup of this process may be found at: its
+    own path below the mount point, and the mount point itself for a
+    container with its own cgroup namespace.
+    '''
+    dirs = []
+    try:
+        with open('/proc/self/cgroup', 'r') as f:
+            for line in f:
+                _, controllers, path = line.rstrip('\n').split(':', 2)
+                if controller in controllers.split(','):
+                    dirs.append(path)
+    except (IOError, OSError, ValueError):
+        pass
+    return dirs + ['/']
+
+
+def cgroupMemory():
+    '''
+    The memory limit of the cgroup of this process and its working set in
+    bytes, the usage without the inactive page cache the kernel reclaims
+    before it kills a process. The limit is None when there is none.
+    '''
+    # cgroup v2
+    for path in cgroupDirs(''):
+        directory = os.path.join(cgroupRoot, path.lstrip('/'))
+        limit = readInt(os.path.join(directory, 'memory.max'))
+        usage = readInt(os.path.join(directory, 'memory.current'))
+        if limit is not None and usage is not None:
+            inactive = readStat(os.path.join(directory, 'memory.stat'), 'inactive_file')
+            return (limit if limit < unlimited else None), max(0, usage - inactive)
+
+    # cgroup v1
+    for path in cgroupDirs('memory'):
+        directory = os.path.join(cgroupRoot, 'memory', path.lstrip('/'))
+        limit = readInt(os.path.join(directory, 'memory.limit_in_bytes'))
+        usage = readInt(os.path.join(directory, 'memory.usage_in_bytes'))
+        if limit is not None and usage is not None:
+            inactive = readStat(os.path.join(directory, 'memory.stat'), 'total_inactive_file')
+            return (limit if limit < unlimited else None), max(0, usage - inactive)
+
+    return None, 0
+
+
+def groupMemory(pgid):
+    '''
+    The proportional set size of the processes of a process group in bytes.
+    The pages the forked Ansible workers share with their pool are split
+    between them instead of being counted once per worker.
+    '''
+    total = 0
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry), 'r') as f:
+                stat = f.read()
+            if int(stat[stat.rfind(')') + 2:].split()[2]) != pgid:
+                continue
+            with open('/proc/{}/smaps_rollup'.format(entry), 'r') as f:
+                for line in f:
+                    if line.startswith('Pss:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except (IOError, OSError, ValueError, IndexError):
+            continue
+    return total
+
+
+class MemoryAdmission():
+    '''
+    Hold back the start of a playbook while the memory limit of the installer
+    pod leaves no room for it. The room is the limit, less a reserve, less the
+    working set of the pod and less the growth still expected from the running
+    playbooks. A playbook is expected to take the peak memory of its last
+    successful run, sampled from its process group, or default without one.
+    A playbook always starts when nothing else runs. The held playbooks are
+    logged and passed to report.
+    '''
+
+    def __init__(self, historyFile, pidFile, default, reserve=0.1, interval=1, probe=cgroupMemory, report=None):
+        '''
+        :param historyFile: The file keeping the peak memory of the last successful run of each playbook
+        :param pidFile: Called with a playbook name, returns the file its run writes the id of its process group to
+        :param default: Bytes expected for a playbook without a recorded peak
+        :param reserve: Fraction of the limit kept free
+        :param interval: Seconds between two samples of the memory of the running playbooks
+        :param probe: Returns the memory limit, None without one, and the working set of the pod
+        :param report: Called with the summary whenever the held playbooks change
+        '''
+        self.historyFile = historyFile
+        self.pidFile = pidFile
+        self.default = default
+        self.reserve = reserve
+        self.interval = interval
+        self.probe = probe
+        self.report = report
+        self.history = {}
+        self.current = {}
+        self.peaks = {}
+        self.held = {}
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._thread = None
+
+    def expected(self, name):
+        with self._lock:
+            self._load()
+            return self.history.get(name) or self.default
+
+    def admit(self, name, running):
+        '''
+        Whether the playbook may start next to the running ones.
+        '''
+        limit, used = self.probe()
+        if limit is None:
+            return True
+        expected = self.expected(name)
+        growth = 0
+        for other in running:
+            with self._lock:
+                current = self.current.get(other, 0)
+            growth += max(0, self.expected(other) - current)
+        available = limit * (1 - self.reserve) - used - growth
+        admitted = not running or expected <= available
+
+        decision = "{} MiB expected, {} MiB available of the {} MiB limit".format(
+            expected // mebibyte, int(available) // mebibyte, limit // mebibyte)
+        changed = False
+        if not admitted and name not in self.held:
+            logging.info("Holding {} back: {}".format(name, decision))
+            changed = True
+        elif admitted and name in self.held:
+            logging.info("Starting {}: {}".format(name, decision))
+            changed = True
+        elif admitted and expected > available:
+            logging.info("Starting {} alone: {}".format(name, decision))
+        if admitted:
+            self.held.pop(name, None)
+        else:
+            self.held[name] = expected
+        if changed:
+            self._report(limit, used)
+        return admitted
+
+    def status(self, taskName, status):
+        with self._lock:
+            if status == 'running':
+                self.current[taskName] = 0
+                self.peaks[taskName] = 0
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, daemon=True)
+                    self._thread.start()
+            elif status in finishedStatuses and taskName in self.current:
+                del self.current[taskName]
+                # A later run of another playbook may get the same process group
+                try:
+                    os.remove(self.pidFile(taskName))
+                except OSError:
+                    pass
+                peak = self.peaks.pop(taskName)
+                if status == 'successful' and peak > 0:
+                    self._load()
+                    self.history[taskName] = peak
+                    self._save()
+
+    def handle(self, taskName, event):
+        return True
+
+    def _run(self):
+        while True:
+            with self._lock:
+                names = list(self.current)
+            for name in names:
+                try:
+                    with open(self.pidFile(name), 'r') as f:
+                        pgid = int(f.read().strip())
+                except (IOError, OSError, ValueError):
+                    continue
+                usage = groupMemory(pgid)
+                with self._lock:
+                    if name in self.current:
+                        self.current[name] = usage
+                        self.peaks[name] = max(self.peaks[name], usage)
+            time.sleep(self.interval)
+
+    def _report(self, limit, used):
+        if self.report is None:
+            return
+        try:
+            self.report({
+                'limitMiB': limit // mebibyte,
+                'usedMiB': used // mebibyte,
+                'held': sorted(self.held),
+            })
+        except Exception as e:
+            logging.info("Failed to report the memory admission: {}".format(e))
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            with open(self.historyFile, 'r') as f:
+                self.history = json.load(f).get('playbooks') or {}
+        except (IOError, ValueError):
+            self.history = {}
+
+    def _save(self):
+        tmpFile = self.historyFile + '.tmp'
+        try:
+            with open(tmpFile, 'w', encoding='utf-8') as f:
+                json.dump({"playbooks": self.history}, f, ensure_ascii=False, indent=4)
+            os.replace(tmpFile, self.historyFile)
+        except (IOError, OSError) as e:
+            logging.info("Failed to save the playbook memory peaks: {}".format(e))
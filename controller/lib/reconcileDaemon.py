@@ -0,0 +1,275 @@
+# encoding: utf-8
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+
+import reconcileState
+
+'''
+clusterConfiguration: The group, version, namespace, plural and name of the ks-installer ClusterConfiguration.
+watchTimeout: Seconds a watch of the ClusterConfiguration is kept open before it is renewed.
+retryDelay: Seconds waited before the watch is started again after an error.
+'''
+clusterConfiguration = ('installer.kubesphere.io', 'v1alpha1', 'kubesphere-system', 'clusterconfigurations', 'ks-installer')
+watchTimeout = 300
+retryDelay = 5
+
+
+class Waiter():
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.rc = None
+
+
+class ReconcileDaemon():
+    '''
+    Run reconciles in a resident process, keeping the imported libraries, the
+    API clients and the Ansible workers between them. A reconcile is
+    requested by a change of the spec of the ClusterConfiguration, seen by
+    watch(), or by a hook invocation over the socket, see forward(). The
+    requests of a burst are coalesced: the reconcile starts window seconds
+    after the last of them, and at the latest maxDelay seconds after the
+    first. Requests arriving during a reconcile are served by the next one.
+    '''
+
+    def __init__(self, reconcile, socketPath, window=5, maxDelay=60):
+        '''
+        :param reconcile: Runs one reconcile and returns the digest of the spec it covers, None if it is unknown
+        :param socketPath: The unix socket the hook invocations are forwarded to
+        :param window: Seconds without a new request before the reconcile starts
+        :param maxDelay: Seconds a request waits at most while new requests keep coming
+        '''
+        self.reconcile = reconcile
+        self.socketPath = socketPath
+        self.window = window
+        self.maxDelay = maxDelay
+        self.reconciledSpec = None
+        self._pending = False
+        self._first = None
+        self._last = None
+        self._spec = None
+        self._waiters = []
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    def request(self, spec=None):
+        '''
+        Ask for a reconcile, returns a Waiter told about its return code.
+        :param spec: The digest of the spec seen by the watch, None for a hook invocation
+        '''
+        waiter = Waiter()
+        with self._lock:
+            now = time.time()
+            if not self._pending:
+                self._first = now
+            self._pending = True
+            self._last = now
+            if spec is not None:
+                self._spec = spec
+            else:
+                self._waiters.append(waiter)
+            self._changed.notify()
+        return waiter
+
+    def run(self):
+        '''
+        Serve the requests until the process is interrupted. The reconciles run
+        in another thread: ansible_runner replaces the signal handlers when it
+        is called from the main thread.
+        '''
+        self._serve()
+        thread = threading.Thread(target=self._loop, daemon=True)
+        thread.start()
+        try:
+            while thread.is_alive():
+                thread.join(1)
+        finally:
+            # Hook invocations fall back to reconciling on their own
+            os.remove(self.socketPath)
+
+    def _loop(self):
+        while True:
+            with self._lock:
+                while not self._pending or time.time() < self._due():
+                    self._changed.wait(None if not self._pending else max(0.0, self._due() - time.time()))
+                waiters, self._waiters = self._waiters, []
+                spec, self._spec = self._spec, None
+                self._pending = False
+            # The watch also sees the spec migrated by the last reconcile
+            if not waiters and spec is not None and spec == self.reconciledSpec:
+                continue
+
+            rc = self._reconcile()
+            for waiter in waiters:
+                waiter.rc = rc
+                waiter.done.set()
+
+    def _due(self):
+        return min(self._last + self.window, self._first + self.maxDelay)
+
+    def _reconcile(self):
+        logging.info('*' * 50)
+        logging.info('Reconciling the cluster configuration ...')
+        try:
+            # None: a change seen during the reconcile is left to the next one
+            self.reconciledSpec = self.reconcile()
+            return 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                return e.code or 0
+            logging.info(e.code)
+            return 1
+        except Exception:
+            logging.info(traceback.format_exc())
+            return 1
+
+    def _serve(self):
+        if os.path.exists(self.socketPath):
+            os.remove(self.socketPath)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.socketPath)
+        os.chmod(self.socketPath, 0o600)
+        listener.listen(16)
+        threading.Thread(target=self._accept, args=(listener,), daemon=True).start()
+
+    def _accept(self, listener):
+        while True:
+            conn, _ = listener.accept()
+            threading.Thread(target=self._answer, args=(conn,), daemon=True).start()
+
+    def _answer(self, conn):
+        try:
+            with conn:
+                request = json.loads(conn.makefile('rb').readline() or b'{}')
+                if not request.get('reconcile'):
+                    return
+                waiter = self.request()
+                waiter.done.wait()
+                conn.sendall(json.dumps({'rc': waiter.rc}).encode('utf-8') + b'\n')
+        except (OSError, ValueError):
+            pass
+
+    def watch(self, specWatch):
+        '''
+        Request a reconcile whenever specWatch sees a new spec.
+        '''
+        specWatch.attach(lambda spec, digest: self.request(digest))
+        specWatch.start()
+
+
+class SpecWatch():
+    '''
+    Watch the ks-installer ClusterConfiguration and call the attached
+    listeners with its spec and the digest of it whenever the spec changes,
+    like the hook registered with shell-operator. The first list counts as a
+    change. Changes of the status or the metadata only are left out.
+    '''
+
+    def __init__(self):
+        self.spec = None
+        self.digest = None
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def attach(self, listener):
+        with self._lock:
+            if listener not in self._listeners:
+                self._listeners.append(listener)
+
+    def detach(self, listener):
+        with self._lock:
+            try:
+                self._listeners.remove(listener)
+            except ValueError:
+                pass
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._watch, daemon=True)
+            self._thread.start()
+
+    def _watch(self):
+        from kubernetes import client, watch
+        from kubernetes.client.rest import ApiException
+
+        group, version, namespace, plural, name = clusterConfiguration
+        api = client.CustomObjectsApi()
+        selector = 'metadata.name={}'.format(name)
+        listed = False
+        resourceVersion = None
+        while True:
+            try:
+                if not listed:
+                    listing = api.list_namespaced_custom_object(
+                        group, version, namespace, plural, field_selector=selector)
+                    resourceVersion = (listing.get('metadata') or {}).get('resourceVersion')
+                    listed = True
+                    for item in listing.get('items') or []:
+                        self._seen(item)
+                started = time.time()
+                for event in watch.Watch().stream(
+                        api.list_namespaced_custom_object, group, version, namespace, plural,
+                        field_selector=selector, resource_version=resourceVersion,
+                        timeout_seconds=watchTimeout):
+                    if event['type'] == 'ERROR':
+                        listed = False
+                        break
+                    resourceVersion = event['object']['metadata']['resourceVersion']
+                    if event['type'] in ('ADDED', 'MODIFIED'):
+                        self._seen(event['object'])
+                else:
+                    # A watch closed right away, e.g. by a proxy, is not renewed in a busy loop
+                    if time.time() - started < 1:
+                        time.sleep(retryDelay)
+            except ApiException as e:
+                # 410 Gone: the resource version is too old, list again right away
+                if e.status != 410:
+                    logging.info("Failed to watch the cluster configuration: {}".format(e.reason))
+                    time.sleep(retryDelay)
+                listed = False
+            except Exception as e:
+                logging.info("Failed to watch the cluster configuration: {}".format(e))
+                time.sleep(retryDelay)
+                listed = False
+
+    def _seen(self, item):
+        spec = item.get('spec') or {}
+        digest = reconcileState.digest(spec)
+        if digest == self.digest:
+            return
+        self.spec, self.digest = spec, digest
+        with self._lock:
+            listeners = list(self._listeners)
+        for listener in listeners:
+            try:
+                listener(spec, digest)
+            except Exception:
+                logging.info(traceback.format_exc())
+
+
+def forward(socketPath):
+    '''
+    Hand a hook invocation to a running daemon and return the return code of
+    the reconcile serving it, or None when no daemon listens on socketPath.
+    '''
+    if not os.path.exists(socketPath):
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socketPath)
+        conn.sendall(b'{"reconcile": true}\n')
+        line = conn.makefile('rb').readline()
+    except OSError:
+        return None
+    finally:
+        conn.close()
+    if not line:
+        return 1
+    return json.loads(line)['rc']
@@ -0,0 +1,281 @@
+# encoding: utf-8
+
+import hashlib
+import json
+import logging
+import os
+import time
+
+import yaml
+
+'''
+fingerprintVersion: Bump when the fingerprint layout changes, so that stale records are ignored.
+configMapKey: Key of the ConfigMap data holding the fingerprints.
+pluginDirs: The folders next to the playbooks holding the modules and action plugins every playbook may use.
+'''
+fingerprintVersion = 1
+configMapKey = 'fingerprints.json'
+pluginDirs = ('action_plugins', 'library')
+
+
+def lookup(spec, path):
+    value = spec
+    for key in path.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+def digest(value):
+    return hashlib.sha256(
+        json.dumps(value, sort_keys=True, default=str).encode('utf-8')
+    ).hexdigest()
+
+
+def hashTree(sha, folder):
+    '''
+    Add the paths and contents of the files under folder to sha, in a stable
+    order. Compiled Python files are left out, they change with the interpreter.
+    '''
+    for root, dirs, files in os.walk(folder):
+        dirs[:] = sorted(d for d in dirs if d != '__pycache__')
+        for fileName in sorted(files):
+            if fileName.endswith('.pyc'):
+                continue
+            path = os.path.join(root, fileName)
+            sha.update(os.path.relpath(path, folder).encode('utf-8'))
+            with open(path, 'rb') as f:
+                sha.update(f.read())
+
+
+class RoleFingerprint():
+
+    def __init__(self, playbookBasePath, rolesPaths):
+        '''
+        :param playbookBasePath: The folder where the playbooks is located.
+        :param rolesPaths: The folders searched for roles, in the order Ansible searches them.
+        '''
+        self.playbookBasePath = playbookBasePath
+        self.rolesPaths = rolesPaths
+        self._roles = {}
+        self._plugins = None
+
+    def playbook(self, name):
+        path = os.path.join(self.playbookBasePath, name + '.yaml')
+        if not os.path.exists(path):
+            return None
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            content = f.read()
+        sha.update(content)
+
+        roles = []
+        for play in yaml.safe_load(content) or []:
+            for role in play.get('roles') or []:
+                roles.append(role['role'] if isinstance(role, dict) else role)
+        seen = set()
+        for role in roles:
+            self._walkRole(role, seen)
+        for role in sorted(seen):
+            sha.update(role.encode('utf-8'))
+            sha.update(self.role(role).encode('utf-8'))
+        sha.update(self.plugins().encode('utf-8'))
+        return sha.hexdigest()
+
+    def role(self, name):
+        if name not in self._roles:
+            sha = hashlib.sha256()
+            roleDir = self._roleDir(name)
+            if roleDir is not None:
+                hashTree(sha, roleDir)
+            self._roles[name] = sha.hexdigest()
+        return self._roles[name]
+
+    def plugins(self):
+        if self._plugins is None:
+            sha = hashlib.sha256()
+            for pluginDir in pluginDirs:
+                sha.update(pluginDir.encode('utf-8'))
+                hashTree(sha, os.path.join(self.playbookBasePath, pluginDir))
+            self._plugins = sha.hexdigest()
+        return self._plugins
+
+    def _walkRole(self, name, seen):
+        if name in seen:
+            return
+        seen.add(name)
+        roleDir = self._roleDir(name)
+        if roleDir is None:
+            return
+        for meta in ['main.yaml', 'main.yml']:
+            metaFile = os.path.join(roleDir, 'meta', meta)
+            if os.path.exists(metaFile):
+                with open(metaFile, 'r') as f:
+                    dependencies = (yaml.safe_load(f) or {}).get('dependencies') or []
+                for dependency in dependencies:
+                    self._walkRole(
+                        dependency['role'] if isinstance(dependency, dict) else dependency, seen)
+
+    def _roleDir(self, name):
+        for rolesPath in self.rolesPaths:
+            roleDir = os.path.join(rolesPath, name)
+            if os.path.isdir(roleDir):
+                return roleDir
+        return None
+
+
+def fingerprints(names, graph, spec, roleFingerprint):
+    '''
+    Compute the fingerprints of the given playbooks.
+
+    "config" covers the spec paths declared for the playbook in the dependency
+    graph, "code" covers the playbook and role files plus the spec keys which no
+    playbook declares, since those may be read by any of them.
+    '''
+    claimed = set()
+    for node in graph.nodes.values():
+        for path in (node or {}).get('config') or []:
+            claimed.add(path.split('.')[0])
+    shared = {key: value for key, value in spec.items() if key not in claimed}
+
+    result = {}
+    for name in names:
+        paths = graph.config(name)
+        if paths is None:
+            config = spec
+        else:
+            config = {path: lookup(spec, path) for path in paths}
+        result[name] = {
+            'config': digest(config),
+            'code': digest([roleFingerprint.playbook(name), shared]),
+        }
+    return result
+
+
+class FingerprintStore():
+    '''
+    The journal of the playbooks completed with the current fingerprints. A
+    playbook is marked incomplete when a run starts it, and recorded as soon
+    as it succeeds, so a run interrupted halfway resumes from the playbooks it
+    had not completed. The records are saved to a file, and to a ConfigMap
+    when one is given, which outlives the installer pod.
+    '''
+
+    def __init__(self, path, configMap=None):
+        '''
+        :param path: The file holding the fingerprints of the last successful run of each playbook.
+        :param configMap: The namespace and name of the ConfigMap keeping a copy of the file.
+        '''
+        self.path = path
+        self.configMap = configMap
+        self.records = {}
+        saved = None
+        for content in (self._readFile(), self._readConfigMap()):
+            if content is None or content.get('version') != fingerprintVersion:
+                continue
+            # The newer copy wins, e.g. the ConfigMap after the pod was replaced
+            if saved is None or content.get('saved', 0) > saved:
+                saved = content.get('saved', 0)
+                self.records = content.get('playbooks', {})
+
+    def changed(self, current):
+        '''
+        Split the playbooks whose fingerprints differ from the last successful run
+        into those whose own config changed and those whose code or shared config changed.
+        '''
+        configChanged, codeChanged = set(), set()
+        for name, fingerprint in current.items():
+            record = self.records.get(name)
+            if record is None or record.get('code') != fingerprint['code']:
+                codeChanged.add(name)
+            elif record.get('config') != fingerprint['config']:
+                configChanged.add(name)
+        return configChanged, codeChanged
+
+    def begin(self, names):
+        '''
+        Mark the playbooks of a run incomplete before any of them starts. Their
+        code fingerprints are kept, so the playbooks depending on them are only
+        run again when they were already part of the interrupted run.
+        '''
+        for name in names:
+            if name in self.records:
+                self.records[name] = dict(self.records[name], config=None)
+        self.save()
+
+    def record(self, name, fingerprint, rc):
+        '''
+        :param rc: The return code of the playbook, None when it is started again
+        '''
+        if rc is None:
+            self.begin([name])
+            return
+        self.update({name: fingerprint}, {name: rc})
+        self.save()
+
+    def update(self, current, results):
+        for name, rc in results.items():
+            if rc == 0 and name in current:
+                self.records[name] = current[name]
+            else:
+                self.records.pop(name, None)
+
+    def save(self):
+        content = {"version": fingerprintVersion, "saved": time.time(), "playbooks": self.records}
+        tmpFile = self.path + '.tmp'
+        try:
+            with open(tmpFile, 'w', encoding='utf-8') as f:
+                json.dump(content, f, ensure_ascii=False, indent=4)
+            os.replace(tmpFile, self.path)
+        except (IOError, OSError) as e:
+            logging.info("Failed to save playbook fingerprints: {}".format(e))
+        if self.configMap is not None:
+            try:
+                self._writeConfigMap(json.dumps(content, sort_keys=True))
+            except Exception as e:
+                logging.info("Failed to save playbook fingerprints to ConfigMap {}: {}".format(
+                    '/'.join(self.configMap), e))
+
+    def _readFile(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _readConfigMap(self):
+        if self.configMap is None:
+            return None
+        from kubernetes import client
+        from kubernetes.client.rest import ApiException
+
+        namespace, name = self.configMap
+        try:
+            configMap = client.CoreV1Api().read_namespaced_config_map(name, namespace)
+            return json.loads((configMap.data or {}).get(configMapKey) or 'null')
+        except ApiException as e:
+            if e.status != 404:
+                logging.info("Failed to read playbook fingerprints from ConfigMap {}: {}".format(
+                    '/'.join(self.configMap), e.reason))
+        except ValueError:
+            pass
+        return None
+
+    def _writeConfigMap(self, text):
+        from kubernetes import client
+        from kubernetes.client.rest import ApiException
+
+        namespace, name = self.configMap
+        api = client.CoreV1Api()
+        try:
+            api.patch_namespaced_config_map(name, namespace, {'data': {configMapKey: text}})
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            api.create_namespaced_config_map(namespace, {
+                'apiVersion': 'v1',
+                'kind': 'ConfigMap',
+                'metadata': {'name': name, 'namespace': namespace},
+                'data': {configMapKey: text},
+            })
@@ -0,0 +1,87 @@
+# encoding: utf-8
+
+import collections
+import json
+
+'''
+failedEvents: The runner events reporting a failed task.
+'''
+failedEvents = ('runner_on_failed', 'runner_on_unreachable', 'runner_item_on_failed')
+
+
+class EventStream():
+    '''
+    Fan the events of every ansible_runner run out to the attached handlers.
+    A handler is an object with a handle(taskName, event) method, returning
+    False from it keeps ansible_runner from writing the event to job_events.
+    Handlers that also define status(taskName, status) are told about the
+    status changes of the run, e.g. running, successful or failed.
+    '''
+
+    def __init__(self):
+        self._handlers = []
+
+    def attach(self, handler):
+        if handler not in self._handlers:
+            self._handlers.append(handler)
+
+    def detach(self, handler):
+        try:
+            self._handlers.remove(handler)
+        except ValueError:
+            pass
+
+    def handler(self, taskName):
+        def handle(event):
+            write = True
+            for handler in list(self._handlers):
+                if handler.handle(taskName, event) is False:
+                    write = False
+            return write
+        return handle
+
+    def statusHandler(self, taskName):
+        def handle(statusData, runner_config=None):
+            for handler in list(self._handlers):
+                if hasattr(handler, 'status'):
+                    handler.status(taskName, statusData.get('status'))
+        return handle
+
+
+def failureRecord(event):
+    '''
+    The details of a failed task event, or None for any other event and for
+    failures ignored by the task.
+    '''
+    if event.get('event') not in failedEvents:
+        return None
+    eventData = event.get('event_data') or {}
+    if eventData.get('ignore_errors'):
+        return None
+
+    res = eventData.get('res') or {}
+    return collections.OrderedDict([
+        ('event', event.get('event')),
+        ('task', eventData.get('task')),
+        ('role', eventData.get('role')),
+        ('host', eventData.get('host')),
+        ('taskPath', eventData.get('task_path')),
+        ('msg', res.get('msg')),
+        ('cmd', res.get('cmd')),
+        ('rc', res.get('rc')),
+        ('stderr', res.get('stderr')),
+        ('stdout', res.get('stdout')),
+    ])
+
+
+def failureSummary(failures, size=10):
+    '''
+    The last size failures as indented JSON, without their empty fields.
+    '''
+    if not failures:
+        return None
+    return json.dumps(
+        [{key: value for key, value in failure.items() if value not in (None, '')}
+         for failure in failures[-size:]],
+        indent=2
+    )
@@ -0,0 +1,307 @@
+# encoding: utf-8
+
+import heapq
+import logging
+import queue
+import threading
+
+import yaml
+
+'''
+defaultDependency: Prerequisite of the components which are not declared in the dependency graph.
+'''
+defaultDependency = 'ks-core'
+
+
+class TaskGraph():
+
+    def __init__(self, nodes):
+        '''
+        :param nodes: Mapping of playbook name to its declaration, e.g. {"after": [...], "weight": 1, "required": False}
+        '''
+        self.nodes = nodes
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            nodes = yaml.safe_load(f) or {}
+        return cls(nodes)
+
+    def after(self, name):
+        if name in self.nodes:
+            return list(self.nodes[name].get('after') or [])
+        return [defaultDependency] if name != defaultDependency else []
+
+    def weight(self, name):
+        return (self.nodes.get(name) or {}).get('weight', 1)
+
+    def required(self, name):
+        return bool((self.nodes.get(name) or {}).get('required', False))
+
+    def config(self, name):
+        if name in self.nodes:
+            return list((self.nodes[name] or {}).get('config') or [])
+        return None
+
+    def subgraph(self, names):
+        '''
+        Resolve the prerequisites and dependents of the given playbooks. A
+        prerequisite which is not part of the run is replaced by its own
+        prerequisites, so the run keeps the declared order.
+        '''
+        names = list(names)
+        enabled = set(names)
+        prerequisites = {}
+        dependents = {name: [] for name in names}
+        for name in names:
+            prerequisites[name] = self._resolve(name, enabled)
+            for dep in prerequisites[name]:
+                dependents[dep].append(name)
+
+        self._checkAcyclic(names, prerequisites)
+        return prerequisites, dependents
+
+    def affected(self, changed, names):
+        '''
+        The given changed playbooks together with every playbook of the run that
+        transitively depends on them.
+        '''
+        prerequisites, dependents = self.subgraph(names)
+        result = set()
+        pending = [name for name in changed if name in prerequisites]
+        while pending:
+            name = pending.pop()
+            if name not in result:
+                result.add(name)
+                pending.extend(dependents[name])
+        return result
+
+    def _resolve(self, name, enabled):
+        result, seen = [], set([name])
+        pending = self.after(name)
+        while pending:
+            dep = pending.pop(0)
+            if dep in seen:
+                continue
+            seen.add(dep)
+            if dep in enabled:
+                result.append(dep)
+            else:
+                pending.extend(self.after(dep))
+        return result
+
+    def criticalPath(self, names, dependents):
+        '''
+        Length of the longest weighted chain starting at each playbook.
+        '''
+        lengths = {}
+
+        def visit(name):
+            if name not in lengths:
+                lengths[name] = self.weight(name) + max(
+                    [visit(dep) for dep in dependents[name]] or [0]
+                )
+            return lengths[name]
+
+        for name in names:
+            visit(name)
+        return lengths
+
+    @staticmethod
+    def _checkAcyclic(names, prerequisites):
+        visiting, visited = set(), set()
+
+        def visit(name, path):
+            if name in visited:
+                return
+            if name in visiting:
+                raise ValueError(
+                    "Dependency cycle between playbooks: {}".format(' -> '.join(path + [name])))
+            visiting.add(name)
+            for dep in prerequisites[name]:
+                visit(dep, path + [name])
+            visiting.discard(name)
+            visited.add(name)
+
+        for name in names:
+            visit(name, [])
+
+
+class TaskScheduler():
+
+    def __init__(self, tasks, graph, concurrency, notify=None, record=None, admit=None):
+        '''
+        :param tasks: Ordered mapping of playbook name to component objects
+        :param graph: TaskGraph declaring the dependencies between the playbooks
+        :param concurrency: Maximum number of playbooks running at the same time
+        :param notify: Called with a message whenever a task changes state
+        :param record: Called with the name and return code of each finished task, and with None as return code when a finished task is restarted
+        :param admit: Called with the name of the next task and the names of the running ones, returning False holds it back until later
+        '''
+        self.tasks = tasks
+        self.graph = graph
+        self.concurrency = max(1, int(concurrency))
+        self.notify = notify or logging.info
+        self.record = record
+        self.admit = admit
+        self.prerequisites, self.dependents = graph.subgraph(tasks.keys())
+        self.priority = graph.criticalPath(tasks.keys(), self.dependents)
+        self.results = {}
+        self.skipped = set()
+        self._events = queue.Queue()
+        self._lock = threading.Lock()
+        self._open = True
+
+    def restart(self, names, before=None):
+        '''
+        Run the given tasks and their dependents again, e.g. after their inputs
+        changed during the run: running ones are canceled, finished ones are
+        queued again once their prerequisites have succeeded. Returns False when
+        the run is already over.
+        :param before: Called first, while the run can not end, e.g. to write the inputs of the restarted tasks
+        '''
+        with self._lock:
+            if not self._open:
+                return False
+            if before is not None:
+                before()
+            self._events.put(('restart', set(names)))
+            return True
+
+    def run(self):
+        '''
+        Run every task once its prerequisites have succeeded and return a mapping
+        of playbook name to return code. Tasks behind a failed prerequisite are
+        skipped and reported with return code -1.
+        '''
+        remaining = {name: len(deps) for name, deps in self.prerequisites.items()}
+        ready = []
+        queued = set()
+        running = {}
+        restarting = set()
+        order = {name: index for index, name in enumerate(self.tasks)}
+
+        def push(name):
+            if name not in queued:
+                queued.add(name)
+                heapq.heappush(ready, (-self.priority[name], order[name], name))
+
+        for name, count in remaining.items():
+            if count == 0:
+                push(name)
+
+        while True:
+            held = False
+            while ready and len(running) < self.concurrency:
+                _, _, name = ready[0]
+                # Entries left behind by a restart
+                if name in running or name in self.results or remaining[name] != 0:
+                    heapq.heappop(ready)
+                    queued.discard(name)
+                    continue
+                if self.admit is not None and not self.admit(name, list(running)):
+                    held = True
+                    break
+                heapq.heappop(ready)
+                queued.discard(name)
+                taskObject = self.tasks[name]
+                taskObject.finished_callback = (
+                    lambda runner, name=name: self._events.put(('finished', name))
+                )
+                self.notify("Start installing {}".format(name))
+                running[name] = taskObject.installRunner()
+
+            if not running and not ready:
+                with self._lock:
+                    if self._events.empty():
+                        self._open = False
+                        break
+
+            try:
+                # A held task is admitted again once the running tasks leave room
+                events = [self._events.get(timeout=5 if held else 60)]
+            except queue.Empty:
+                # A runner thread that died before invoking finished_callback
+                # would otherwise block us forever
+                events = [
+                    ('finished', name) for name in running
+                    if not self.tasks[name].thread.is_alive()
+                ]
+
+            for event, value in events:
+                if event == 'restart':
+                    self._restart(value, remaining, running, restarting, push)
+                    continue
+
+                name = value
+                if name not in running:
+                    continue
+                taskRunner = running.pop(name)
+                if name in restarting:
+                    restarting.discard(name)
+                    if remaining[name] == 0:
+                        push(name)
+                    continue
+                rc = taskRunner.rc if taskRunner.rc is not None else 1
+                self.results[name] = rc
+                if self.record is not None:
+                    self.record(name, rc)
+                self.notify("task {} status is {}  ({}/{})".format(
+                    name,
+                    taskRunner.status,
+                    len(self.results),
+                    len(self.tasks)
+                ))
+
+                for dependent in self.dependents[name]:
+                    if rc != 0:
+                        self._skip(dependent, name)
+                        continue
+                    if dependent in self.skipped:
+                        continue
+                    remaining[dependent] -= 1
+                    if remaining[dependent] == 0:
+                        push(dependent)
+
+        return {name: self.results[name] for name in self.tasks}
+
+    def _restart(self, names, remaining, running, restarting, push):
+        affected = set()
+        pending = [name for name in names if name in self.prerequisites]
+        while pending:
+            name = pending.pop()
+            if name not in affected:
+                affected.add(name)
+                pending.extend(self.dependents[name])
+
+        for name in affected:
+            if self.results.pop(name, None) is not None and self.record is not None:
+                self.record(name, None)
+            self.skipped.discard(name)
+        for name in sorted(affected, key=list(self.tasks).index):
+            if name in running and name not in restarting:
+                restarting.add(name)
+                self.tasks[name].canceled = True
+                self.notify("task {} canceled, its configuration changed".format(name))
+            # The prerequisites outside the restart keep their results
+            remaining[name] = 0
+            failed = None
+            for dep in self.prerequisites[name]:
+                if dep in affected or dep not in self.results:
+                    remaining[name] += 1
+                elif self.results[dep] != 0:
+                    failed = dep
+            if failed is not None:
+                self._skip(name, failed)
+            elif remaining[name] == 0 and name not in running:
+                push(name)
+
+    def _skip(self, name, cause):
+        if name in self.skipped:
+            return
+        self.skipped.add(name)
+        self.results[name] = -1
+        self.notify("task {} skipped, prerequisite {} failed  ({}/{})".format(
+            name, cause, len(self.results), len(self.tasks)))
+        for dependent in self.dependents[name]:
+            self._skip(dependent, cause)
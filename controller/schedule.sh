@@ -14,7 +14,10 @@ if [[ $1 == "--config" ]] ; then
 }
 EOF
 else
-  ansible-playbook /kubesphere/playbooks/telemetry.yaml -e @/kubesphere/config/ks-config.json
+  # telemetry reads cluster_facts, refreshed here as the nodes may have changed since the last reconcile
+  python3 "$(dirname "$0")/lib/clusterFacts.py" --output /kubesphere/config/ks-facts.json
+  ansible-playbook /kubesphere/playbooks/telemetry.yaml -e @/kubesphere/config/ks-config.json \
+    -e @/kubesphere/config/ks-facts.json
   if [[ $? -eq 0 ]]; then
     #statements
     str="successsful!"
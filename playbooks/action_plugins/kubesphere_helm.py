@@ -0,0 +1,213 @@
+# encoding: utf-8
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import hashlib
+import json
+import os
+import shlex
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from ansible.errors import AnsibleActionFail
+from ansible.module_utils._text import to_native
+from ansible.module_utils.parsing.convert_bool import boolean
+from ansible.plugins.action import ActionBase
+
+'''
+digestAnnotation: Annotation of the release Secret holding the digest of the inputs the release was installed with.
+metadataAccept: Asks the API server for the metadata of the release Secrets only, not the release they store.
+releaseKeys: The arguments describing one release, given directly for a single release or in a list as releases.
+'''
+digestAnnotation = 'installer.kubesphere.io/helm-digest'
+metadataAccept = 'application/json;as=PartialObjectMetadataList;g=meta.k8s.io;v=v1,application/json'
+releaseKeys = ('name', 'chart', 'namespace', 'values', 'set', 'extra_args', 'force')
+
+
+def newMetadataApi():
+    from kubernetes import client, config
+    from kubernetes.config.config_exception import ConfigException
+
+    # A KUBECONFIG names another cluster than the one the controller runs in, e.g. in fleet mode
+    if os.environ.get('KUBECONFIG'):
+        config.load_kube_config()
+    else:
+        try:
+            config.load_incluster_config()
+        except ConfigException:
+            config.load_kube_config()
+    apiClient = client.ApiClient()
+    apiClient.set_default_header('Accept', metadataAccept)
+    return client.CoreV1Api(apiClient)
+
+
+def hashPath(sha, path):
+    '''
+    Hash a chart archive, or every file of a chart folder together with its
+    path relative to the chart.
+    '''
+    if not os.path.isdir(path):
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 16), b''):
+                sha.update(block)
+        return
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            filePath = os.path.join(root, name)
+            sha.update(os.path.relpath(filePath, path).encode('utf-8') + b'\0')
+            hashPath(sha, filePath)
+            sha.update(b'\0')
+
+
+def releaseDigest(release):
+    '''
+    The digest of everything helm upgrade renders a release from: the chart,
+    the content of the values files, the --set values and the other arguments.
+    '''
+    sha = hashlib.sha256()
+    sha.update(json.dumps([release['name'], release['namespace'], release['set'], release['args']],
+                          sort_keys=True).encode('utf-8'))
+    hashPath(sha, release['chart'])
+    for values in release['values']:
+        sha.update(b'\0')
+        hashPath(sha, values)
+    return sha.hexdigest()
+
+
+def toList(value):
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return shlex.split(value)
+    return list(value)
+
+
+class ActionModule(ActionBase):
+    '''
+    Install or upgrade Helm releases, skipping every release whose chart and
+    values have not changed since its deployed revision. The digest of the
+    inputs is kept as an annotation of the release Secret, so an unchanged
+    release costs a single list call instead of a render, a new revision
+    Secret and a wait. Independent releases of one task are installed
+    concurrently. Supported states are present and check, which only reports
+    the releases that would be upgraded.
+    '''
+
+    TRANSFERS_FILES = False
+    _VALID_ARGS = frozenset(('state', 'releases', 'concurrency', 'binary') + releaseKeys)
+
+    def run(self, tmp=None, task_vars=None):
+        result = super(ActionModule, self).run(tmp, task_vars)
+        args = self._task.args
+        task_vars = task_vars or {}
+        state = args.get('state', 'present')
+        self.binary = args.get('binary') or os.path.join(task_vars.get('bin_dir', '/usr/local/bin'), 'helm')
+
+        releases = [self._release(spec) for spec in (args.get('releases') or [args])]
+        if not releases:
+            result.update(changed=False, results=[])
+            return result
+
+        try:
+            self.api = newMetadataApi()
+            for release in releases:
+                release['digest'] = releaseDigest(release)
+                release['deployed'] = self._deployedDigest(release)
+                release['pending'] = release['force'] or release['deployed'] != release['digest']
+
+            if state == 'check':
+                pending = [release['name'] for release in releases if release['pending']]
+                result.update(changed=False, upgrade=bool(pending), pending=pending)
+                return result
+            if state != 'present':
+                raise AnsibleActionFail("Unsupported state: {}".format(state))
+
+            concurrency = int(args.get('concurrency', 4))
+            with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(releases)))) as executor:
+                results = list(executor.map(self._upgrade, releases))
+        except AnsibleActionFail:
+            raise
+        except Exception as e:
+            raise AnsibleActionFail("helm {} failed: {}".format(state, to_native(e)))
+
+        failed = [r for r in results if r['rc'] != 0]
+        result.update(
+            changed=any(not r['skipped'] for r in results),
+            results=results,
+            rc=max(r['rc'] for r in results),
+            stdout='\n'.join(r['stdout'] for r in results if r['stdout']),
+            stderr='\n'.join(r['stderr'] for r in results if r['stderr']),
+        )
+        result['stdout_lines'] = result['stdout'].splitlines()
+        result['stderr_lines'] = result['stderr'].splitlines()
+        if failed:
+            result['failed'] = True
+            result['msg'] = 'helm upgrade failed for {}'.format(', '.join(r['name'] for r in failed))
+        return result
+
+    def _release(self, spec):
+        for key in ('name', 'chart', 'namespace'):
+            if not spec.get(key):
+                raise AnsibleActionFail("A release needs {}".format(key))
+        values = spec.get('set') or {}
+        if not isinstance(values, dict):
+            raise AnsibleActionFail("set of release {} has to be a mapping".format(spec['name']))
+        return {
+            'name': spec['name'],
+            'chart': spec['chart'],
+            'namespace': spec['namespace'],
+            'values': toList(spec.get('values')),
+            'set': dict((key, str(value)) for key, value in values.items()),
+            'args': toList(spec.get('extra_args')),
+            'force': boolean(spec.get('force', False)),
+        }
+
+    def _deployedSecret(self, release):
+        '''
+        The metadata of the Secret of the deployed revision of a release.
+        '''
+        selector = 'owner=helm,name={},status=deployed'.format(release['name'])
+        response = self.api.list_namespaced_secret(
+            release['namespace'], label_selector=selector, _preload_content=False)
+        items = [item.get('metadata') or {} for item in json.loads(response.read().decode('utf-8')).get('items') or []]
+        if not items:
+            return None
+        return max(items, key=lambda metadata: int((metadata.get('labels') or {}).get('version', 0)))
+
+    def _deployedDigest(self, release):
+        metadata = self._deployedSecret(release)
+        if metadata is None:
+            return None
+        return (metadata.get('annotations') or {}).get(digestAnnotation)
+
+    def _upgrade(self, release):
+        result = {'name': release['name'], 'namespace': release['namespace'], 'digest': release['digest']}
+        if not release['pending']:
+            result.update(skipped=True, rc=0, stdout='', stderr='')
+            return result
+
+        command = [self.binary, 'upgrade', '--install', release['name'], release['chart'],
+                   '--namespace', release['namespace']]
+        for values in release['values']:
+            command.extend(['-f', values])
+        for key, value in sorted(release['set'].items()):
+            command.extend(['--set', '{}={}'.format(key, value)])
+        command.extend(release['args'])
+
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+        result.update(skipped=False, rc=process.returncode, cmd=command,
+                      stdout=to_native(stdout).rstrip('\n'), stderr=to_native(stderr).rstrip('\n'))
+        if process.returncode == 0:
+            metadata = self._deployedSecret(release)
+            if metadata is not None:
+                # A JSON patch, the content type every client version sends for a list body
+                if metadata.get('annotations'):
+                    patch = [{'op': 'add', 'value': release['digest'],
+                              'path': '/metadata/annotations/' + digestAnnotation.replace('~', '~0').replace('/', '~1')}]
+                else:
+                    patch = [{'op': 'add', 'path': '/metadata/annotations', 'value': {digestAnnotation: release['digest']}}]
+                self.api.patch_namespaced_secret(metadata['name'], release['namespace'], patch, _preload_content=False)
+        return result
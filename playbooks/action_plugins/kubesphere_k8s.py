@@ -0,0 +1,581 @@
+# encoding: utf-8
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+from ansible.errors import AnsibleActionFail
+from ansible.module_utils._text import to_native
+from ansible.module_utils.parsing.convert_bool import boolean
+from ansible.plugins.action import ActionBase
+
+'''
+Ansible forks a worker for every task, so nothing survives in memory between
+tasks. The discovery document and the objects read during a playbook run are
+therefore cached on disk, in KS_K8S_CACHE_DIR or in a directory keyed by the
+ansible-playbook process. Every write through this plugin invalidates the
+cached copies of the object it touched.
+'''
+fieldManager = 'ks-installer'
+
+'''
+applyFirst: Kinds applied before all other objects of an apply, in this order, as the other objects may be
+            created in their namespaces or be instances of their kinds.
+'''
+applyFirst = ('Namespace', 'CustomResourceDefinition')
+
+'''
+clientSideManager: The field manager of kubectl apply without --server-side. The fields it owns on an object applied
+                   before are handed over to fieldManager, so that server-side apply prunes them once they are
+                   dropped from the manifests, as kubectl apply did.
+recreateTimeout: Seconds an object whose immutable fields changed is waited for to be deleted before it is created again.
+'''
+clientSideManager = 'kubectl-client-side-apply'
+recreateTimeout = 120
+
+
+class ManifestLoader(getattr(yaml, 'CSafeLoader', yaml.SafeLoader)):
+    '''
+    Loads manifests like kubectl, which reads a plain = as a string.
+    '''
+
+
+ManifestLoader.yaml_implicit_resolvers = dict(
+    (first, [(tag, regexp) for tag, regexp in resolvers if tag != 'tag:yaml.org,2002:value'])
+    for first, resolvers in yaml.SafeLoader.yaml_implicit_resolvers.items())
+
+
+def cacheDir():
+    path = os.environ.get('KS_K8S_CACHE_DIR') or os.path.join(
+        tempfile.gettempdir(), 'kubesphere-k8s-{}'.format(os.getppid()))
+    if not os.path.isdir(path):
+        os.makedirs(path, exist_ok=True)
+    return path
+
+
+def newClient(poolSize=None):
+    from kubernetes import config
+    from kubernetes.client import ApiClient, Configuration
+    from kubernetes.config.config_exception import ConfigException
+    from kubernetes.dynamic import DynamicClient
+
+    # A KUBECONFIG names another cluster than the one the controller runs in, e.g. in fleet mode
+    if os.environ.get('KUBECONFIG'):
+        config.load_kube_config()
+    else:
+        try:
+            config.load_incluster_config()
+        except ConfigException:
+            config.load_kube_config()
+    configuration = Configuration.get_default_copy()
+    if poolSize:
+        configuration.connection_pool_maxsize = poolSize
+    return DynamicClient(ApiClient(configuration), cache_file=os.path.join(cacheDir(), 'discovery.json'))
+
+
+def splitJsonpath(expr):
+    expr = expr.strip()
+    if expr.startswith('{') and expr.endswith('}'):
+        expr = expr[1:-1]
+    keys = []
+    for token in re.findall(r"\[(?:'([^']*)'|(\d+))\]|((?:\\\.|[^.\[])+)", expr):
+        quoted, index, plain = token
+        if index:
+            keys.append(int(index))
+        elif quoted or plain:
+            keys.append((quoted or plain).replace('\\.', '.'))
+    return keys
+
+
+def jsonpath(obj, expr):
+    '''
+    Resolve the subset of kubectl's JSONPath used by the roles, e.g.
+    "{.data.kubesphere\\.yaml}" or "{.spec.ports[0].nodePort}".
+    '''
+    for key in splitJsonpath(expr):
+        if isinstance(key, int):
+            if not isinstance(obj, list) or key >= len(obj):
+                return None
+        elif not isinstance(obj, dict) or key not in obj:
+            return None
+        obj = obj[key]
+    return obj
+
+
+def conditionStatus(obj, conditionType):
+    for condition in (obj.get('status') or {}).get('conditions') or []:
+        if condition.get('type') == conditionType:
+            return condition.get('status') == 'True'
+    return False
+
+
+def rolloutComplete(obj):
+    metadata, spec, status = obj['metadata'], obj.get('spec') or {}, obj.get('status') or {}
+    if status.get('observedGeneration', 0) < metadata.get('generation', 0):
+        return False
+    if obj['kind'] == 'DaemonSet':
+        desired = status.get('desiredNumberScheduled', 0)
+        return status.get('updatedNumberScheduled', 0) == desired and \
+            status.get('numberAvailable', 0) == desired
+    replicas = spec.get('replicas', 1)
+    if obj['kind'] == 'StatefulSet':
+        return status.get('readyReplicas', 0) == replicas and \
+            status.get('updateRevision') == status.get('currentRevision', status.get('updateRevision'))
+    return status.get('updatedReplicas', 0) == replicas and \
+        status.get('replicas', 0) == replicas and \
+        status.get('availableReplicas', 0) == replicas
+
+
+def jobComplete(obj):
+    if conditionStatus(obj, 'Failed'):
+        raise AnsibleActionFail("Job {} failed".format(obj['metadata']['name']))
+    return conditionStatus(obj, 'Complete')
+
+
+'''
+waitConditions: Checks of the conditions supported by state=wait, every watched object has to pass.
+'''
+waitConditions = {
+    'rollout': rolloutComplete,
+    'ready': lambda obj: conditionStatus(obj, 'Ready'),
+    'running': lambda obj: (obj.get('status') or {}).get('phase') in ('Running', 'Succeeded'),
+    'complete': jobComplete,
+    'established': lambda obj: conditionStatus(obj, 'Established'),
+}
+
+
+def toStdout(value):
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        return value
+    return json.dumps(value, sort_keys=True)
+
+
+def mergeFields(fields, other):
+    '''
+    The union of two managed fields sets in the FieldsV1 format.
+    '''
+    merged = dict(fields)
+    for key, value in other.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = mergeFields(merged[key], value)
+        else:
+            merged.setdefault(key, value)
+    return merged
+
+
+class ReadCache():
+
+    def __init__(self, path):
+        self.path = path
+
+    def _file(self, prefix, *key):
+        sha = hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, '{}-{}.json'.format(prefix, sha))
+
+    def _kindPrefix(self, apiVersion, kind):
+        return 'list-' + hashlib.sha1('{}/{}'.format(apiVersion, kind).encode('utf-8')).hexdigest()[:12]
+
+    def get(self, apiVersion, kind, namespace, name):
+        return self._read(self._file('obj', apiVersion, kind, namespace, name))
+
+    def put(self, apiVersion, kind, namespace, name, obj):
+        self._write(self._file('obj', apiVersion, kind, namespace, name), obj)
+
+    def getList(self, apiVersion, kind, namespace, labelSelector, fieldSelector):
+        return self._read(self._file(self._kindPrefix(apiVersion, kind),
+                                     namespace, labelSelector, fieldSelector))
+
+    def putList(self, apiVersion, kind, namespace, labelSelector, fieldSelector, items):
+        self._write(self._file(self._kindPrefix(apiVersion, kind),
+                               namespace, labelSelector, fieldSelector), items)
+
+    def invalidate(self, apiVersion, kind, namespace, name):
+        paths = [self._file('obj', apiVersion, kind, namespace, name)]
+        prefix = self._kindPrefix(apiVersion, kind)
+        paths.extend(os.path.join(self.path, f) for f in os.listdir(self.path) if f.startswith(prefix))
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _read(self, path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _write(self, path, obj):
+        fd, tmpFile = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(obj, f)
+        os.replace(tmpFile, path)
+
+
+class ActionModule(ActionBase):
+    '''
+    Read and write Kubernetes objects through the Python client instead of
+    forking kubectl. Supported states are get, list, patch, apply, absent and wait.
+    '''
+
+    TRANSFERS_FILES = False
+    _VALID_ARGS = frozenset((
+        'state', 'api_version', 'kind', 'name', 'namespace', 'jsonpath',
+        'label_selector', 'field_selector', 'patch', 'patch_type',
+        'definition', 'src', 'cache', 'condition', 'timeout', 'concurrency',
+    ))
+
+    def run(self, tmp=None, task_vars=None):
+        result = super(ActionModule, self).run(tmp, task_vars)
+        args = self._task.args
+        state = args.get('state', 'get')
+
+        try:
+            self.concurrency = max(1, int(args.get('concurrency', 8)))
+            self.client = newClient(self.concurrency)
+            self.cache = ReadCache(cacheDir())
+            if state == 'get':
+                result.update(self._get(args))
+            elif state == 'list':
+                result.update(self._list(args))
+            elif state == 'patch':
+                result.update(self._patch(args))
+            elif state == 'apply':
+                result.update(self._apply(args))
+            elif state == 'absent':
+                result.update(self._delete(args))
+            elif state == 'wait':
+                result.update(self._wait(args))
+            else:
+                raise AnsibleActionFail("Unsupported state: {}".format(state))
+        except AnsibleActionFail:
+            raise
+        except Exception as e:
+            raise AnsibleActionFail("{} {} failed: {}".format(
+                state, args.get('kind', ''), to_native(e)))
+        return result
+
+    def _resource(self, args):
+        return self.client.resources.get(
+            api_version=args.get('api_version', 'v1'), kind=args['kind'])
+
+    def _get(self, args):
+        from kubernetes.dynamic.exceptions import NotFoundError
+
+        apiVersion = args.get('api_version', 'v1')
+        key = (apiVersion, args['kind'], args.get('namespace'), args['name'])
+        obj = self.cache.get(*key) if boolean(args.get('cache', True)) else None
+        if obj is None:
+            try:
+                obj = self._resource(args).get(
+                    name=args['name'], namespace=args.get('namespace')).to_dict()
+            except NotFoundError:
+                obj = {}
+            self.cache.put(*key, obj)
+
+        value = jsonpath(obj, args['jsonpath']) if args.get('jsonpath') and obj else obj
+        stdout = toStdout(value) if obj else ''
+        return dict(changed=False, found=bool(obj), resource=obj,
+                    stdout=stdout, stdout_lines=stdout.splitlines())
+
+    def _list(self, args):
+        apiVersion = args.get('api_version', 'v1')
+        key = (apiVersion, args['kind'], args.get('namespace'),
+               args.get('label_selector'), args.get('field_selector'))
+        items = self.cache.getList(*key) if boolean(args.get('cache', True)) else None
+        if items is None:
+            items = self._resource(args).get(
+                namespace=args.get('namespace'),
+                label_selector=args.get('label_selector'),
+                field_selector=args.get('field_selector'),
+            ).to_dict().get('items') or []
+            self.cache.putList(*key, items)
+
+        if args.get('jsonpath'):
+            values = [jsonpath(item, args['jsonpath']) for item in items]
+        else:
+            values = [item['metadata']['name'] for item in items]
+        lines = [toStdout(value) for value in values]
+        return dict(changed=False, resources=items, count=len(items),
+                    stdout='\n'.join(lines), stdout_lines=lines)
+
+    def _patch(self, args):
+        patchType = args.get('patch_type', 'merge')
+        contentType = {
+            'merge': 'application/merge-patch+json',
+            'strategic': 'application/strategic-merge-patch+json',
+            'json': 'application/json-patch+json',
+        }[patchType]
+        body = args['patch']
+        if isinstance(body, str):
+            body = json.loads(body)
+
+        obj = self._resource(args).patch(
+            body=body, name=args['name'], namespace=args.get('namespace'),
+            content_type=contentType).to_dict()
+        self.cache.invalidate(args.get('api_version', 'v1'), args['kind'],
+                              args.get('namespace'), args['name'])
+        return dict(changed=True, resource=obj)
+
+    def _apply(self, args):
+        '''
+        Server-side apply every object of definition and src over one
+        connection pool. Namespaces and CRDs are applied first and the CRDs
+        are waited for to be Established, then the other objects are applied
+        concurrently.
+        '''
+        definitions = []
+        if args.get('definition'):
+            definition = args['definition']
+            if isinstance(definition, str):
+                definition = list(yaml.load_all(definition, Loader=ManifestLoader))
+            definitions.extend(definition if isinstance(definition, list) else [definition])
+        for src in self._sources(args.get('src')):
+            with open(src, 'r') as f:
+                definitions.extend(yaml.load_all(f, Loader=ManifestLoader))
+        definitions = [d for d in self._flatten(definitions) if d]
+
+        namespace = args.get('namespace')
+        applied = []
+        for kind in applyFirst:
+            stage = self.applyDefinitions([d for d in definitions if d['kind'] == kind], namespace)
+            if kind == 'CustomResourceDefinition':
+                self._waitEstablished([obj['name'] for obj in stage], int(args.get('timeout', 300)))
+            applied.extend(stage)
+        applied.extend(self.applyDefinitions([d for d in definitions if d['kind'] not in applyFirst], namespace))
+        return dict(changed=bool(applied), resources=applied)
+
+    @classmethod
+    def _flatten(cls, definitions):
+        for definition in definitions:
+            # kubectl reads every kind ending in List as a list, e.g. ConfigMapList
+            if definition and definition.get('kind', '').endswith('List') and 'items' in definition:
+                for item in cls._flatten(definition.get('items') or []):
+                    yield item
+            else:
+                yield definition
+
+    def applyDefinitions(self, definitions, namespace=None):
+        '''
+        Apply definitions with up to concurrency requests in flight. The API
+        resources are looked up first, as discovery is not thread safe.
+        '''
+        resources = [self.client.resources.get(api_version=d['apiVersion'], kind=d['kind'])
+                     for d in definitions]
+        if len(definitions) <= 1 or self.concurrency == 1:
+            return [self.applyDefinition(*item, namespace=namespace) for item in zip(definitions, resources)]
+
+        failed = []
+
+        def apply(item):
+            try:
+                return self.applyDefinition(*item, namespace=namespace)
+            except Exception as e:
+                failed.append('{} {}: {}'.format(item[0]['kind'], item[0]['metadata'].get('name'), to_native(e)))
+
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(definitions))) as executor:
+            applied = [obj for obj in executor.map(apply, zip(definitions, resources)) if obj]
+        if failed:
+            raise AnsibleActionFail("apply failed for {} of {} objects: {}".format(
+                len(failed), len(definitions), '; '.join(sorted(failed))))
+        return applied
+
+    def applyDefinition(self, definition, resource=None, namespace=None):
+        apiVersion, kind = definition['apiVersion'], definition['kind']
+        metadata = definition.setdefault('metadata', {})
+        if resource is None:
+            resource = self.client.resources.get(api_version=apiVersion, kind=kind)
+        if resource.namespaced:
+            metadata.setdefault('namespace', namespace or 'default')
+        namespace = metadata.get('namespace') if resource.namespaced else None
+        try:
+            obj = self._serverSideApply(resource, definition, namespace)
+        except Exception as e:
+            # kubectl apply --force deleted and created the object again when a field is immutable
+            if getattr(e, 'status', None) != 422 or 'immutable' not in to_native(e):
+                raise
+            self._recreate(resource, metadata['name'], namespace)
+            obj = self._serverSideApply(resource, definition, namespace)
+        self._takeOverFields(resource, obj)
+        self.cache.invalidate(apiVersion, kind, metadata.get('namespace'), metadata['name'])
+        return {'kind': kind, 'name': metadata['name'], 'namespace': metadata.get('namespace')}
+
+    @staticmethod
+    def _serverSideApply(resource, definition, namespace):
+        return resource.server_side_apply(
+            body=definition,
+            name=definition['metadata']['name'],
+            namespace=namespace,
+            field_manager=fieldManager,
+            force_conflicts=True,
+        ).to_dict()
+
+    @staticmethod
+    def _recreate(resource, name, namespace):
+        from kubernetes.dynamic.exceptions import NotFoundError
+
+        try:
+            resource.delete(name=name, namespace=namespace, body={'propagationPolicy': 'Background'})
+        except NotFoundError:
+            return
+        deadline = time.time() + recreateTimeout
+        while time.time() < deadline:
+            try:
+                resource.get(name=name, namespace=namespace)
+            except NotFoundError:
+                return
+            time.sleep(1)
+        raise AnsibleActionFail("Timed out after {}s waiting for {} {} to be deleted, to create it again".format(
+            recreateTimeout, resource.kind, name))
+
+    @staticmethod
+    def _takeOverFields(resource, obj):
+        '''
+        Hand the fields the client-side kubectl apply owns on obj over to
+        fieldManager, like kubectl apply --server-side does on its first run.
+        Otherwise they are kept forever, even when dropped from the manifests.
+        '''
+        metadata = obj.get('metadata') or {}
+        managedFields = metadata.get('managedFields') or []
+        applied = [entry for entry in managedFields
+                   if entry.get('manager') == fieldManager and entry.get('operation') == 'Apply']
+        if len(applied) != 1:
+            return
+        applied = dict(applied[0])
+        legacy = [entry for entry in managedFields
+                  if entry.get('manager') == clientSideManager and entry.get('operation') == 'Update'
+                  and entry.get('apiVersion') == applied.get('apiVersion')]
+        if not legacy:
+            return
+        for entry in legacy:
+            applied['fieldsV1'] = mergeFields(applied.get('fieldsV1') or {}, entry.get('fieldsV1') or {})
+        kept = [entry for entry in managedFields if entry not in legacy and
+                not (entry.get('manager') == fieldManager and entry.get('operation') == 'Apply')]
+        try:
+            resource.patch(
+                body=[
+                    # Another writer in the meantime makes the patch fail, the next apply tries again
+                    {'op': 'test', 'path': '/metadata/resourceVersion', 'value': metadata.get('resourceVersion')},
+                    {'op': 'replace', 'path': '/metadata/managedFields', 'value': kept + [applied]},
+                ],
+                name=metadata['name'], namespace=metadata.get('namespace'),
+                content_type='application/json-patch+json')
+        except Exception as e:
+            if getattr(e, 'status', None) not in (409, 422):
+                raise
+
+    def _waitEstablished(self, names, timeout):
+        if not names:
+            return
+        check = waitConditions['established']
+        resource = self.client.resources.get(
+            api_version='apiextensions.k8s.io/v1', kind='CustomResourceDefinition')
+        if self._watchUntil(resource, lambda objects: all(
+                name in objects and check(objects[name]) for name in names), timeout) is None:
+            raise AnsibleActionFail("Timed out after {}s waiting for CustomResourceDefinitions {} to be established".format(
+                timeout, ', '.join(sorted(names))))
+
+    def _delete(self, args):
+        from kubernetes.dynamic.exceptions import NotFoundError
+
+        try:
+            self._resource(args).delete(name=args['name'], namespace=args.get('namespace'))
+            changed = True
+        except NotFoundError:
+            changed = False
+        self.cache.invalidate(args.get('api_version', 'v1'), args['kind'],
+                              args.get('namespace'), args['name'])
+        return dict(changed=changed)
+
+    @staticmethod
+    def _sources(src):
+        if not src:
+            return []
+        sources = []
+        for path in (src if isinstance(src, list) else [src]):
+            if os.path.isdir(path):
+                sources.extend(
+                    os.path.join(path, f) for f in sorted(os.listdir(path))
+                    if f.endswith(('.yaml', '.yml', '.json')))
+            else:
+                sources.append(path)
+        return sources
+
+    def _wait(self, args):
+        '''
+        Wait until the named object, or every object matching label_selector,
+        meets the condition.
+        '''
+        condition = args.get('condition', 'ready')
+        if condition not in waitConditions:
+            raise AnsibleActionFail("Unsupported condition: {}".format(condition))
+        check = waitConditions[condition]
+        timeout = int(args.get('timeout', 900))
+        started = time.time()
+        objects = self._watchUntil(
+            self._resource(args),
+            lambda objects: bool(objects) and all(check(obj) for obj in objects.values()),
+            timeout,
+            namespace=args.get('namespace'),
+            labelSelector=args.get('label_selector'),
+            fieldSelector='metadata.name={}'.format(args['name']) if args.get('name') else None)
+        if objects is None:
+            raise AnsibleActionFail("Timed out after {}s waiting for {} {} to be {}".format(
+                timeout, args['kind'], args.get('name') or args.get('label_selector', ''), condition))
+        return dict(changed=False, elapsed=int(time.time() - started), resources=list(objects.values()))
+
+    def _watchUntil(self, resource, satisfied, timeout, namespace=None, labelSelector=None, fieldSelector=None):
+        '''
+        The objects by name once satisfied holds for them, or None on timeout.
+        The objects are listed once and then followed through a watch from the
+        listed resourceVersion, so this returns as soon as satisfied holds.
+        '''
+        from kubernetes.client.rest import ApiException
+
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            listing = resource.get(
+                namespace=namespace,
+                label_selector=labelSelector,
+                field_selector=fieldSelector,
+            ).to_dict()
+            objects = {item['metadata']['name']: item for item in listing.get('items') or []}
+            if satisfied(objects):
+                return objects
+
+            try:
+                for event in self.client.watch(
+                        resource,
+                        namespace=namespace,
+                        label_selector=labelSelector,
+                        field_selector=fieldSelector,
+                        resource_version=listing['metadata'].get('resourceVersion'),
+                        timeout=max(1, int(deadline - time.time()))):
+                    if event['type'] == 'ERROR':
+                        break
+                    obj = event['raw_object']
+                    if event['type'] == 'DELETED':
+                        objects.pop(obj['metadata']['name'], None)
+                    else:
+                        objects[obj['metadata']['name']] = obj
+                    if satisfied(objects):
+                        return objects
+                    if time.time() >= deadline:
+                        break
+            except ApiException as e:
+                # 410 Gone: the listed resourceVersion is too old, list again
+                if e.status != 410:
+                    raise
+        return None
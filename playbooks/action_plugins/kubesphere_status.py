@@ -0,0 +1,68 @@
+# encoding: utf-8
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import os
+
+from ansible.errors import AnsibleActionFail
+from ansible.module_utils._text import to_native
+from ansible.plugins.action import ActionBase
+
+'''
+writerEnv: Set by the controller when it writes the status reported by the runs itself.
+resultKey: Key of the task result the controller reads the reported status from.
+'''
+writerEnv = 'KS_STATUS_WRITER'
+resultKey = 'ks_status'
+
+
+def patchStatus(status):
+    from kubernetes import client, config
+    from kubernetes.config.config_exception import ConfigException
+
+    # A KUBECONFIG names another cluster than the one the controller runs in, e.g. in fleet mode
+    if os.environ.get('KUBECONFIG'):
+        config.load_kube_config()
+    else:
+        try:
+            config.load_incluster_config()
+        except ConfigException:
+            config.load_kube_config()
+    client.CustomObjectsApi().patch_namespaced_custom_object(
+        group='installer.kubesphere.io',
+        version='v1alpha1',
+        name='ks-installer',
+        namespace='kubesphere-system',
+        plural='clusterconfigurations',
+        body={'status': status},
+    )
+
+
+class ActionModule(ActionBase):
+    '''
+    Report a change of the status of the ks-installer ClusterConfiguration,
+    as a JSON merge patch of its status. Under the controller the change is
+    only returned in the task result, the controller merges the changes of
+    all runs and writes them together. Playbooks run on their own, e.g. the
+    scheduled telemetry, patch the ClusterConfiguration right away.
+    '''
+
+    TRANSFERS_FILES = False
+    _VALID_ARGS = frozenset(('status',))
+
+    def run(self, tmp=None, task_vars=None):
+        result = super(ActionModule, self).run(tmp, task_vars)
+        status = self._task.args.get('status')
+        if not isinstance(status, dict) or not status:
+            raise AnsibleActionFail("status has to be a mapping")
+
+        if not os.environ.get(writerEnv):
+            try:
+                patchStatus(status)
+            except Exception as e:
+                raise AnsibleActionFail("Failed to patch the status of ks-installer: {}".format(to_native(e)))
+
+        result.update(changed=True)
+        result[resultKey] = status
+        return result
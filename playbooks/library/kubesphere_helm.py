@@ -0,0 +1,66 @@
+#!/usr/bin/python
+# encoding: utf-8
+
+# The work is done by the action plugin of the same name in ../action_plugins,
+# this file only documents the module for ansible-doc.
+
+DOCUMENTATION = '''
+---
+module: kubesphere_helm
+short_description: Install or upgrade Helm releases whose chart or values changed
+description:
+  - Runs C(helm upgrade --install) for one release, or for a list of releases
+    installed concurrently.
+  - The digest of the chart, the values files, C(set) and C(extra_args) is kept
+    in the C(installer.kubesphere.io/helm-digest) annotation of the Secret of
+    the deployed revision. A release with the same digest is skipped.
+options:
+  state:
+    description: C(present) installs the pending releases, C(check) only
+      reports them in C(upgrade) and C(pending).
+    default: present
+  name:
+    description: Name of the release.
+  chart:
+    description: Chart folder or archive.
+  namespace:
+    description: Namespace of the release.
+  values:
+    description: Values files, passed with C(-f).
+  set:
+    description: Values passed with C(--set), as a mapping.
+  extra_args:
+    description: Other arguments of C(helm upgrade), as a list or a string.
+  force:
+    description: Upgrade the release even if its digest is unchanged.
+    default: false
+  releases:
+    description: A list of releases, each with the options above, instead of a
+      single release.
+  concurrency:
+    description: Number of releases installed at a time.
+    default: 4
+  binary:
+    description: Path of helm.
+    default: "{{ bin_dir }}/helm"
+'''
+
+EXAMPLES = '''
+- name: ks-core | Creating ks-core
+  kubesphere_helm:
+    name: ks-core
+    chart: "{{ kubesphere_dir }}/ks-core"
+    values: "{{ kubesphere_dir }}/ks-core/custom-values-ks-core.yaml"
+    namespace: kubesphere-system
+'''
+
+RETURN = '''
+upgrade:
+  description: Whether any release is pending, returned by C(check).
+pending:
+  description: Names of the pending releases, returned by C(check).
+results:
+  description: One result per release, with C(skipped), C(rc), C(stdout) and C(stderr).
+rc:
+  description: The highest return code of helm.
+'''
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+# encoding: utf-8
+
+# The work is done by the action plugin of the same name in ../action_plugins,
+# this file only documents the module for ansible-doc.
+
+DOCUMENTATION = '''
+---
+module: kubesphere_k8s
+short_description: Read and write Kubernetes objects without forking kubectl
+description:
+  - Uses the Kubernetes Python client with the in-cluster or local kubeconfig.
+  - Objects and lists read during a playbook run are cached until the same
+    object or kind is written through this module. Set C(cache=false) to read
+    an object that was changed by kubectl or helm in the meantime.
+options:
+  state:
+    description: One of C(get), C(list), C(patch), C(apply), C(absent) or C(wait).
+    default: get
+  api_version:
+    description: API version of the object, e.g. C(apps/v1).
+    default: v1
+  kind:
+    description: Kind of the object, e.g. C(ConfigMap).
+  name:
+    description: Name of the object, required by C(get), C(patch) and C(absent).
+  namespace:
+    description: Namespace of the object, also the default namespace for C(apply).
+  jsonpath:
+    description: kubectl style JSONPath, e.g. C({.data.kubesphere\\.yaml}). The
+      matching value is returned in C(stdout).
+  label_selector:
+    description: Label selector for C(list).
+  field_selector:
+    description: Field selector for C(list).
+  patch:
+    description: Patch body for C(patch), as a dict or JSON string.
+  patch_type:
+    description: One of C(merge), C(strategic) or C(json).
+    default: merge
+  definition:
+    description: Objects for C(apply), as a dict, a list or a YAML string.
+  src:
+    description: Manifest files or directories for C(apply). Namespaces and
+      CustomResourceDefinitions are applied first and the CRDs are waited for
+      to be established, then all other objects are applied concurrently.
+      Like C(kubectl apply --force), an object whose immutable fields changed
+      is deleted and created again. The fields a client-side C(kubectl apply)
+      set on an object are handed over to this module on its first apply, so
+      the fields later dropped from the manifests are removed.
+  concurrency:
+    description: Number of requests C(apply) sends at a time, over one
+      connection pool.
+    default: 8
+  cache:
+    description: Whether C(get) and C(list) may answer from the per-run cache.
+    default: true
+  condition:
+    description: Condition for C(wait), checked on the named object or on every
+      object matching C(label_selector) through the watch API.
+      C(rollout) for Deployments, StatefulSets and DaemonSets, C(ready) and
+      C(running) for Pods, C(complete) for Jobs (fails as soon as the Job
+      fails) and C(established) for CustomResourceDefinitions.
+    default: ready
+  timeout:
+    description: Seconds C(wait) waits before failing, C(apply) waits as long
+      for its CRDs to be established.
+    default: 900 for C(wait), 300 for C(apply)
+'''
+
+EXAMPLES = '''
+- name: KubeSphere | Getting ks-console svc port
+  kubesphere_k8s:
+    kind: Service
+    name: ks-console
+    namespace: kubesphere-system
+    jsonpath: "{.spec.ports[0].nodePort}"
+  register: ks_console_svc_port
+
+- name: KubeSphere | Waiting for ks-console
+  kubesphere_k8s:
+    state: wait
+    condition: rollout
+    api_version: apps/v1
+    kind: Deployment
+    name: ks-console
+    namespace: kubesphere-system
+    timeout: 900
+'''
+
+RETURN = '''
+stdout:
+  description: The value selected by jsonpath, the object as JSON, or one line per listed object.
+resource:
+  description: The object read or patched.
+resources:
+  description: The listed or applied objects.
+found:
+  description: Whether the object of C(get) exists.
+count:
+  description: Number of objects returned by C(list).
+'''
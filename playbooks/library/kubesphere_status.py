@@ -0,0 +1,36 @@
+#!/usr/bin/python
+# encoding: utf-8
+
+# The work is done by the action plugin of the same name in ../action_plugins,
+# this file only documents the module for ansible-doc.
+
+DOCUMENTATION = '''
+---
+module: kubesphere_status
+short_description: Report a change of the status of the ks-installer ClusterConfiguration
+description:
+  - The change is a JSON merge patch of the status, a C(null) value removes a field.
+  - Under the controller, which sets C(KS_STATUS_WRITER), the change is only
+    returned in C(ks_status). The controller merges the changes of all runs,
+    writes them to C(ks-status.json) right away and to the ClusterConfiguration
+    in one patch every few seconds.
+  - Otherwise the ClusterConfiguration is patched by the task.
+options:
+  status:
+    description: The fields of the status to change.
+    required: true
+'''
+
+EXAMPLES = '''
+- name: ks-devops | Importing ks-devops status
+  kubesphere_status:
+    status:
+      devops:
+        status: enabled
+        enabledTime: "{{ lookup('pipe','date  +%Y-%m-%dT%H:%M:%S%Z') }}"
+'''
+
+RETURN = '''
+ks_status:
+  description: The reported change of the status.
+'''
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+'''
+Check imageSync.py against the registry and Harbor stand-ins of fakeRegistry.py.
+
+Each check syncs an images list with the stand-in skopeo in a scratch folder
+and compares the target registry, the journal and the skopeo calls with what
+the sync should have done: concurrent copies, digest skips, journal resume,
+retries and Harbor project creation.
+
+    python3 scripts/checkImageSync.py
+
+Only needs the Python 3 standard library.
+'''
+
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import imageSync  # noqa: E402
+from fakeRegistry import FakeRegistry, FakeHarbor, digestOf, imageManifest, manifestList  # noqa: E402
+
+'''
+source: The registry the images are copied from.
+target: The registry the images are copied to.
+images: The images list of the checks, the last one has a manifest per platform.
+'''
+source = 'source.local'
+target = 'target.local:5000'
+images = ['kubesphere/ks-apiserver:v3.3.0', 'kubesphere/ks-console:v3.3.0', 'redis:5.0.14-alpine',
+          'calico/node:v3.23.2']
+
+
+class Scratch():
+    '''
+    A scratch folder with the registries, the stand-in skopeo and the images list.
+    '''
+
+    def __init__(self):
+        self.path = tempfile.mkdtemp(prefix='image-sync-check-')
+        self.registry = FakeRegistry(os.path.join(self.path, 'registries'))
+        self.skopeo = os.path.join(self.path, 'skopeo')
+        with open(self.skopeo, 'w') as f:
+            f.write('#!/bin/sh\nFAKE_REGISTRY_DIR={} exec {} {} "$@"\n'.format(
+                self.registry.path, sys.executable,
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fakeRegistry.py')))
+        os.chmod(self.skopeo, 0o755)
+        self.imagesList = os.path.join(self.path, 'images-list.txt')
+        with open(self.imagesList, 'w') as f:
+            f.write('##kubesphere-images\n' + '\n'.join(images) + '\n')
+        self.journal = self.imagesList + '.journal'
+        for image in images[:-1]:
+            self.registry.put(self.sourceRef(image), imageManifest(image))
+        platforms = dict((arch, imageManifest('{} {}'.format(images[-1], arch))) for arch in ('amd64', 'arm64'))
+        self.registry.put(self.sourceRef(images[-1]), manifestList(platforms), platforms.values())
+        self.platformDigest = digestOf(platforms['amd64'])
+
+    def sourceRef(self, image):
+        return 'docker://{}/{}'.format(source, image)
+
+    def targetRef(self, image):
+        return 'docker://{}/{}'.format(target, imageSync.repoPath(image))
+
+    def sync(self, *args):
+        self.registry.clearCalls()
+        return imageSync.main(['sync', '-l', self.imagesList, '--source', source, '--target', target,
+                               '--skopeo', self.skopeo, '--backoff', '0.01'] + list(args))
+
+    def journalEntries(self):
+        if not os.path.exists(self.journal):
+            return []
+        with open(self.journal, 'r') as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def copied(self):
+        return sorted(call['args'][1] for call in self.registry.calls('copy'))
+
+    def close(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def checkCopy(scratch):
+    assert scratch.sync('--workers', '4') == 0
+    for image in images[:-1]:
+        assert digestOf(scratch.registry.get(scratch.targetRef(image))) == digestOf(imageManifest(image)), image
+    # Only the platform of --arch is copied out of a manifest list
+    assert digestOf(scratch.registry.get(scratch.targetRef(images[-1]))) == scratch.platformDigest
+    assert len(scratch.journalEntries()) == len(images)
+    assert set(entry['state'] for entry in scratch.journalEntries()) == {'copied'}
+    copies = sorted(scratch.registry.calls('copy'), key=lambda call: call['start'])
+    assert any(later['start'] < earlier['end'] for earlier, later in zip(copies, copies[1:])), \
+        'the copies did not overlap'
+
+
+def checkJournalResume(scratch):
+    assert scratch.sync() == 0
+    # A killed sync may leave a cut off line, the images before it are still done
+    with open(scratch.journal, 'a') as f:
+        f.write('{"source": "docker://')
+    assert scratch.sync() == 0
+    assert scratch.registry.calls() == [], 'images in the journal were read again'
+
+
+def checkInterruptedResume(scratch):
+    scratch.registry.failNext(scratch.sourceRef(images[1]), 100)
+    assert scratch.sync('--retries', '0') == 1
+    assert len(scratch.journalEntries()) == len(images) - 1
+    scratch.registry.failNext(scratch.sourceRef(images[1]), 0)
+    assert scratch.sync() == 0
+    assert scratch.copied() == [scratch.sourceRef(images[1])]
+
+
+def checkDigestSkip(scratch):
+    assert scratch.sync() == 0
+    os.remove(scratch.journal)
+    assert scratch.sync() == 0
+    assert scratch.copied() == [], 'images with the same digest in the target were copied'
+    assert set(entry['state'] for entry in scratch.journalEntries()) == {'skipped'}
+
+    # A new build of a tag is copied again when the journal is verified
+    scratch.registry.put(scratch.sourceRef(images[0]), imageManifest(images[0] + ' rebuilt'))
+    assert scratch.sync() == 0
+    assert scratch.copied() == []
+    assert scratch.sync('--verify') == 0
+    assert scratch.copied() == [scratch.sourceRef(images[0])]
+    assert scratch.registry.get(scratch.targetRef(images[0])) == imageManifest(images[0] + ' rebuilt')
+
+
+def checkRetries(scratch):
+    scratch.registry.failNext(scratch.sourceRef(images[0]), 2)
+    assert scratch.sync('--retries', '2') == 0
+    assert scratch.copied().count(scratch.sourceRef(images[0])) == 3
+
+    os.remove(scratch.journal)
+    scratch.registry.remove(scratch.targetRef(images[0]))
+    scratch.registry.failNext(scratch.sourceRef(images[0]), 3)
+    assert scratch.sync('--retries', '2') == 1
+    assert scratch.copied().count(scratch.sourceRef(images[0])) == 3
+    assert scratch.sourceRef(images[0]) not in [entry['source'] for entry in scratch.journalEntries()]
+
+
+def checkHarborProjects(scratch):
+    harbor = FakeHarbor('admin', 'Harbor12345', projects=['library']).start()
+    try:
+        assert scratch.sync('--harbor-url', harbor.url) == 0
+        assert sorted(harbor.created) == ['calico', 'kubesphere'], harbor.created
+        # The Harbor credentials are passed to the copies
+        assert set(call['options'].get('--dest-creds') for call in scratch.registry.calls('copy')) == \
+            {'admin:Harbor12345'}
+
+        assert imageSync.main(['projects', '--harbor-url', harbor.url, 'kubesphere', 'istio']) == 0
+        assert sorted(harbor.created) == ['calico', 'istio', 'kubesphere'], harbor.created
+    finally:
+        harbor.stop()
+
+
+'''
+checks: The checks, each run in a scratch folder of its own.
+'''
+checks = [checkCopy, checkJournalResume, checkInterruptedResume, checkDigestSkip, checkRetries, checkHarborProjects]
+
+
+def main():
+    failed = 0
+    for check in checks:
+        scratch = Scratch()
+        try:
+            check(scratch)
+            print('ok      {}'.format(check.__name__))
+        except AssertionError as e:
+            failed += 1
+            print('FAILED  {}: {}'.format(check.__name__, e))
+        finally:
+            scratch.close()
+    print('{} of {} checks passed'.format(len(checks) - failed, len(checks)))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    logging.disable(logging.INFO)
+    sys.exit(main())
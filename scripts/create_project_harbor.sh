@@ -43,7 +43,6 @@ harbor_projects=(library
     kubeedge
 )
 
-for project in "${harbor_projects[@]}"; do
-    echo "creating $project"
-    curl -u "${user}:${passwd}" -X POST -H "Content-Type: application/json" "${url}/api/v2.0/projects" -d "{ \"project_name\": \"${project}\", \"public\": true}"
-done
+# Only the projects that don't exist yet are created
+CurrentDIR=$(cd "$(dirname "$0")" || exit;pwd)
+python3 "${CurrentDIR}/imageSync.py" projects --harbor-url "${url}" --harbor-user "${user}" --harbor-password "${passwd}" "${harbor_projects[@]}"
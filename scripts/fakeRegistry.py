@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+'''
+Stand-ins for the registries and the Harbor API imageSync.py talks to, used by
+checkImageSync.py.
+
+Run as a script, this file is a stand-in for skopeo: `inspect --raw` and `copy`
+of docker:// references, served from the registries kept in the folder named
+by FAKE_REGISTRY_DIR. Every call is appended to calls.jsonl in that folder,
+and the copies of a source listed in failures.json fail as many times as
+listed there.
+
+Only needs the Python 3 standard library.
+'''
+
+import base64
+import fcntl
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+'''
+stateFile: The manifests of the registries, by reference and by digest.
+callsFile: One JSON line per skopeo call, with its arguments, start and end.
+failuresFile: Number of times the next copies of a source reference fail.
+copySeconds: Seconds a copy takes, so that the copies of several workers overlap.
+manifestListType: Media type of the multi-platform manifests.
+'''
+stateFile = 'registry.json'
+callsFile = 'calls.jsonl'
+failuresFile = 'failures.json'
+copySeconds = 0.2
+manifestListType = 'application/vnd.docker.distribution.manifest.list.v2+json'
+
+
+def digestOf(raw):
+    return 'sha256:' + hashlib.sha256(raw).hexdigest()
+
+
+def imageManifest(name, layerSize=1024 * 1024):
+    '''
+    The raw manifest of a single platform image, different for every name.
+    '''
+    return json.dumps({
+        'schemaVersion': 2,
+        'mediaType': 'application/vnd.docker.distribution.manifest.v2+json',
+        'config': {'digest': digestOf(('config ' + name).encode('utf-8')), 'size': 1024},
+        'layers': [{'digest': digestOf(('layer ' + name).encode('utf-8')), 'size': layerSize}],
+    }, sort_keys=True).encode('utf-8')
+
+
+def manifestList(platforms):
+    '''
+    The raw manifest list of the platform manifests, a mapping of architecture to raw manifest.
+    '''
+    return json.dumps({
+        'schemaVersion': 2,
+        'mediaType': manifestListType,
+        'manifests': [{'digest': digestOf(raw), 'size': len(raw), 'platform': {'architecture': arch, 'os': 'linux'}}
+                      for arch, raw in sorted(platforms.items())],
+    }, sort_keys=True).encode('utf-8')
+
+
+def splitRef(ref):
+    '''
+    The repository and the tag or digest of a docker:// reference.
+    '''
+    if not ref.startswith('docker://'):
+        raise ValueError('only docker:// references are served: {}'.format(ref))
+    ref = ref[len('docker://'):]
+    if '@' in ref:
+        return ref.split('@', 1)
+    head, _, last = ref.rpartition('/')
+    name, _, tag = last.partition(':')
+    return '{}/{}'.format(head, name) if head else name, tag or 'latest'
+
+
+class FakeRegistry():
+    '''
+    Registries kept in a folder, shared by the stand-in skopeo processes.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    @contextmanager
+    def _state(self, write=False):
+        with open(os.path.join(self.path, stateFile), 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if write else fcntl.LOCK_SH)
+            f.seek(0)
+            content = f.read()
+            state = json.loads(content) if content else {'tags': {}, 'blobs': {}}
+            yield state
+            if write:
+                f.seek(0)
+                f.truncate()
+                json.dump(state, f)
+
+    def put(self, ref, raw, children=()):
+        '''
+        Store raw as the manifest of ref, and children, the raw platform
+        manifests of a list, under their digests in the same repository.
+        '''
+        repo, tag = splitRef(ref)
+        with self._state(write=True) as state:
+            for item in list(children) + [raw]:
+                state['blobs']['{}@{}'.format(repo, digestOf(item))] = base64.b64encode(item).decode('ascii')
+            state['tags']['{}:{}'.format(repo, tag)] = digestOf(raw)
+
+    def get(self, ref):
+        repo, tag = splitRef(ref)
+        with self._state() as state:
+            digest = tag if tag.startswith('sha256:') else state['tags'].get('{}:{}'.format(repo, tag))
+            raw = state['blobs'].get('{}@{}'.format(repo, digest))
+        return base64.b64decode(raw) if raw is not None else None
+
+    def remove(self, ref):
+        repo, tag = splitRef(ref)
+        with self._state(write=True) as state:
+            state['tags'].pop('{}:{}'.format(repo, tag), None)
+
+    def failNext(self, ref, times):
+        with open(os.path.join(self.path, failuresFile), 'w') as f:
+            json.dump({ref: times}, f)
+
+    def _takeFailure(self, ref):
+        path = os.path.join(self.path, failuresFile)
+        with open(path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            content = f.read()
+            failures = json.loads(content) if content else {}
+            if not failures.get(ref):
+                return False
+            failures[ref] -= 1
+            f.seek(0)
+            f.truncate()
+            json.dump(failures, f)
+            return True
+
+    def calls(self, command=None):
+        path = os.path.join(self.path, callsFile)
+        if not os.path.exists(path):
+            return []
+        with open(path, 'r') as f:
+            calls = [json.loads(line) for line in f]
+        return [call for call in calls if command is None or call['args'][0] == command]
+
+    def clearCalls(self):
+        path = os.path.join(self.path, callsFile)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def skopeo(self, argv):
+        '''
+        Run the skopeo command line argv and return its exit code.
+        '''
+        started = time.time()
+        options = {}
+        args = []
+        flags = {'--override-arch', '--override-os', '--creds', '--src-creds', '--dest-creds', '--digestfile'}
+        iterator = iter(argv)
+        for arg in iterator:
+            if arg in flags:
+                options[arg] = next(iterator)
+            elif arg.startswith('--'):
+                options[arg.split('=')[0]] = arg.split('=', 1)[1] if '=' in arg else True
+            else:
+                args.append(arg)
+        try:
+            if args[0] == 'inspect':
+                raw = self.get(args[1])
+                if raw is None:
+                    sys.stderr.write('reading manifest {}: manifest unknown\n'.format(args[1]))
+                    return 1
+                sys.stdout.buffer.write(raw)
+                return 0
+            if args[0] == 'copy':
+                time.sleep(copySeconds)
+                if self._takeFailure(args[1]):
+                    sys.stderr.write('writing blob: connection reset by peer\n')
+                    return 1
+                raw = self.get(args[1])
+                if raw is None:
+                    sys.stderr.write('reading manifest {}: manifest unknown\n'.format(args[1]))
+                    return 1
+                children = []
+                content = json.loads(raw.decode('utf-8'))
+                if content.get('mediaType') == manifestListType:
+                    repo = splitRef(args[1])[0]
+                    children = [self.get('docker://{}@{}'.format(repo, entry['digest']))
+                                for entry in content['manifests']]
+                    if not options.get('--all'):
+                        arch = options.get('--override-arch', 'amd64')
+                        raw = [child for entry, child in zip(content['manifests'], children)
+                               if entry['platform']['architecture'] == arch][0]
+                        children = []
+                self.put(args[2], raw, children)
+                with open(options['--digestfile'], 'w') as f:
+                    f.write(digestOf(raw))
+                return 0
+            sys.stderr.write('unsupported command {}\n'.format(args[0]))
+            return 2
+        finally:
+            with open(os.path.join(self.path, callsFile), 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.write(json.dumps({'args': args, 'options': options, 'start': started, 'end': time.time()}) + '\n')
+
+
+class FakeHarbor():
+    '''
+    A stand-in for the projects API of Harbor, checking the basic auth of
+    every request.
+    '''
+
+    def __init__(self, user, password, projects=(), host='127.0.0.1', port=0):
+        '''
+        :param projects: The projects Harbor has at start
+        '''
+        self.auth = 'Basic ' + base64.b64encode('{}:{}'.format(user, password).encode('utf-8')).decode('ascii')
+        self.projects = dict((name, {'public': 'true'}) for name in projects)
+        self.created = []
+        self._lock = threading.Lock()
+        harbor = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, code, body=None):
+                content = json.dumps(body).encode('utf-8') if body is not None else b''
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if self.headers.get('Authorization') != harbor.auth:
+                    return self._reply(401, {'errors': [{'code': 'UNAUTHORIZED'}]})
+                if url.path != '/api/v2.0/projects':
+                    return self._reply(404)
+                query = parse_qs(url.query)
+                page = int(query.get('page', ['1'])[0])
+                size = int(query.get('page_size', ['10'])[0])
+                with harbor._lock:
+                    names = sorted(harbor.projects)
+                self._reply(200, [{'name': name} for name in names[(page - 1) * size:page * size]])
+
+            def do_POST(self):
+                if self.headers.get('Authorization') != harbor.auth:
+                    return self._reply(401, {'errors': [{'code': 'UNAUTHORIZED'}]})
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+                with harbor._lock:
+                    if body['project_name'] in harbor.projects:
+                        return self._reply(409, {'errors': [{'code': 'CONFLICT'}]})
+                    harbor.projects[body['project_name']] = body.get('metadata') or {}
+                    harbor.created.append(body['project_name'])
+                self._reply(201)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.url = 'http://{}:{}'.format(*self.server.server_address)
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+    sys.exit(FakeRegistry(os.environ['FAKE_REGISTRY_DIR']).skopeo(sys.argv[1:]))
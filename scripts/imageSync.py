@@ -0,0 +1,679 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+'''
+Copy the images of an images list from one registry to another with skopeo.
+
+Images are copied by a pool of workers. An image whose manifest is already
+in the target registry with the same digest is skipped, and every copied or
+skipped image is written to a journal, so a sync that failed or was stopped
+carries on where it stopped when run again. Failed copies are retried with
+an exponential backoff.
+
+    python3 scripts/imageSync.py sync -l images-list.txt --source docker.io --target dockerhub.kubekey.local
+
+The images list has one image per line, e.g. kubesphere/ks-apiserver:v3.3.0.
+Lines with a # are comments.
+
+The images can also be saved to an offline bundle, an OCI image layout that
+stores every blob once however many images share it, and copied from it to a
+registry later. skopeo only uploads the blobs the registry does not have:
+
+    python3 scripts/imageSync.py save -l images-list.txt --bundle kubesphere-images
+    python3 scripts/imageSync.py sync -l images-list.txt --source-transport oci --source kubesphere-images --target dockerhub.kubekey.local
+
+Harbor projects for the images can be created before the copy with
+--harbor-url, or on their own:
+
+    python3 scripts/imageSync.py projects --harbor-url http://192.168.6.2 -l images-list.txt
+
+Needs skopeo, and runs with the Python 3 standard library only.
+checkImageSync.py checks it against the registry and Harbor stand-ins of
+fakeRegistry.py, without skopeo.
+'''
+
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+listMediaTypes: Media types of manifests listing one image per platform.
+transports: Prefixes of the image references of the skopeo transports the sync reads from.
+refNameAnnotation: Annotation of the manifests of a bundle naming their image.
+sourceDigestAnnotation: Annotation of the manifests of a bundle with the digest of the manifest they were copied from.
+'''
+listMediaTypes = (
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.oci.image.index.v1+json',
+)
+transports = {
+    'docker': 'docker://',
+    'docker-daemon': 'docker-daemon:',
+    'oci': 'oci:',
+}
+refNameAnnotation = 'org.opencontainers.image.ref.name'
+sourceDigestAnnotation = 'installer.kubesphere.io/source-digest'
+
+
+def readImagesList(path):
+    '''
+    The images of an images list, in order and without duplicates. Like
+    sync-images.sh, lines with a # and words without a tag are left out.
+    '''
+    images = []
+    with open(path, 'r') as f:
+        for line in f:
+            if '#' in line:
+                continue
+            for image in line.split():
+                if (':' in image or '@' in image) and image not in images:
+                    images.append(image)
+    return images
+
+
+def repoPath(image):
+    '''
+    The repository and tag of an image without its registry, e.g.
+    kubesphere/ks-apiserver:v3.3.0 for docker.io/kubesphere/ks-apiserver:v3.3.0.
+    Official images are in the library project, as on Docker Hub.
+    '''
+    first, _, rest = image.partition('/')
+    if rest and ('.' in first or ':' in first or first == 'localhost'):
+        image = rest
+    return image if '/' in image else 'library/' + image
+
+
+def projectOf(image):
+    return repoPath(image).split('/')[0]
+
+
+def pinDigest(ref, digest):
+    '''
+    ref with its tag or digest replaced by digest.
+    '''
+    head, _, last = ref.split('@')[0].rpartition('/')
+    return '{}/{}@{}'.format(head, last.split(':')[0], digest)
+
+
+def digestOf(raw):
+    return 'sha256:' + hashlib.sha256(raw).hexdigest()
+
+
+class ManifestError(Exception):
+    pass
+
+
+class Skopeo():
+    '''
+    Runs skopeo with the options shared by every call.
+    '''
+
+    def __init__(self, binary, tlsVerify, srcCreds, destCreds, arch, osName):
+        '''
+        :param binary: Path of skopeo
+        :param tlsVerify: Verify the certificates of the registries
+        :param srcCreds: USER:PASSWORD of the source registry, None for the auth file or anonymous access
+        :param destCreds: USER:PASSWORD of the target registry
+        :param arch: The architecture copied out of multi-platform images
+        :param osName: The OS copied out of multi-platform images
+        '''
+        self.binary = binary
+        self.tlsVerify = 'true' if tlsVerify else 'false'
+        self.srcCreds = srcCreds
+        self.destCreds = destCreds
+        self.arch = arch
+        self.osName = osName
+
+    def _run(self, args, timeout=None):
+        command = [self.binary, '--override-arch', self.arch, '--override-os', self.osName] + args
+        process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+        return process.returncode, process.stdout, process.stderr.decode('utf-8', 'replace').strip()
+
+    def inspectRaw(self, ref, creds):
+        '''
+        The raw manifest of ref, None when the registry does not have it.
+        '''
+        args = ['inspect', '--raw', '--tls-verify=' + self.tlsVerify]
+        if creds:
+            args.extend(['--creds', creds])
+        rc, stdout, stderr = self._run(args + [ref], timeout=300)
+        if rc == 0:
+            return stdout
+        if any(reason in stderr.lower() for reason in ('manifest unknown', 'name unknown', 'not found', 'not_found')):
+            return None
+        raise ManifestError('inspecting {} failed: {}'.format(ref, stderr))
+
+    def copy(self, source, target, allPlatforms, extraArgs=()):
+        '''
+        Copy source to target and return the digest of the manifest written.
+        '''
+        fd, digestFile = tempfile.mkstemp(prefix='image-sync-')
+        os.close(fd)
+        args = ['copy', '--insecure-policy', '--quiet',
+                '--src-tls-verify=' + self.tlsVerify, '--dest-tls-verify=' + self.tlsVerify,
+                '--digestfile', digestFile]
+        if allPlatforms:
+            args.append('--all')
+        if self.srcCreds:
+            args.extend(['--src-creds', self.srcCreds])
+        if self.destCreds and target.startswith(transports['docker']):
+            args.extend(['--dest-creds', self.destCreds])
+        args.extend(extraArgs)
+        try:
+            rc, _, stderr = self._run(args + [source, target])
+            if rc != 0:
+                raise ManifestError('copying {} failed: {}'.format(source, stderr))
+            with open(digestFile, 'r') as f:
+                return f.read().strip()
+        finally:
+            os.remove(digestFile)
+
+
+class Manifest():
+    '''
+    The parts of a manifest the sync compares and reports.
+    '''
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.digest = digestOf(raw)
+        try:
+            self.content = json.loads(raw.decode('utf-8'))
+        except ValueError:
+            raise ManifestError('not a manifest: {!r}'.format(raw[:80]))
+
+    @property
+    def isList(self):
+        return self.content.get('mediaType') in listMediaTypes or 'manifests' in self.content
+
+    @property
+    def size(self):
+        '''
+        Bytes of the config and layers of a single platform manifest.
+        '''
+        return (self.content.get('config') or {}).get('size', 0) + \
+            sum(layer.get('size', 0) for layer in self.content.get('layers') or [])
+
+    @property
+    def children(self):
+        '''
+        Digests of the blobs the manifest refers to.
+        '''
+        descriptors = (self.content.get('manifests') or []) + (self.content.get('layers') or [])
+        if self.content.get('config'):
+            descriptors.append(self.content['config'])
+        return [descriptor['digest'] for descriptor in descriptors]
+
+    def platformDigest(self, arch, osName):
+        for entry in self.content.get('manifests') or []:
+            platform = entry.get('platform') or {}
+            if platform.get('architecture') == arch and platform.get('os') == osName:
+                return entry['digest']
+        raise ManifestError('no {}/{} image in the manifest list'.format(osName, arch))
+
+
+class Journal():
+    '''
+    The images a sync has copied or found in the target, one JSON line each.
+    Lines are written and flushed as soon as an image is done, so the journal
+    survives a sync that is killed.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line of a killed sync may be cut off
+                        continue
+                    self.done[(entry['source'], entry['target'])] = entry
+
+    def get(self, source, target):
+        return self.done.get((source, target))
+
+    def record(self, source, target, digest, state):
+        if not self.path:
+            return
+        entry = {'source': source, 'target': target, 'digest': digest, 'state': state, 'time': int(time.time())}
+        with self._lock:
+            self.done[(source, target)] = entry
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+
+class Registry():
+    '''
+    A registry, optionally with a path, images are copied to.
+    '''
+
+    def __init__(self, skopeo, target):
+        self.skopeo = skopeo
+        self.target = target.rstrip('/')
+
+    def ref(self, image):
+        return '{}{}/{}'.format(transports['docker'], self.target, repoPath(image))
+
+    def existing(self, image, sourceManifest):
+        '''
+        The digest of the manifest of image if it is the one of sourceManifest.
+        '''
+        raw = self.skopeo.inspectRaw(self.ref(image), self.skopeo.destCreds)
+        if raw is not None and digestOf(raw) == sourceManifest.digest:
+            return sourceManifest.digest
+        return None
+
+    def copy(self, source, image, allPlatforms, sourceManifest):
+        return self.skopeo.copy(source, self.ref(image), allPlatforms)
+
+
+class Daemon():
+    '''
+    The local Docker, images are always copied to it.
+    '''
+
+    def __init__(self, skopeo):
+        self.skopeo = skopeo
+
+    def ref(self, image):
+        return transports['docker-daemon'] + image
+
+    def existing(self, image, sourceManifest):
+        return None
+
+    def copy(self, source, image, allPlatforms, sourceManifest):
+        return self.skopeo.copy(source, self.ref(image), allPlatforms)
+
+
+class Bundle():
+    '''
+    An OCI image layout holding the images of an images list. Every blob is
+    stored once in blobs/sha256, compressed as the registry serves it, and
+    index.json names the manifest of every image by its image reference.
+
+    skopeo writes to an OCI layout by rewriting its index.json, so every image
+    is copied to a layout of its own that keeps its blobs in the blobs of the
+    bundle, and then added to the index of the bundle.
+    '''
+
+    def __init__(self, skopeo, path):
+        self.skopeo = skopeo
+        self.path = os.path.abspath(path)
+        self.blobs = os.path.join(self.path, 'blobs')
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(self.blobs, 'sha256'), exist_ok=True)
+        layoutFile = os.path.join(self.path, 'oci-layout')
+        if not os.path.exists(layoutFile):
+            with open(layoutFile, 'w') as f:
+                json.dump({'imageLayoutVersion': '1.0.0'}, f)
+        self.index = {'schemaVersion': 2, 'manifests': []}
+        indexFile = os.path.join(self.path, 'index.json')
+        if os.path.exists(indexFile):
+            with open(indexFile, 'r') as f:
+                self.index = json.load(f)
+
+    def ref(self, image):
+        return '{}{}:{}'.format(transports['oci'], self.path, image)
+
+    def blobPath(self, digest):
+        algorithm, _, hexDigest = digest.partition(':')
+        return os.path.join(self.blobs, algorithm, hexDigest)
+
+    def _entry(self, image):
+        for descriptor in self.index['manifests']:
+            if (descriptor.get('annotations') or {}).get(refNameAnnotation) == image:
+                return descriptor
+        return None
+
+    def existing(self, image, sourceManifest):
+        entry = self._entry(image)
+        if entry is None or not os.path.exists(self.blobPath(entry['digest'])):
+            return None
+        if entry['annotations'].get(sourceDigestAnnotation) != sourceManifest.digest:
+            return None
+        return entry['digest']
+
+    def copy(self, source, image, allPlatforms, sourceManifest):
+        staging = tempfile.mkdtemp(prefix='.staging-', dir=self.path)
+        try:
+            self.skopeo.copy(source, '{}{}:{}'.format(transports['oci'], staging, image), allPlatforms,
+                             ['--dest-shared-blob-dir', self.blobs])
+            with open(os.path.join(staging, 'index.json'), 'r') as f:
+                descriptor = json.load(f)['manifests'][0]
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+        annotations = {refNameAnnotation: image}
+        if sourceManifest is not None:
+            annotations[sourceDigestAnnotation] = sourceManifest.digest
+        descriptor = dict(descriptor, annotations=annotations)
+        with self._lock:
+            self.index['manifests'] = [d for d in self.index['manifests']
+                                       if (d.get('annotations') or {}).get(refNameAnnotation) != image]
+            self.index['manifests'].append(descriptor)
+            self._writeIndex()
+        return descriptor['digest']
+
+    def _writeIndex(self):
+        fd, tmpFile = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.index, f, indent=2)
+        os.replace(tmpFile, os.path.join(self.path, 'index.json'))
+
+    def prune(self):
+        '''
+        Remove the blobs no image of the index refers to any more, e.g. the
+        layers of images saved again with a new tag, and return the number of
+        blobs and bytes left.
+        '''
+        used = set()
+        pending = [descriptor['digest'] for descriptor in self.index['manifests']]
+        while pending:
+            digest = pending.pop()
+            if digest in used:
+                continue
+            used.add(digest)
+            path = self.blobPath(digest)
+            if not os.path.exists(path):
+                continue
+            with open(path, 'rb') as f:
+                raw = f.read(1 << 20)
+            try:
+                pending.extend(Manifest(raw).children)
+            except (ManifestError, AttributeError, KeyError):
+                # A layer or config, not a manifest
+                pass
+
+        count, size = 0, 0
+        for algorithm in os.listdir(self.blobs):
+            for hexDigest in os.listdir(os.path.join(self.blobs, algorithm)):
+                path = os.path.join(self.blobs, algorithm, hexDigest)
+                if '{}:{}'.format(algorithm, hexDigest) not in used:
+                    os.remove(path)
+                    continue
+                count += 1
+                size += os.path.getsize(path)
+        return count, size
+
+
+class ImageSync():
+    '''
+    Sync a list of images from a source to a Registry, Daemon or Bundle.
+    '''
+
+    def __init__(self, skopeo, journal, source, destination, sourceTransport='docker', allPlatforms=False,
+                 retries=5, backoff=2.0, verify=False):
+        '''
+        :param skopeo: The Skopeo running the copies
+        :param journal: The Journal of the sync
+        :param source: Registry prefixed to the images of the list, empty when the list has full
+                       references, or the path of the bundle for the oci transport
+        :param destination: The Registry, Daemon or Bundle the images are copied to
+        :param sourceTransport: skopeo transport of the source, docker, docker-daemon or oci
+        :param allPlatforms: Copy every platform of multi-platform images
+        :param retries: Attempts of a failed image after the first one
+        :param backoff: Seconds before the first retry, doubled for every further retry
+        :param verify: Check the target registry for images in the journal too
+        '''
+        self.skopeo = skopeo
+        self.journal = journal
+        self.source = source.rstrip('/')
+        self.destination = destination
+        self.sourceTransport = sourceTransport
+        self.allPlatforms = allPlatforms
+        self.retries = retries
+        self.backoff = backoff
+        self.verify = verify
+        self._lock = threading.Lock()
+        self.total = 0
+        self.finished = 0
+        self.stats = {'copied': 0, 'skipped': 0, 'failed': 0, 'bytes': 0}
+
+    def sourceRef(self, image):
+        if self.sourceTransport == 'oci':
+            return '{}{}:{}'.format(transports['oci'], os.path.abspath(self.source), image)
+        source = '{}/{}'.format(self.source, image) if self.source else image
+        return transports[self.sourceTransport] + source
+
+    def run(self, images, workers):
+        self.total = len(images)
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            results = list(executor.map(self.syncImage, images))
+        elapsed = max(time.time() - started, 0.001)
+        mib = self.stats['bytes'] / 1024.0 / 1024.0
+        logging.info("Synced {} images in {:.1f}s: {} copied, {} skipped, {} failed, {:.1f}MiB at {:.1f}MiB/s".format(
+            self.total, elapsed, self.stats['copied'], self.stats['skipped'], self.stats['failed'],
+            mib, mib / elapsed))
+        return results
+
+    def syncImage(self, image):
+        source, target = self.sourceRef(image), self.destination.ref(image)
+        entry = self.journal.get(source, target)
+        if entry is not None and not self.verify:
+            return self._done(image, 'skipped', 0, 0, 'in journal')
+
+        started = time.time()
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                delay = min(self.backoff * 2 ** (attempt - 1), 60) * random.uniform(0.5, 1.5)
+                logging.info("Retrying {} in {:.0f}s ({}/{}): {}".format(image, delay, attempt, self.retries, error))
+                time.sleep(delay)
+            try:
+                state, digest, size = self._sync(source, image)
+            except (ManifestError, subprocess.TimeoutExpired, OSError) as e:
+                error = e
+                continue
+            self.journal.record(source, target, digest, state)
+            return self._done(image, state, size, time.time() - started)
+        return self._done(image, 'failed', 0, time.time() - started, error)
+
+    def _sync(self, source, image):
+        '''
+        Copy one image unless the destination has it, return (state, digest, bytes).
+        '''
+        sourceManifest = None
+        if self.sourceTransport != 'docker-daemon':
+            sourceManifest = Manifest(self._inspect(source, self.skopeo.srcCreds))
+            # An OCI layout can't be read by digest, the list is compared as a whole
+            if sourceManifest.isList and not self.allPlatforms and self.sourceTransport == 'docker':
+                platformDigest = sourceManifest.platformDigest(self.skopeo.arch, self.skopeo.osName)
+                sourceManifest = Manifest(self._inspect(
+                    pinDigest(source, platformDigest), self.skopeo.srcCreds))
+
+            digest = self.destination.existing(image, sourceManifest)
+            if digest is not None:
+                return 'skipped', digest, 0
+
+        digest = self.destination.copy(source, image, self.allPlatforms, sourceManifest)
+        size = sourceManifest.size if sourceManifest is not None and not sourceManifest.isList else 0
+        return 'copied', digest, size
+
+    def _inspect(self, ref, creds):
+        raw = self.skopeo.inspectRaw(ref, creds)
+        if raw is None:
+            raise ManifestError('{} not found'.format(ref))
+        return raw
+
+    def _done(self, image, state, size, seconds, detail=None):
+        with self._lock:
+            self.finished += 1
+            self.stats[state] += 1
+            self.stats['bytes'] += size
+            progress = '{}/{}'.format(self.finished, self.total)
+        if state == 'copied':
+            logging.info("Progress: {} sync {} successful ({:.1f}MiB in {:.1f}s)".format(
+                progress, image, size / 1024.0 / 1024.0, seconds))
+        elif state == 'skipped':
+            logging.info("Progress: {} sync {} skipped, {}".format(
+                progress, image, detail or 'the target has the same digest'))
+        else:
+            logging.info("Progress: {} sync {} failed: {}".format(progress, image, detail))
+        return {'image': image, 'state': state, 'bytes': size, 'seconds': seconds}
+
+
+class Harbor():
+    '''
+    The projects API of a Harbor registry.
+    '''
+
+    def __init__(self, url, user, password):
+        self.url = url.rstrip('/')
+        self.auth = 'Basic ' + base64.b64encode('{}:{}'.format(user, password).encode('utf-8')).decode('ascii')
+
+    def _request(self, method, path, body=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        request = urllib.request.Request(self.url + path, data=data, method=method, headers={
+            'Authorization': self.auth,
+            'Accept': 'application/json',
+            'Content-Type': 'application/json',
+        })
+        with urllib.request.urlopen(request, timeout=60) as response:
+            content = response.read()
+            return json.loads(content.decode('utf-8')) if content else None
+
+    def projects(self):
+        names = set()
+        page = 1
+        while True:
+            items = self._request('GET', '/api/v2.0/projects?page={}&page_size=100'.format(page)) or []
+            names.update(item['name'] for item in items)
+            if len(items) < 100:
+                return names
+            page += 1
+
+    def createProjects(self, projects, public=True):
+        existing = self.projects()
+        for project in sorted(set(projects) - existing):
+            logging.info("Creating Harbor project {}".format(project))
+            try:
+                self._request('POST', '/api/v2.0/projects', {
+                    'project_name': project,
+                    'metadata': {'public': 'true' if public else 'false'},
+                })
+            except urllib.error.HTTPError as e:
+                # 409: created by another sync in the meantime
+                if e.code != 409:
+                    raise
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    harbor = argparse.ArgumentParser(add_help=False)
+    harbor.add_argument('--harbor-url', help='Harbor to create the projects of the images in, e.g. http://192.168.6.2')
+    harbor.add_argument('--harbor-user', default=os.environ.get('HARBOR_USER', 'admin'))
+    harbor.add_argument('--harbor-password', default=os.environ.get('HARBOR_PASSWORD', 'Harbor12345'))
+    harbor.add_argument('--harbor-private', action='store_true', help='Create private instead of public projects')
+
+    copy = argparse.ArgumentParser(add_help=False)
+    copy.add_argument('-l', '--images-list', default='images-list.txt')
+    copy.add_argument('-w', '--workers', type=int, default=4, help='Images copied at a time')
+    copy.add_argument('--retries', type=int, default=5)
+    copy.add_argument('--backoff', type=float, default=2.0, help='Seconds before the first retry')
+    copy.add_argument('--all', action='store_true', help='Copy every platform of multi-platform images')
+    copy.add_argument('--arch', default='amd64', help='Platform copied out of multi-platform images')
+    copy.add_argument('--os', default='linux')
+    copy.add_argument('--src-creds', default=os.environ.get('SRC_CREDS'), help='USER:PASSWORD of the source')
+    copy.add_argument('--tls-verify', action='store_true', help='Verify the certificates of the registries')
+    copy.add_argument('--skopeo', default='skopeo')
+
+    sync = subparsers.add_parser('sync', parents=[harbor, copy], help='Copy the images of an images list')
+    sync.add_argument('--source', default='docker.io',
+                      help='Registry prefixed to the images, empty when the list has full references, '
+                           'or the bundle for the oci transport')
+    sync.add_argument('--source-transport', default='docker', choices=sorted(transports),
+                      help='docker-daemon copies images loaded into the local Docker instead, '
+                           'which are only skipped through the journal, oci copies them from a bundle')
+    sync.add_argument('--target', default='localhost', help='Registry, optionally with a path, to copy to')
+    sync.add_argument('--target-transport', default='docker', choices=['docker', 'docker-daemon'],
+                      help='docker-daemon loads the images into the local Docker')
+    sync.add_argument('--journal', help='Journal of the sync, default: the images list with .journal appended')
+    sync.add_argument('--no-journal', action='store_true', help='Neither read nor write a journal')
+    sync.add_argument('--verify', action='store_true',
+                      help='Compare the digests of the images in the journal with the target again')
+    sync.add_argument('--dest-creds', default=os.environ.get('DEST_CREDS'), help='USER:PASSWORD of the target')
+
+    save = subparsers.add_parser('save', parents=[copy], help='Save the images of an images list to a bundle')
+    save.add_argument('--source', default='docker.io',
+                      help='Registry prefixed to the images, empty when the list has full references')
+    save.add_argument('--bundle', default='kubesphere-images', help='Directory of the bundle')
+
+    projects = subparsers.add_parser('projects', parents=[harbor], help='Create the Harbor projects of images')
+    projects.add_argument('-l', '--images-list', help='Create the projects of the images of this list')
+    projects.add_argument('project', nargs='*', help='Projects to create')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    args = parseArgs(sys.argv[1:] if argv is None else argv)
+
+    if args.command == 'projects':
+        if not args.harbor_url:
+            logging.info("--harbor-url is required")
+            return 2
+        projects = list(args.project)
+        if args.images_list:
+            projects.extend(projectOf(image) for image in readImagesList(args.images_list))
+        Harbor(args.harbor_url, args.harbor_user, args.harbor_password).createProjects(
+            projects, public=not args.harbor_private)
+        return 0
+
+    images = readImagesList(args.images_list)
+    if args.command == 'save':
+        skopeo = Skopeo(args.skopeo, args.tls_verify, args.src_creds, None, args.arch, args.os)
+        bundle = Bundle(skopeo, args.bundle)
+        # The index of the bundle is its journal
+        imageSync = ImageSync(skopeo, Journal(None), args.source, bundle, allPlatforms=args.all,
+                              retries=args.retries, backoff=args.backoff)
+        results = imageSync.run(images, args.workers)
+        count, size = bundle.prune()
+        logging.info("Bundle {}: {} images, {} blobs, {:.1f}MiB".format(
+            bundle.path, len(bundle.index['manifests']), count, size / 1024.0 / 1024.0))
+        return 1 if any(result['state'] == 'failed' for result in results) else 0
+
+    if args.harbor_url:
+        Harbor(args.harbor_url, args.harbor_user, args.harbor_password).createProjects(
+            [projectOf(image) for image in images], public=not args.harbor_private)
+        if not args.dest_creds:
+            args.dest_creds = '{}:{}'.format(args.harbor_user, args.harbor_password)
+
+    journalPath = None if args.no_journal else (args.journal or args.images_list + '.journal')
+    skopeo = Skopeo(args.skopeo, args.tls_verify, args.src_creds, args.dest_creds, args.arch, args.os)
+    if args.target_transport == 'docker-daemon':
+        destination = Daemon(skopeo)
+    else:
+        destination = Registry(skopeo, args.target)
+    imageSync = ImageSync(skopeo, Journal(journalPath), args.source, destination,
+                          sourceTransport=args.source_transport, allPlatforms=args.all,
+                          retries=args.retries, backoff=args.backoff, verify=args.verify)
+    results = imageSync.run(images, args.workers)
+    return 1 if any(result['state'] == 'failed' for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -20,6 +20,15 @@ fi
 
 delete_sure
 
+# The controller tears the components down in parallel when its Python dependencies are installed,
+# pass --dry-run to only show what it would delete. Otherwise, or without the controller next to this script,
+# the sequence below runs.
+root="$(cd "$(dirname "$0")/.." && pwd)"
+if [[ -f "$root/controller/installRunner.py" && -f "$root/playbooks/teardown.yaml" ]] && \
+    python3 -c 'import kubernetes, yaml' 2>/dev/null; then
+  cd "$root" && exec python3 controller/installRunner.py --debug --uninstall "$@"
+fi
+
 # delete ks-installer
 kubectl delete deploy ks-installer -n kubesphere-system 2>/dev/null
 
@@ -34,10 +34,10 @@ func() {
     echo
     echo "Description:"
     echo "  -b                     : save kubernetes' binaries."
-    echo "  -d IMAGES-DIR          : the dir of files (tar.gz) which generated by \`docker save\`. default: ${ImagesDirDefault}"
+    echo "  -d IMAGES-DIR          : the dir of the images bundle (OCI layout), or of files (tar.gz) which generated by \`docker save\`. default: ${ImagesDirDefault}"
     echo "  -l IMAGES-LIST         : text file with list of images."
     echo "  -r PRIVATE-REGISTRY    : target private registry:port."
-    echo "  -s                     : save model will be applied. Pull the images in the IMAGES-LIST and save images as a tar.gz file."
+    echo "  -s                     : save model will be applied. Pull the images in the IMAGES-LIST and save them to a bundle in IMAGES-DIR, which stores every layer once."
     echo "  -h                     : usage message"
     echo
     echo "Examples:"
@@ -134,39 +134,24 @@ if [[ ${binary} == "true" ]]; then
   fi
 fi
 
+# The images are copied by imageSync.py, WORKERS images at a time
+: ${WORKERS:=4}
+
 if [[ ${save} == "true" ]] && [[ -n "${ImagesList}" ]]; then
-    if [ ! -d ${ImagesDir} ]; then
-       mkdir -p ${ImagesDir}
+    echo "Save images to the bundle "${ImagesDir}"  <<<"
+    python3 ${CurrentDIR}/imageSync.py save --images-list ${ImagesList} --source "" \
+        --bundle ${ImagesDir} --arch ${ARCH} --workers ${WORKERS}
+elif [ -n "${ImagesList}" ] && [ -f ${ImagesDir}/index.json ]; then
+    # Only the layers the registry does not have yet are pushed
+    if [[ -n ${registryurl} ]]; then
+       python3 ${CurrentDIR}/imageSync.py sync --images-list ${ImagesList} \
+           --source-transport oci --source ${ImagesDir} --target ${registryurl} --arch ${ARCH} --workers ${WORKERS}
+    else
+       python3 ${CurrentDIR}/imageSync.py sync --images-list ${ImagesList} \
+           --source-transport oci --source ${ImagesDir} --target-transport docker-daemon --arch ${ARCH} --workers ${WORKERS}
     fi
-    ImagesListLen=$(cat ${ImagesList} | wc -l)
-    name=""
-    images=""
-    index=0
-    for image in $(<${ImagesList}); do
-        if [[ ${image} =~ ^\#\#.* ]]; then
-           if [[ -n ${images} ]]; then
-              echo ""
-              echo "Save images: "${name}" to "${ImagesDir}"/"${name}".tar.gz  <<<"
-              docker save ${images} | gzip -c > ${ImagesDir}"/"${name}.tar.gz
-              echo ""
-           fi
-           images=""
-           name=$(echo "${image}" | sed 's/#//g' | sed -e 's/[[:space:]]//g')
-           ((index++))
-           continue
-        fi
-
-        docker pull "${image}"
-        images=${images}" "${image}
-
-        if [[ ${index} -eq ${ImagesListLen}-1 ]]; then
-           if [[ -n ${images} ]]; then
-              docker save ${images} | gzip -c > ${ImagesDir}"/"${name}.tar.gz
-           fi
-        fi
-        ((index++))
-    done
 elif [ -n "${ImagesList}" ]; then
+    # Bundles of tar.gz files saved by older versions of this tool
     # shellcheck disable=SC2045
     for image in $(ls ${ImagesDir}/*.tar.gz); do
       echo "Load images: "${image}"  <<<"